@@ -1,29 +1,69 @@
 import numpy as np
+from functools import partial
 from loss_functions import *
-from manifold_functions import map_dataset_to_mfd
+from manifold_functions import map_dataset_to_mfd, pairwise_mfd_dist, has_dist_grad, is_exact_metric
+from neighbor_index import VPTree
 from scipy.optimize import minimize
-import scipy.stats
-
-def do_classification_tests_all(nrounds, train_ratio, K, reg, lmbd, Bnew_euc, fxn_euc, fxn_euc_dist, Bnew_mfd, fxn_mfd, fxn_mfd_dist, fxn_integrand, true_labels):
+from stochastic_optimization import fit_lmnn_stochastic
+from task_pool import run_tasks, split_jobs
+
+# Q_init and seeds, if given, hold the Q_init and seed of each round (see do_classification_test); return_Q also
+# returns the list of the Q learned in each round
+# n_jobs runs the rounds, and the fits and evaluations within them, concurrently over that many processes (see
+# run_tasks); results are gathered in the order of the rounds
+# knn_block_size, if given, classifies in blocks of that many points (see knnclassify_mapped)
+def do_classification_tests_all(nrounds, train_ratio, K, reg, lmbd, Bnew_euc, fxn_euc, fxn_euc_dist, Bnew_mfd, fxn_mfd, fxn_mfd_dist, fxn_integrand, true_labels, optimizer=None, Q_init=None, seeds=None, return_Q=False, n_jobs=None, knn_block_size=None):
     err_euc_orig = []
     err_euc_qlrn = []
     err_mfd_orig = []
     err_mfd_qlrn = []
+    Q_learned = []
 
-    for r in range(nrounds):
-        all_FQx_nbrs.clear()
-        all_FQx_impos.clear()
+    round_jobs, branch_jobs = split_jobs(n_jobs, nrounds)
+    rounds = run_tasks([(do_classification_test, (train_ratio, K, reg, lmbd, Bnew_euc, fxn_euc, fxn_euc_dist, Bnew_mfd, fxn_mfd, fxn_mfd_dist, fxn_integrand, true_labels, optimizer,
+                                                  None if Q_init is None else Q_init[r], None if seeds is None else seeds[r], True, branch_jobs, knn_block_size)) for r in range(nrounds)], round_jobs)
 
-        eeo,eeq,emo,emq = do_classification_test(train_ratio, K, reg, lmbd, Bnew_euc, fxn_euc, fxn_euc_dist, Bnew_mfd, fxn_mfd, fxn_mfd_dist, fxn_integrand, true_labels)
+    for eeo,eeq,emo,emq,Q in rounds:
         err_euc_orig.append(eeo)
         err_euc_qlrn.append(eeq)
         err_mfd_orig.append(emo)
         err_mfd_qlrn.append(emq)
+        Q_learned.append(Q)
 
+    if return_Q:
+        return err_euc_orig, err_euc_qlrn, err_mfd_orig, err_mfd_qlrn, Q_learned
     return err_euc_orig, err_euc_qlrn, err_mfd_orig, err_mfd_qlrn
 
 
-def do_classification_test(train_ratio, K, reg, lmbd, Bnew_euc, fxn_euc, fxn_euc_dist, Bnew_mfd, fxn_mfd, fxn_mfd_dist, fxn_integrand, true_labels):
+# Learns Q by minimizing the LMNN loss, starting from Q0; the target neighbors and impostors (kept in a state of
+# this fit, see new_lmnn_state) are updated before each of the 6 minimizations
+# Uses L-BFGS-B with the closed-form gradient when the manifold has one, and Powell otherwise
+# optimizer 'adam' or 'sgd' fits on minibatches of triplets instead (see fit_lmnn_stochastic)
+def fit_lmnn(Q0, K, reg, lmbd, fxn, fxn_dist, fxn_integrand, data_tr, labels_tr, name, optimizer=None):
+    if optimizer is not None:
+        res = fit_lmnn_stochastic(Q0, K, reg, lmbd, fxn, fxn_dist, fxn_integrand, data_tr, labels_tr, method=optimizer)
+        print(name + " HELD-OUT LOSS: " + str(res.fun))
+        return res
+
+    state = new_lmnn_state()
+    Q = np.ravel(Q0)
+    for count in range(6):
+        stage = "INITIAL" if count == 0 else "IN PROGRESS"
+        print(name + " " + stage + " LOSS: " + str(lmnn_loss_generic(Q, None, K, reg, lmbd, fxn, fxn_dist, fxn_integrand, data_tr, labels_tr, True, state=state)))
+        loss = partial(lmnn_loss_generic, state=state)
+        if has_dist_grad(fxn, fxn_dist):
+            res = minimize(loss, Q, args=(None, K, reg, lmbd, fxn, fxn_dist, fxn_integrand, data_tr, labels_tr, False, True), jac=True, method='L-BFGS-B')
+        else:
+            res = minimize(loss, Q, args=(None, K, reg, lmbd, fxn, fxn_dist, fxn_integrand, data_tr, labels_tr), method='Powell', options={'disp': True})
+        Q = res.x
+
+    return res
+
+# Q_init (euc, mfd) are the starting points of the fits of Q (identity by default), e.g. the Q learned for a nearby
+# lmbd; seed seeds the train/test split (drawn from np.random by default); return_Q also returns the learned Q
+# n_jobs runs the two fits, then the four evaluations, concurrently over that many processes (see run_tasks)
+# knn_block_size, if given, classifies in blocks of that many points (see knnclassify_mapped)
+def do_classification_test(train_ratio, K, reg, lmbd, Bnew_euc, fxn_euc, fxn_euc_dist, Bnew_mfd, fxn_mfd, fxn_mfd_dist, fxn_integrand, true_labels, optimizer=None, Q_init=None, seed=None, return_Q=False, n_jobs=None, knn_block_size=None):
     npts = len(Bnew_euc)
     dim_euc = len(Bnew_euc[0])
     dim_mfd = len(Bnew_mfd[0])
@@ -36,8 +76,9 @@ def do_classification_test(train_ratio, K, reg, lmbd, Bnew_euc, fxn_euc, fxn_euc
     mfd_data_ts = []
     labels_tr = []
     labels_ts = []
+    draws = np.random.random(npts) if seed is None else np.random.default_rng(seed).random(npts)
     for i in range(npts):
-        if np.random.random() < train_ratio:
+        if draws[i] < train_ratio:
             idx_tr.append(i)
             euc_data_tr.append(Bnew_euc[i])
             mfd_data_tr.append(Bnew_mfd[i])
@@ -52,46 +93,20 @@ def do_classification_test(train_ratio, K, reg, lmbd, Bnew_euc, fxn_euc, fxn_euc
     Q0_euc = np.diag([1 for _ in range(dim_euc)])
     Q0_mfd = np.diag([1 for _ in range(dim_mfd)])
 
-    all_FQx_nbrs.clear()
-    all_FQx_impos.clear()
-
-    print("EUCLIDEAN INITIAL LOSS: " + str(lmnn_loss_generic(Q0_euc, None, K, reg, lmbd, fxn_euc, fxn_euc_dist, None, euc_data_tr, labels_tr, True)))
-    euc_res_Powell = minimize(lmnn_loss_generic, Q0_euc, args=(None, K, reg, lmbd, fxn_euc, fxn_euc_dist, None, euc_data_tr, labels_tr), method='Powell', options={'disp': True})
-    for count in range(5):
-        print("EUCLIDEAN IN PROGRESS LOSS: " + str(lmnn_loss_generic(euc_res_Powell.x, None, K, reg, lmbd, fxn_euc, fxn_euc_dist, None, euc_data_tr, labels_tr, True)))
-        euc_res_Powell = minimize(lmnn_loss_generic, euc_res_Powell.x, args=(None, K, reg, lmbd, fxn_euc, fxn_euc_dist, None, euc_data_tr, labels_tr), method='Powell', options={'disp': True})
+    Qi_euc, Qi_mfd = (Q0_euc, Q0_mfd) if Q_init is None else Q_init
 
-    all_FQx_nbrs.clear()
-    all_FQx_impos.clear()
-
-    print("MANIFOLD INITIAL LOSS: " + str(lmnn_loss_generic(Q0_mfd, None, K, reg, lmbd, fxn_mfd, fxn_mfd_dist, None, mfd_data_tr, labels_tr, True)))
-    mfd_res_Powell = minimize(lmnn_loss_generic, Q0_mfd, args=(None, K, reg, lmbd, fxn_mfd, fxn_mfd_dist, fxn_integrand, mfd_data_tr, labels_tr), method='Powell', options={'disp': True})
-    for count in range(5):
-        print("MANIFOLD IN PROGRESS LOSS: " + str(lmnn_loss_generic(mfd_res_Powell.x, None, K, reg, lmbd, fxn_mfd, fxn_mfd_dist, None, mfd_data_tr, labels_tr, True)))
-        mfd_res_Powell = minimize(lmnn_loss_generic, mfd_res_Powell.x, args=(None, K, reg, lmbd, fxn_mfd, fxn_mfd_dist, fxn_integrand, mfd_data_tr, labels_tr), method='Powell', options={'disp': True})
-
-    all_FQx_nbrs.clear()
-    all_FQx_impos.clear()
+    euc_res_Powell, mfd_res_Powell = run_tasks([
+        (fit_lmnn, (Qi_euc, K, reg, lmbd, fxn_euc, fxn_euc_dist, None, euc_data_tr, labels_tr, "EUCLIDEAN", optimizer)),
+        (fit_lmnn, (Qi_mfd, K, reg, lmbd, fxn_mfd, fxn_mfd_dist, fxn_integrand, mfd_data_tr, labels_tr, "MANIFOLD", optimizer))], n_jobs)
 
     euc_Qnew = euc_res_Powell.x.reshape(dim_euc, dim_euc)
     mfd_Qnew = mfd_res_Powell.x.reshape(dim_mfd, dim_mfd)
 
-    euc_Idata_ts = map_dataset_to_mfd(euc_data_ts, Q0_euc, fxn_euc)
-    mfd_Idata_ts = map_dataset_to_mfd(mfd_data_ts, Q0_mfd, fxn_mfd)
-
-    euc_Qdata_ts = map_dataset_to_mfd(euc_data_ts, euc_Qnew, fxn_euc)
-    mfd_Qdata_ts = map_dataset_to_mfd(mfd_data_ts, mfd_Qnew, fxn_mfd)
-
-    euc_Qdata_tr = map_dataset_to_mfd(euc_data_tr, euc_Qnew, fxn_euc)
-    mfd_Qdata_tr = map_dataset_to_mfd(mfd_data_tr, mfd_Qnew, fxn_mfd)
-
-    euc_Idata_tr = map_dataset_to_mfd(euc_data_tr, Q0_euc, fxn_euc)
-    mfd_Idata_tr = map_dataset_to_mfd(mfd_data_tr, Q0_mfd, fxn_mfd)
-
-    euc_lab_ts   = knnclassify_generic(euc_Idata_ts,  K, euc_Idata_tr,  labels_tr, fxn_euc_dist, None, False)
-    euc_Qlab_ts  = knnclassify_generic(euc_Qdata_ts,  K, euc_Qdata_tr,  labels_tr, fxn_euc_dist, None, False)
-    mfd_lab_ts   = knnclassify_generic(mfd_Idata_ts,  K, mfd_Idata_tr,  labels_tr, fxn_mfd_dist, None, False)
-    mfd_Qlab_ts  = knnclassify_generic(mfd_Qdata_ts,  K, mfd_Qdata_tr,  labels_tr, fxn_mfd_dist, None, False)
+    euc_lab_ts, euc_Qlab_ts, mfd_lab_ts, mfd_Qlab_ts = run_tasks([
+        (knnclassify_mapped, (euc_data_ts, K, euc_data_tr, labels_tr, Q0_euc, fxn_euc, fxn_euc_dist, None, knn_block_size)),
+        (knnclassify_mapped, (euc_data_ts, K, euc_data_tr, labels_tr, euc_Qnew, fxn_euc, fxn_euc_dist, None, knn_block_size)),
+        (knnclassify_mapped, (mfd_data_ts, K, mfd_data_tr, labels_tr, Q0_mfd, fxn_mfd, fxn_mfd_dist, None, knn_block_size)),
+        (knnclassify_mapped, (mfd_data_ts, K, mfd_data_tr, labels_tr, mfd_Qnew, fxn_mfd, fxn_mfd_dist, None, knn_block_size))], n_jobs)
 
         # evaluate classification results
     err_euc_orig = eval_classification_quality(labels_ts, euc_lab_ts)
@@ -99,6 +114,8 @@ def do_classification_test(train_ratio, K, reg, lmbd, Bnew_euc, fxn_euc, fxn_euc
     err_mfd_orig = eval_classification_quality(labels_ts, mfd_lab_ts)
     err_mfd_qlrn = eval_classification_quality(labels_ts, mfd_Qlab_ts)
 
+    if return_Q:
+        return err_euc_orig, err_euc_qlrn, err_mfd_orig, err_mfd_qlrn, (euc_Qnew, mfd_Qnew)
     return err_euc_orig, err_euc_qlrn, err_mfd_orig, err_mfd_qlrn
 
 def eval_classification_quality(labels_ts, mfd_lab_ts):
@@ -110,28 +127,66 @@ def eval_classification_quality(labels_ts, mfd_lab_ts):
     err_01 /= len(labels_ts)
     return err_01
 
+# k-NN classification of data_ts (base space points), with data_ts and data_tr mapped onto the manifold with Q
+# With block_size, the distances are computed in blocks of block_size test by block_size training points (see
+# knnclassify_stream) instead of with a VPTree, bounding the memory used on large datasets
+def knnclassify_mapped(data_ts, K, data_tr, labels_tr, Q, fxn, fxn_dist, fxn_integrand, block_size=None):
+    if block_size is not None:
+        blocks = knnclassify_stream(map_dataset_to_mfd(data_ts, Q, fxn), K, map_dataset_to_mfd(data_tr, Q, fxn), labels_tr, fxn_dist, fxn_integrand, False, block_size, block_size)
+        return np.concatenate(list(blocks)).tolist()
+    return knnclassify_generic(map_dataset_to_mfd(data_ts, Q, fxn), K, map_dataset_to_mfd(data_tr, Q, fxn), labels_tr, fxn_dist, fxn_integrand, False)
+
+# Neighbors are found with a VPTree over data_tr for exact metrics (see is_exact_metric), and by brute force (see
+# knnclassify_stream) for approximate geodesic distances, on which the tree's pruning could miss neighbors
 def knnclassify_generic(data_ts,  K, data_tr, labels_tr, mfd_dist_generic, mfd_integrand, skip_first_nbr=False):
-    labels_ts = []
-
-    for x_ts in data_ts:
-        x_ts = np.asarray(x_ts)
-        dst_to_xts = []
-        for idx_tr, x_tr in enumerate(data_tr):
-            x_tr = np.asarray(x_tr)
-            dst_to_xts.append( mfd_dist_generic(x_tr, x_ts, mfd_integrand))
-
-        idx_of_points = np.argsort(np.asarray(dst_to_xts))
-
-        l = [];
-
+    if not is_exact_metric(mfd_dist_generic, mfd_integrand):
+        return np.concatenate(list(knnclassify_stream(data_ts, K, data_tr, labels_tr, mfd_dist_generic, mfd_integrand, skip_first_nbr))).tolist()
+
+    index = VPTree(data_tr, mfd_dist_generic, mfd_integrand)
+    _, nbrs_ts = index.query(data_ts, K+1 if skip_first_nbr else K)
+
+    if skip_first_nbr:
+        nbrs_ts = nbrs_ts[:, 1:]
+
+    return knn_vote(nbrs_ts, labels_tr).tolist()
+
+# k-NN classification of data_ts in blocks of block_size test points, yielding the labels of each block in turn
+# The distances of a block are computed in tiles of tr_block_size training points (all of them by default), keeping
+# a running set of the K nearest, so memory is O(block_size x tr_block_size) however many test points there are
+def knnclassify_stream(data_ts, K, data_tr, labels_tr, mfd_dist_generic, mfd_integrand, skip_first_nbr=False, block_size=1024, tr_block_size=None):
+    data_tr = np.asanyarray(data_tr, dtype=float)
+    tr_block_size = len(data_tr) if tr_block_size is None else tr_block_size
+    nnbrs = min(K+1 if skip_first_nbr else K, len(data_tr))
+
+    for start in range(0, len(data_ts), block_size):
+        block = np.asanyarray(data_ts[start:start + block_size], dtype=float)
+        best_dist = np.zeros((len(block), 0))
+        best_idx = np.zeros((len(block), 0), dtype=int)
+
+        for tr_start in range(0, len(data_tr), tr_block_size):
+            tile = pairwise_mfd_dist(block, data_tr[tr_start:tr_start + tr_block_size], mfd_dist_generic, mfd_integrand)
+            cand_dist = np.concatenate((best_dist, tile), axis=1)
+            cand_idx = np.concatenate((best_idx, np.broadcast_to(np.arange(tr_start, tr_start + tile.shape[1]), tile.shape)), axis=1)
+
+            if cand_dist.shape[1] > nnbrs:
+                keep = np.argpartition(cand_dist, nnbrs - 1, axis=1)[:, :nnbrs]
+                cand_dist = np.take_along_axis(cand_dist, keep, axis=1)
+                cand_idx = np.take_along_axis(cand_idx, keep, axis=1)
+            best_dist, best_idx = cand_dist, cand_idx
+
+        order = np.argsort(best_dist, axis=1)
+        best_idx = np.take_along_axis(best_idx, order, axis=1)
         if skip_first_nbr:
-            for i in idx_of_points[1:K+1]:
-                l.append(labels_tr[i])
-        else:
-            for i in idx_of_points[:K]:
-                l.append(labels_tr[i])
-
-        l_xts = scipy.stats.mode(l)
-        labels_ts.append(l_xts[0].tolist()[0])
-
-    return labels_ts
+            best_idx = best_idx[:, 1:]
+
+        yield knn_vote(best_idx, labels_tr)
+
+# Majority vote of the labels of the neighbors nbrs (m x K indices of training points; -1, as padded by
+# VPTree.query when K exceeds the number of training points, is not a neighbor)
+# Ties go to the smallest label, as with scipy.stats.mode
+def knn_vote(nbrs, labels_tr):
+    classes, codes = np.unique(np.asarray(labels_tr).ravel(), return_inverse=True)
+    votes = np.zeros((len(nbrs), len(classes)), dtype=int)
+    rows, cols = np.nonzero(nbrs >= 0)
+    np.add.at(votes, (rows, codes[nbrs[rows, cols]]), 1)
+    return classes[np.argmax(votes, axis=1)]
@@ -1,7 +1,10 @@
 import numpy as np
 from loss_functions import *
-from manifold_functions import map_dataset_to_mfd
+from manifold_functions import map_dataset_to_mfd, pairwise_mfd_dist, has_dist_grad, frechet_mean_of
 from scipy.optimize import minimize
+from stochastic_optimization import fit_mmc_stochastic
+from kmedoids import kmedoids
+from task_pool import run_tasks, split_jobs
 import random
 import sklearn.metrics
 import scipy.io
@@ -12,47 +15,162 @@ def kmeans_randomly_partition_data(FQB, k):
         assigned_labels.append(random.choice(range(k)))
     return assigned_labels
 
-def kmeans_cost_of_assignment(FQB, assigned_labels, mfd_dist_generic, mfd_integrand, k):
-    total_cost = 0
-    pts_per_clust = [0 for _ in range(k)]
-    for lblx in assigned_labels:  ## this is what i want
-        pts_per_clust[lblx] += 1
+# dist is the matrix of pairwise distances of FQB; it is computed here unless passed in
+def kmeans_cost_of_assignment(FQB, assigned_labels, mfd_dist_generic, mfd_integrand, k, dist=None):
+    if dist is None:
+        dist = pairwise_mfd_dist(FQB, None, mfd_dist_generic, mfd_integrand)
 
-    for idxx, FQx in enumerate(FQB):
-        for idxy, FQy in enumerate(FQB):
-            if assigned_labels[idxx] == assigned_labels[idxy]:
-                total_cost += mfd_dist_generic(FQx,FQy, mfd_integrand) / (2*pts_per_clust[assigned_labels[idxx]])
+    assigned_labels = np.asarray(assigned_labels)
+    pts_per_clust = np.bincount(assigned_labels, minlength=k)
 
-    return total_cost
+    same_clust = assigned_labels[:, None] == assigned_labels[None, :]
+    total_cost = (dist * same_clust).sum(axis=1) / (2*pts_per_clust[assigned_labels])
 
-def kmeans_generic(FQB, k, mfd_dist_generic, mfd_integrand):
+    return total_cost.sum()
+
+# Moves one point at a time to the cluster that lowers kmeans_cost_of_assignment the most (keeping its cluster on
+# ties), sweeping over the points until a sweep moves none of them or max_sweeps sweeps have been made
+# The cost change of a move is computed in O(k) from the sums of distances of every point to every cluster
+def kmeans_generic(FQB, k, mfd_dist_generic, mfd_integrand, max_sweeps=100):
     assigned_labels = kmeans_randomly_partition_data(FQB, k)
+    dist = pairwise_mfd_dist(FQB, None, mfd_dist_generic, mfd_integrand)
+
+    labels = np.asarray(assigned_labels)
+    onehot = np.eye(k)[labels]
+    to_clust = np.matmul(dist, onehot)                    # to_clust[i, c] = sum of distances from point i to cluster c
+    pts_per_clust = onehot.sum(axis=0)
+    clust_sum = np.sum(to_clust * onehot, axis=0)         # sum of distances over ordered pairs within each cluster
+
+    def clust_cost(S, n):
+        return np.divide(S, 2*n, out=np.zeros_like(S), where=n > 0)
 
-    converged = False
-    while not converged:
+    for _ in range(max_sweeps):
         converged = True
-        for idxx, FQx in enumerate(FQB):
-            curr_cost = kmeans_cost_of_assignment(FQB, assigned_labels, mfd_dist_generic, mfd_integrand, k)
+        for idxx in range(len(labels)):
+            a = labels[idxx]
 
-            min_new_cost = curr_cost
-            min_new_label_x = assigned_labels[idxx]
+            # cost change of moving idxx from cluster a to each cluster b
+            S_a, n_a = clust_sum[a] - 2*to_clust[idxx, a], pts_per_clust[a] - 1
+            S_b, n_b = clust_sum + 2*to_clust[idxx], pts_per_clust + 1
+            delta = clust_cost(np.asarray(S_a), np.asarray(n_a)) - clust_cost(clust_sum[a], pts_per_clust[a]) \
+                    + clust_cost(S_b, n_b) - clust_cost(clust_sum, pts_per_clust)
+            delta[a] = 0
 
-            for kidx in range(k):
-                new_labels = assigned_labels
-                new_labels[idxx] = kidx
-                new_proposed_cost = kmeans_cost_of_assignment(FQB, new_labels, mfd_dist_generic, mfd_integrand, k)
+            b = np.argmin(delta)
+            if delta[b] < -1e-12 * max(abs(clust_sum).max(), 1):
+                converged = False
+                clust_sum[a], pts_per_clust[a] = S_a, n_a
+                clust_sum[b], pts_per_clust[b] = S_b[b], n_b[b]
+                to_clust[:, a] -= dist[:, idxx]
+                to_clust[:, b] += dist[:, idxx]
+                labels[idxx] = b
 
-                if new_proposed_cost < min_new_cost:
-                    min_new_cost = new_proposed_cost
-                    min_new_label_x = kidx
-                    converged = False
+        if converged:
+            break
 
-            assigned_labels[idxx] = min_new_label_x
+    return labels.tolist()
 
-    return assigned_labels
 
+# k-medoids clustering (FasterPAM from n_init random starts, in parallel, see kmedoids) on the distances of FQB
+# seed defaults to one drawn from np.random, so that rounds differ but follow np.random.seed
+def kmedoids_generic(FQB, k, mfd_dist_generic, mfd_integrand, n_init=8, seed=None, n_jobs=None):
+    dist = pairwise_mfd_dist(FQB, None, mfd_dist_generic, mfd_integrand)
+    seed = np.random.randint(2**31) if seed is None else seed
+    assigned_labels, _, _ = kmedoids(dist, k, n_init, seed, n_jobs)
+    return assigned_labels.tolist()
+
+# Lloyd's k-means with Frechet means as centers (Riemannian k-means), for distances in frechet_mean_of (e.g. on the
+# hyperboloid): alternates assigning every point to its nearest center with moving every center to the Frechet mean of
+# its points, until no assignment changes or max_iter iterations, so that an iteration costs O(n k d)
+# Runs from n_init k-means++ initializations and keeps the lowest sum of squared distances to the centers
+# seed defaults to one drawn from np.random, so that rounds differ but follow np.random.seed
+def riemannian_kmeans_generic(FQB, k, mfd_dist_generic, mfd_integrand, n_init=4, max_iter=100, seed=None):
+    if mfd_dist_generic not in frechet_mean_of:
+        raise ValueError("No Frechet mean for distance function " + getattr(mfd_dist_generic, '__name__', repr(mfd_dist_generic)))
+    frechet_mean = frechet_mean_of[mfd_dist_generic]
+
+    FQB = np.asarray(FQB, dtype=float)
+    rng = np.random.default_rng(np.random.randint(2**31) if seed is None else seed)
+    best_labels, best_cost = None, np.inf
+
+    for _ in range(n_init):
+        # k-means++ initialization
+        centers = [FQB[rng.integers(len(FQB))]]
+        min_dist = pairwise_mfd_dist(FQB, centers, mfd_dist_generic, mfd_integrand)[:, 0]
+        for _ in range(1, k):
+            weights = min_dist**2
+            pick = rng.choice(len(FQB), p=weights / weights.sum()) if weights.sum() > 0 else rng.integers(len(FQB))
+            centers.append(FQB[pick])
+            min_dist = np.minimum(min_dist, pairwise_mfd_dist(FQB, [FQB[pick]], mfd_dist_generic, mfd_integrand)[:, 0])
+        centers = np.array(centers)
+
+        labels = None
+        for _ in range(max_iter):
+            dist = pairwise_mfd_dist(FQB, centers, mfd_dist_generic, mfd_integrand)
+            new_labels = np.argmin(dist, axis=1)
+
+            # an emptied cluster restarts from the point farthest from its center
+            for c in np.setdiff1d(np.arange(k), new_labels):
+                far = np.argmax(dist[np.arange(len(FQB)), new_labels])
+                new_labels[far] = c
+                dist[far, c] = 0
+
+            if labels is not None and np.array_equal(labels, new_labels):
+                break
+            labels = new_labels
+            centers = np.array([frechet_mean(FQB[labels == c]) for c in range(k)])
 
-def do_cluster_test(train_ratio, k, reg, lmbd, Bnew_euc, fxn_euc, fxn_euc_dist, Bnew_mfd, fxn_mfd, fxn_mfd_dist, fxn_integrand, true_labels, datasetname):
+        cost = np.sum(pairwise_mfd_dist(FQB, centers, mfd_dist_generic, mfd_integrand)[np.arange(len(FQB)), labels]**2)
+        if cost < best_cost:
+            best_labels, best_cost = labels, cost
+
+    return best_labels.tolist()
+
+# Clustering methods of do_cluster_test
+cluster_method_of = {
+    'kmeans': kmeans_generic,
+    'kmedoids': kmedoids_generic,
+    'riemannian': riemannian_kmeans_generic,
+}
+
+# Raises ValueError if cluster_method is not one of cluster_method_of or cannot cluster under the distances
+# mfd_dist_generic (Riemannian k-means needs a Frechet mean), so that tests fail before fitting Q rather than after
+def check_cluster_method(cluster_method, *mfd_dist_generic):
+    if cluster_method not in cluster_method_of:
+        raise ValueError("Undefined clustering method " + repr(cluster_method))
+    for dist in mfd_dist_generic:
+        if cluster_method == 'riemannian' and dist not in frechet_mean_of:
+            raise ValueError("No Frechet mean for distance function " + getattr(dist, '__name__', repr(dist)) + ", cannot use riemannian clustering")
+
+# Clustering (cluster_method) of the base space points data mapped onto the manifold with Q, into k clusters
+# n_jobs is the number of processes of k-medoids (see kmedoids); the other methods run in this process
+def cluster_mapped(cluster_method, data, Q, k, fxn, fxn_dist, fxn_integrand, n_jobs=None):
+    FQB = map_dataset_to_mfd(data, Q, fxn)
+    if cluster_method == 'kmedoids':
+        return kmedoids_generic(FQB, k, fxn_dist, fxn_integrand, n_jobs=n_jobs)
+    return cluster_method_of[cluster_method](FQB, k, fxn_dist, fxn_integrand)
+
+
+# Learns Q by minimizing the MMC loss, starting from Q0, with the pairs kept in a state of this fit (see new_mmc_state)
+# Uses L-BFGS-B with the closed-form gradient when the manifold has one, and Powell otherwise
+# optimizer 'adam' or 'sgd' fits on minibatches of pairs instead (see fit_mmc_stochastic)
+# max_dis_pairs fits on a class-balanced subsample of the dissimilar pairs (see get_sim_dis_pairs)
+def fit_mmc(Q0, reg, lmbd, fxn, fxn_dist, fxn_integrand, data_tr, labels_tr, optimizer=None, max_dis_pairs=None):
+    if optimizer is not None:
+        return fit_mmc_stochastic(Q0, reg, lmbd, fxn, fxn_dist, fxn_integrand, data_tr, labels_tr, method=optimizer)
+    state = new_mmc_state()
+    if has_dist_grad(fxn, fxn_dist):
+        return minimize(mmc_loss_generic, np.ravel(Q0), args=(reg, lmbd, fxn, fxn_dist, fxn_integrand, data_tr, labels_tr, True, max_dis_pairs, state), jac=True, method='L-BFGS-B')
+    return minimize(mmc_loss_generic, np.ravel(Q0), args=(reg, lmbd, fxn, fxn_dist, fxn_integrand, data_tr, labels_tr, False, max_dis_pairs, state), method='Powell', options={'disp': True})
+
+
+# Q_init (euc, mfd) are the starting points of the fits of Q (identity by default), e.g. the Q learned for a nearby
+# lmbd; seed seeds the train/test split (drawn from np.random by default); return_Q also returns the learned Q
+# n_jobs runs the two fits, then the four clusterings, concurrently over that many processes (see run_tasks); the
+# processes left over from the clusterings go to the restarts of k-medoids within them
+# max_dis_pairs fits Q on a subsample of the dissimilar pairs (see fit_mmc)
+def do_cluster_test(train_ratio, k, reg, lmbd, Bnew_euc, fxn_euc, fxn_euc_dist, Bnew_mfd, fxn_mfd, fxn_mfd_dist, fxn_integrand, true_labels, datasetname, optimizer=None, cluster_method='kmeans', Q_init=None, seed=None, return_Q=False, n_jobs=None, max_dis_pairs=None):
+    check_cluster_method(cluster_method, fxn_euc_dist, fxn_mfd_dist)
     npts = len(Bnew_euc)
     dim_euc = len(Bnew_euc[0])
     dim_mfd = len(Bnew_mfd[0])
@@ -65,8 +183,9 @@ def do_cluster_test(train_ratio, k, reg, lmbd, Bnew_euc, fxn_euc, fxn_euc_dist,
     mfd_data_ts = []
     labels_tr = []
     labels_ts = []
+    draws = np.random.random(npts) if seed is None else np.random.default_rng(seed).random(npts)
     for i in range(npts):
-        if np.random.random() < train_ratio:
+        if draws[i] < train_ratio:
             idx_tr.append(i)
             euc_data_tr.append(Bnew_euc[i])
             mfd_data_tr.append(Bnew_mfd[i])
@@ -81,26 +200,28 @@ def do_cluster_test(train_ratio, k, reg, lmbd, Bnew_euc, fxn_euc, fxn_euc_dist,
     Q0_euc = np.diag([1 for _ in range(dim_euc)])
     Q0_mfd = np.diag([1 for _ in range(dim_mfd)])
 
-    euc_res_Powell = minimize(mmc_loss_generic, Q0_euc, args=(reg, lmbd, fxn_euc, fxn_euc_dist, None, euc_data_tr, labels_tr), method='Powell', options={'disp': True})
-    mfd_res_Powell = minimize(mmc_loss_generic, Q0_mfd, args=(reg, lmbd, fxn_mfd, fxn_mfd_dist, fxn_integrand, mfd_data_tr, labels_tr), method='Powell', options={'disp': True})
+    Qi_euc, Qi_mfd = (Q0_euc, Q0_mfd) if Q_init is None else Q_init
+
+    euc_res_Powell, mfd_res_Powell = run_tasks([
+        (fit_mmc, (Qi_euc, reg, lmbd, fxn_euc, fxn_euc_dist, None, euc_data_tr, labels_tr, optimizer, max_dis_pairs)),
+        (fit_mmc, (Qi_mfd, reg, lmbd, fxn_mfd, fxn_mfd_dist, fxn_integrand, mfd_data_tr, labels_tr, optimizer, max_dis_pairs))], n_jobs)
 
     euc_Qnew = euc_res_Powell.x.reshape(dim_euc, dim_euc)
     mfd_Qnew = mfd_res_Powell.x.reshape(dim_mfd, dim_mfd)
 
-    euc_Qdata_ts = map_dataset_to_mfd(euc_data_ts, euc_Qnew, fxn_euc)
-    mfd_Qdata_ts = map_dataset_to_mfd(mfd_data_ts, mfd_Qnew, fxn_mfd)
-    euc_Idata_ts = map_dataset_to_mfd(euc_data_ts, Q0_euc, fxn_euc)
     mfd_Idata_ts = map_dataset_to_mfd(mfd_data_ts, Q0_mfd, fxn_mfd)
 
     scipy.io.savemat('./Q'+datasetname+'.mat', mdict = {'Q': mfd_Qnew, 'data': mfd_Idata_ts})
 
-        # run k-means
+        # run k-means (or cluster_method)
     K = len(np.unique(true_labels))   # number of unique labels is the value of K in K-means
 
-    euc_lab_ts  = kmeans_generic(euc_Idata_ts, K, fxn_euc_dist, None)
-    euc_Qlab_ts = kmeans_generic(euc_Qdata_ts, K, fxn_euc_dist, None)
-    mfd_lab_ts  = kmeans_generic(mfd_Idata_ts, K, fxn_mfd_dist, fxn_integrand)
-    mfd_Qlab_ts = kmeans_generic(mfd_Qdata_ts, K, fxn_mfd_dist, fxn_integrand)
+    cluster_jobs, method_jobs = split_jobs(n_jobs, 4)
+    euc_lab_ts, euc_Qlab_ts, mfd_lab_ts, mfd_Qlab_ts = run_tasks([
+        (cluster_mapped, (cluster_method, euc_data_ts, Q0_euc, K, fxn_euc, fxn_euc_dist, None, method_jobs)),
+        (cluster_mapped, (cluster_method, euc_data_ts, euc_Qnew, K, fxn_euc, fxn_euc_dist, None, method_jobs)),
+        (cluster_mapped, (cluster_method, mfd_data_ts, Q0_mfd, K, fxn_mfd, fxn_mfd_dist, fxn_integrand, method_jobs)),
+        (cluster_mapped, (cluster_method, mfd_data_ts, mfd_Qnew, K, fxn_mfd, fxn_mfd_dist, fxn_integrand, method_jobs))], cluster_jobs)
 
         # evaluate k-means results
     err_euc_orig = eval_cluster_quality(labels_ts, euc_lab_ts)
@@ -108,6 +229,8 @@ def do_cluster_test(train_ratio, k, reg, lmbd, Bnew_euc, fxn_euc, fxn_euc_dist,
     err_mfd_orig = eval_cluster_quality(labels_ts, mfd_lab_ts)
     err_mfd_qlrn = eval_cluster_quality(labels_ts, mfd_Qlab_ts)
 
+    if return_Q:
+        return err_euc_orig, err_euc_qlrn, err_mfd_orig, err_mfd_qlrn, (euc_Qnew, mfd_Qnew)
     return err_euc_orig, err_euc_qlrn, err_mfd_orig, err_mfd_qlrn
 
 
@@ -119,17 +242,30 @@ def eval_cluster_quality(true_labels, assigned_labels):
     err = [ARI, NMI]
     return err
 
-def do_cluster_tests_all(nrounds, train_ratio, k, reg, lmbd, Bnew_euc, fxn_euc, fxn_euc_dist, Bnew_mfd, fxn_mfd, fxn_mfd_dist, fxn_integrand, true_labels, datasetname):
+# Q_init and seeds, if given, hold the Q_init and seed of each round (see do_cluster_test); return_Q also returns
+# the list of the Q learned in each round
+# n_jobs runs the rounds, and the fits and clusterings within them, concurrently over that many processes (see
+# run_tasks); results are gathered in the order of the rounds
+# max_dis_pairs fits Q on a subsample of the dissimilar pairs (see fit_mmc)
+def do_cluster_tests_all(nrounds, train_ratio, k, reg, lmbd, Bnew_euc, fxn_euc, fxn_euc_dist, Bnew_mfd, fxn_mfd, fxn_mfd_dist, fxn_integrand, true_labels, datasetname, optimizer=None, cluster_method='kmeans', Q_init=None, seeds=None, return_Q=False, n_jobs=None, max_dis_pairs=None):
+    check_cluster_method(cluster_method, fxn_euc_dist, fxn_mfd_dist)
     err_euc_orig = []
     err_euc_qlrn = []
     err_mfd_orig = []
     err_mfd_qlrn = []
+    Q_learned = []
+
+    round_jobs, branch_jobs = split_jobs(n_jobs, nrounds)
+    rounds = run_tasks([(do_cluster_test, (train_ratio, k, reg, lmbd, Bnew_euc, fxn_euc, fxn_euc_dist, Bnew_mfd, fxn_mfd, fxn_mfd_dist, fxn_integrand, true_labels, datasetname, optimizer, cluster_method,
+                                           None if Q_init is None else Q_init[r], None if seeds is None else seeds[r], True, branch_jobs, max_dis_pairs)) for r in range(nrounds)], round_jobs)
 
-    for r in range(nrounds):
-        eeo,eeq,emo,emq = do_cluster_test(train_ratio, k, reg, lmbd, Bnew_euc, fxn_euc, fxn_euc_dist, Bnew_mfd, fxn_mfd, fxn_mfd_dist, fxn_integrand, true_labels, datasetname)
+    for eeo,eeq,emo,emq,Q in rounds:
         err_euc_orig.append(eeo)
         err_euc_qlrn.append(eeq)
         err_mfd_orig.append(emo)
         err_mfd_qlrn.append(emq)
+        Q_learned.append(Q)
 
+    if return_Q:
+        return err_euc_orig, err_euc_qlrn, err_mfd_orig, err_mfd_qlrn, Q_learned
     return err_euc_orig, err_euc_qlrn, err_mfd_orig, err_mfd_qlrn
@@ -0,0 +1,65 @@
+import os
+import numpy as np
+import scipy.io
+from sklearn.model_selection import train_test_split
+from manifold_functions import hyp_mfd, hyp_mfd_dist, helicoid_mfd, helicoid_mfd_dist, integrand_helicoid, klein_mfd, klein_mfd_dist, \
+    integrand_klein, swiss_mfd, swiss_mfd_base_dist, torus_mfd, torus_mfd_base_dist, trefoil_mfd, trefoil_mfd_base_dist
+
+# ----------------------------------------------------------------------------------------------------
+#
+# DATASETS
+#
+# ----------------------------------------------------------------------------------------------------
+
+# Directory of the .mat files of the datasets, and of the .npy cache of their variables
+data_dir = './data'
+cache_dir = os.path.join(data_dir, 'cache')
+
+# Datasets of the metric learning tests, by name: variables of the .mat file holding the points for the Euclidean
+# tests, the points for the manifold tests and the labels; train ratio; chart, distance and integrand of the
+# manifold; and, if not None, the fraction of the points kept on load (a random subsample)
+dataset_of = {
+    'karate':      {'vars': ('Beuc', 'Bhyp', 'Labels'), 'train_ratio': 0.8, 'mfd': hyp_mfd, 'mfd_dist': hyp_mfd_dist, 'integrand': None, 'subsample': None},
+    'helicoid':    {'vars': ('data', 'base', 'labels'), 'train_ratio': 0.6, 'mfd': helicoid_mfd, 'mfd_dist': helicoid_mfd_dist, 'integrand': integrand_helicoid, 'subsample': None},
+    'football':    {'vars': ('Beuc', 'Bhyp', 'Labels'), 'train_ratio': 0.75, 'mfd': hyp_mfd, 'mfd_dist': hyp_mfd_dist, 'integrand': None, 'subsample': None},
+    'polbooks':    {'vars': ('Beuc', 'Bhyp', 'Labels'), 'train_ratio': 0.7, 'mfd': hyp_mfd, 'mfd_dist': hyp_mfd_dist, 'integrand': None, 'subsample': None},
+    'adjnoun':     {'vars': ('Beuc', 'Bhyp', 'Labels'), 'train_ratio': 0.7, 'mfd': hyp_mfd, 'mfd_dist': hyp_mfd_dist, 'integrand': None, 'subsample': None},
+    '20newsgroup': {'vars': ('Beuc', 'Bhyp', 'Labels'), 'train_ratio': 0.7, 'mfd': hyp_mfd, 'mfd_dist': hyp_mfd_dist, 'integrand': None, 'subsample': None},
+    'klein':       {'vars': ('Beuc', 'Bklein', 'labels'), 'train_ratio': 0.7, 'mfd': klein_mfd, 'mfd_dist': klein_mfd_dist, 'integrand': integrand_klein, 'subsample': None},
+    'swiss':       {'vars': ('swiss_base', 'swiss_data', 'swiss_labels'), 'train_ratio': 0.7, 'mfd': swiss_mfd, 'mfd_dist': swiss_mfd_base_dist, 'integrand': None, 'subsample': 0.4},
+    'torus':       {'vars': ('torus_base', 'torus_data', 'torus_labels'), 'train_ratio': 0.7, 'mfd': torus_mfd, 'mfd_dist': torus_mfd_base_dist, 'integrand': None, 'subsample': 0.4},
+    'trefoil':     {'vars': ('trefoil_base', 'trefoil_data', 'trefoil_labels'), 'train_ratio': 0.7, 'mfd': trefoil_mfd, 'mfd_dist': trefoil_mfd_base_dist, 'integrand': None, 'subsample': 0.4},
+}
+
+# Input: datasetname, names of variables of its .mat file
+# Output: the variables, as read-only memory-mapped arrays
+# The .mat file is parsed once, when the cache (one .npy file per variable under cache_dir) is missing or older than
+# it; each file is written under a temporary name and renamed, so that concurrent loads never see a partial file
+def load_mat_vars(datasetname, names):
+    mat_path = os.path.join(data_dir, datasetname + '.mat')
+    npy_paths = [os.path.join(cache_dir, datasetname + '_' + name + '.npy') for name in names]
+
+    mat_time = os.path.getmtime(mat_path)
+    if not all(os.path.exists(p) and os.path.getmtime(p) >= mat_time for p in npy_paths):
+        mat = scipy.io.loadmat(mat_path, variable_names=list(names))
+        os.makedirs(cache_dir, exist_ok=True)
+        for name, path in zip(names, npy_paths):
+            tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, mat[name])
+            os.replace(tmp_path, path)
+
+    return [np.load(p, mmap_mode='r') for p in npy_paths]
+
+# Input: datasetname - one of dataset_of, seed - seed of the subsample of the dataset, if it has one (random by default)
+# Output: Beuc, Bhyp, Labels, train_ratio, fxn_mfd, fxn_mfd_dist, fxn_integrand; None for an undefined dataset
+def load_dataset(datasetname, seed=None):
+    if datasetname not in dataset_of:
+        return None
+    dataset = dataset_of[datasetname]
+    Beuc, Bhyp, Labels = load_mat_vars(datasetname, dataset['vars'])
+
+    if dataset['subsample'] is not None:
+        _, Beuc, __, Bhyp, ___, Labels = train_test_split(Beuc, Bhyp, Labels, test_size=dataset['subsample'], random_state=seed)
+
+    return Beuc, Bhyp, Labels, dataset['train_ratio'], dataset['mfd'], dataset['mfd_dist'], dataset['integrand']
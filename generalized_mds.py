@@ -5,6 +5,7 @@
 # ----------------------------------------------------------------------------------------------------
 
 import numpy as np
+from manifold_functions import map_dataset_to_mfd, pairwise_mfd_dist
 
 # mfd_generic is a function that maps points in the base space B to the specified manifold
 # mfd_dist_generic is the distance function on the manifold
@@ -17,11 +18,10 @@ def mds_loss(B, npts, dim, Dist, mfd_generic, mfd_dist_generic, integrand):
     I = np.diag([1 for _ in range(dim)])
 
     FB = map_dataset_to_mfd(B, I, mfd_generic)
+    FB_dist = pairwise_mfd_dist(FB, None, mfd_dist_generic, integrand)
 
-    loss = 0
-    for i in range(npts):
-        for j in range(i-1):  # Traverse the upper triangular matrix
-            loss += (mfd_dist_generic(FB[i], FB[j], integrand) - Dist[i][j]) ** 2
+    lower = np.tril(np.ones((npts, npts), dtype=bool), -2)   # pairs j < i-1, as traversed before
+    loss = np.sum((FB_dist - np.asarray(Dist))[lower] ** 2)
 
     print(B)
     return loss
@@ -0,0 +1,161 @@
+# ----------------------------------------------------------------------------------------------------
+#
+# CACHE OF APPROXIMATE GEODESIC DISTANCES
+#
+# ----------------------------------------------------------------------------------------------------
+
+import os
+import hashlib
+import numpy as np
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:   # no file locking on this platform; concurrent saves may then drop entries
+    fcntl = None
+
+# Memoizes the distances computed by learn_distance / learn_distances for pairs of base space points
+# Entries are keyed on the integrand, the solver settings and the coordinates of both points quantized to
+# a grid of spacing resolution (in canonical order, since distances are symmetric)
+# Recently used entries are kept in memory, up to maxsize of them (least recently used are evicted first)
+# If path is given, it is a directory holding one pair of .npy files (sorted keys, distances) per integrand
+# and settings; these are memory-mapped on load, and save() merges the in-memory entries into them, so
+# repeated runs and parallel jobs on the same dataset can reuse each other's distances
+class GeodesicCache:
+    def __init__(self, maxsize=200000, resolution=1e-9, path=None):
+        self.maxsize = maxsize
+        self.resolution = resolution
+        self.path = path
+        self.entries = OrderedDict()   # (prefix, key) -> distance
+        self.stored = {}               # prefix -> (sorted keys, distances) read from disk
+        self.hits = 0
+        self.misses = 0
+
+    # Identifies the integrand and solver settings an entry was computed with
+    def prefix_of(self, integrand, settings):
+        name = getattr(integrand, '__module__', '') + '.' + getattr(integrand, '__qualname__', repr(integrand))
+        return name + repr(sorted(settings.items())) + repr(self.resolution)
+
+    # Input: BX, BY (P x dim) pairs of base space points
+    # Output: P fixed-length byte keys
+    def keys_of(self, BX, BY):
+        BX = np.asarray(BX, dtype=float).reshape(len(BX), -1)
+        BY = np.asarray(BY, dtype=float).reshape(len(BY), -1)
+        qx = np.round(BX / self.resolution).astype(np.int64)
+        qy = np.round(BY / self.resolution).astype(np.int64)
+
+        # canonical order of the two endpoints: lexicographic on the quantized coordinates
+        diff = qx != qy
+        first = np.argmax(diff, axis=1)
+        swap = qx[np.arange(len(qx)), first] > qy[np.arange(len(qy)), first]
+        qa = np.where(swap[:, None], qy, qx)
+        qb = np.where(swap[:, None], qx, qy)
+
+        keys = np.ascontiguousarray(np.concatenate((qa, qb), axis=1))
+        return keys.view('S' + str(keys.shape[1] * 8)).ravel()
+
+    # Output: distances of the pairs (valid where found), boolean mask of the pairs found, and their keys
+    def lookup(self, BX, BY, integrand, settings):
+        prefix = self.prefix_of(integrand, settings)
+        keys = self.keys_of(BX, BY)
+        dist = np.zeros(len(keys))
+        found = np.zeros(len(keys), dtype=bool)
+
+        for i, key in enumerate(keys):
+            entry = (prefix, key)
+            if entry in self.entries:
+                self.entries.move_to_end(entry)
+                dist[i] = self.entries[entry]
+                found[i] = True
+
+        stored_keys, stored_dist = self.load(prefix, keys.dtype)
+        if len(stored_keys) > 0 and not found.all():
+            missing = np.flatnonzero(~found)
+            pos = np.minimum(np.searchsorted(stored_keys, keys[missing]), len(stored_keys) - 1)
+            on_disk = stored_keys[pos] == keys[missing]
+            dist[missing[on_disk]] = stored_dist[pos[on_disk]]
+            found[missing[on_disk]] = True
+
+        self.hits += int(found.sum())
+        self.misses += int((~found).sum())
+        return dist, found, keys
+
+    def store(self, keys, dist, integrand, settings):
+        prefix = self.prefix_of(integrand, settings)
+        for key, d in zip(keys, dist):
+            self.entries[(prefix, key)] = float(d)
+            self.entries.move_to_end((prefix, key))
+
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.stored.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def files_of(self, prefix):
+        name = os.path.join(self.path, hashlib.sha1(prefix.encode()).hexdigest())
+        return name + '.keys.npy', name + '.dist.npy'
+
+    # Memory-maps the stored entries for prefix (empty arrays if there is no on-disk store)
+    def load(self, prefix, key_dtype):
+        if prefix in self.stored:
+            return self.stored[prefix]
+
+        stored = (np.zeros(0, dtype=key_dtype), np.zeros(0))
+        if self.path is not None and os.path.exists(self.path):
+            keys_file, dist_file = self.files_of(prefix)
+            with open(os.path.join(self.path, 'lock'), 'a') as lock:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_SH)
+                if os.path.exists(keys_file) and os.path.exists(dist_file):
+                    stored = (np.load(keys_file, mmap_mode='r'), np.load(dist_file, mmap_mode='r'))
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+        self.stored[prefix] = stored
+        return stored
+
+    # Merges the in-memory entries into the on-disk store
+    def save(self):
+        if self.path is None:
+            return
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, exist_ok=True)
+
+        by_prefix = {}
+        for (prefix, key), d in self.entries.items():
+            by_prefix.setdefault(prefix, ([], []))
+            by_prefix[prefix][0].append(key)
+            by_prefix[prefix][1].append(d)
+
+        with open(os.path.join(self.path, 'lock'), 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+
+            for prefix, (keys, dist) in by_prefix.items():
+                keys = np.asarray(keys)
+                dist = np.asarray(dist)
+
+                # re-read the store, since other jobs may have saved to it since it was loaded
+                stored_keys, stored_dist = (np.zeros(0, dtype=keys.dtype), np.zeros(0))
+                keys_file, dist_file = self.files_of(prefix)
+                if os.path.exists(keys_file) and os.path.exists(dist_file):
+                    stored_keys, stored_dist = np.load(keys_file), np.load(dist_file)
+                keys = np.concatenate((stored_keys, keys))
+                dist = np.concatenate((stored_dist, dist))
+
+                # later entries win, then sort for binary search
+                keys, first = np.unique(keys[::-1], return_index=True)
+                dist = dist[::-1][first]
+
+                self.stored.pop(prefix, None)
+                for fname, arr in ((keys_file, keys), (dist_file, dist)):
+                    tmp = fname + '.' + str(os.getpid()) + '.tmp.npy'
+                    np.save(tmp, arr)
+                    os.replace(tmp, fname)
+
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
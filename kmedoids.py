@@ -0,0 +1,90 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from task_pool import default_jobs
+
+# ----------------------------------------------------------------------------------------------------
+#
+# K-MEDOIDS CLUSTERING
+#
+# ----------------------------------------------------------------------------------------------------
+
+# Input: dist (n x n) distance matrix, medoids (k indices)
+# Output: index (into medoids) of the nearest and second nearest medoid of every point, and the distances to them
+def nearest_medoids(dist, medoids):
+    to_medoids = dist[:, medoids]
+    order = np.argsort(to_medoids, axis=1, kind='stable')[:, :2]
+    dn = np.take_along_axis(to_medoids, order[:, :1], axis=1)[:, 0]
+    ds = np.take_along_axis(to_medoids, order[:, 1:2], axis=1)[:, 0] if len(medoids) > 1 else np.full(len(dist), np.inf)
+    return order[:, 0], dn, ds
+
+# FasterPAM (Schubert and Rousseeuw, 2021): starting from the medoids given, swaps a medoid with a non-medoid as
+# soon as the swap lowers the total deviation (sum of distances of the points to their nearest medoid)
+# The best medoid to swap out for a candidate x is found with a single O(n) pass over the points, using the
+# distances to the nearest and second nearest medoids; stops after a pass over all candidates without a swap, or
+# after max_iter passes
+# Output: medoids, index (into medoids) of the nearest medoid of every point, total deviation
+def fasterpam(dist, medoids, max_iter=100):
+    n, k = len(dist), len(medoids)
+    medoids = np.array(medoids)
+    nearest, dn, ds = nearest_medoids(dist, medoids)
+    removal_loss = np.bincount(nearest, weights=ds - dn, minlength=k)
+
+    last_swap = 0
+    for _ in range(max_iter):
+        swapped = False
+        for x in np.concatenate((np.arange(last_swap, n), np.arange(last_swap))):
+            if x in medoids:
+                continue
+
+            # change of the total deviation when x replaces each medoid
+            dox = dist[:, x]
+            closer = dox < dn
+            between = ~closer & (dox < ds)
+            delta = removal_loss + np.bincount(nearest[closer], weights=dn[closer] - ds[closer], minlength=k) \
+                    + np.bincount(nearest[between], weights=dox[between] - ds[between], minlength=k)
+            delta += np.sum(dox[closer] - dn[closer])
+
+            m = np.argmin(delta)
+            if delta[m] < -1e-12 * max(dn.sum(), 1):
+                medoids[m] = x
+                nearest, dn, ds = nearest_medoids(dist, medoids)
+                removal_loss = np.bincount(nearest, weights=ds - dn, minlength=k)
+                swapped, last_swap = True, x
+
+        if not swapped:
+            break
+
+    return medoids, nearest, dn.sum()
+
+# Distance matrix shared with the worker processes of kmedoids, so that it is sent to each worker only once
+worker_dist = None
+
+def set_worker_dist(dist):
+    global worker_dist
+    worker_dist = dist
+
+def fasterpam_from_seed(args):
+    seed, k, max_iter = args
+    rng = np.random.default_rng(seed)
+    return fasterpam(worker_dist, rng.choice(len(worker_dist), size=k, replace=False), max_iter)
+
+# k-medoids clustering of the points with distance matrix dist: runs FasterPAM from n_init random sets of medoids
+# (seeded from seed) over n_jobs processes (see default_jobs; 1 runs them in this process), and keeps the run
+# with the lowest total deviation
+# Output: index (0..k-1) of the cluster of every point, medoids, total deviation
+def kmedoids(dist, k, n_init=8, seed=0, n_jobs=None, max_iter=100):
+    dist = np.asarray(dist, dtype=float)
+    seeds = np.random.SeedSequence(seed).spawn(n_init)
+    tasks = [(s, k, max_iter) for s in seeds]
+
+    n_jobs = default_jobs(n_jobs)
+    if n_jobs <= 1 or n_init <= 1:
+        set_worker_dist(dist)
+        runs = [fasterpam_from_seed(t) for t in tasks]
+        set_worker_dist(None)
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, n_init), initializer=set_worker_dist, initargs=(dist,)) as pool:
+            runs = list(pool.map(fasterpam_from_seed, tasks))
+
+    medoids, nearest, deviation = min(runs, key=lambda run: run[2])
+    return nearest, medoids, deviation
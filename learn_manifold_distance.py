@@ -1,51 +1,122 @@
 import numpy as np
+from collections import OrderedDict
+from functools import lru_cache
 from scipy.integrate import quad
+from scipy.optimize import minimize
+
+# ----------------------------------------------------------------------------------------------------
+#
+# VECTORIZED ARC LENGTH INTEGRANDS
+#
+# ----------------------------------------------------------------------------------------------------
+
+# Integrands have the signature integrand(t, x, y, Q). For a scalar t and single points x, y they return
+# a float (as needed by scipy's quad); for an array of nodes t and stacks of segment endpoints x, y of
+# shape (..., dim) they return the integrand on every node of every segment, with shape (..., len(t))
+
+# Straight path from x to y in the base space, evaluated at t
+# Output: Pth with shape (..., *t.shape, dim), and Dff = y - x broadcastable against Pth
+def linear_path(t, x, y):
+    t = np.asarray(t, dtype=float)
+    x, y = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+    shape = x.shape[:-1] + (1,) * t.ndim + x.shape[-1:]
+    x = x.reshape(shape)
+    y = y.reshape(shape)
+    t = t[..., None]
 
-# Arc length integrand for the sinusoid manifold: (x, y, sin(x) + sin(y))
-def integrand_sinusoid(t, x, y, Q):
     Pth = (1 - t) * x + (y * t)
     Dff = y-x
+    return Pth, Dff
+
+# Builds a Jacobian of shape (..., rows, cols) from nested lists of entries (scalars or arrays)
+def stack_jacobian(D):
+    entries = np.broadcast_arrays(*[np.asarray(e, dtype=float) for row in D for e in row])
+    ncols = len(D[0])
+    rows = [np.stack(entries[i*ncols:(i+1)*ncols], axis=-1) for i in range(len(D))]
+    return np.stack(rows, axis=-2)
+
+# Norm of the velocity D Q Dff of the path on the manifold
+def velocity_norm(D, Q, Dff):
+    QDff = np.matmul(Dff, np.asarray(Q, dtype=float).T)
+    v = np.matmul(D, QDff[..., None])[..., 0]
+    return np.linalg.norm(v, axis=-1)
+
+# Arc length integrand for the sinusoid manifold: (x, y, sin(x) + sin(y))
+def integrand_sinusoid(t, x, y, Q):
+    Pth, Dff = linear_path(t, x, y)
 
-    r = Pth[0]
-    s = Pth[1]
-    D = np.asarray([[1, 0], [0, 1], [np.cos(r), np.cos(s)]])
+    r = Pth[..., 0]
+    s = Pth[..., 1]
+    D = stack_jacobian([[1, 0], [0, 1], [np.cos(r), np.cos(s)]])
 
-    v = np.matmul(D, np.matmul(Q, Dff))
-    return np.linalg.norm(v)
+    return velocity_norm(D, Q, Dff)
 
 # Arc length integrand for the hyperboloid
 def integrand_hyp(t, x, y, Q):
-    Pth = (1 - t) * x + (y * t)
-    Dff = y-x
-    ip = np.matmul(Dff.T, np.matmul(Q.T, np.matmul(Q, Dff)))
-    nm = np.matmul(Pth.T, Dff)
-    dn = 1 + np.matmul(Pth.T, Pth)
+    Pth, Dff = linear_path(t, x, y)
+    QDff = np.matmul(Dff, np.asarray(Q, dtype=float).T)
+    ip = np.sum(QDff**2, axis=-1)
+    nm = np.sum(Pth * Dff, axis=-1)
+    dn = 1 + np.sum(Pth**2, axis=-1)
 
     return np.sqrt( ip - (nm**2 / dn) )
 
 # Arc length integrand for the helicoid
 def integrand_helicoid(t, x, y, Q):
-    Pth = (1 - t) * x + (y * t)
-    Dff = y-x   # 2 x 1
+    Pth, Dff = linear_path(t, x, y)
 
-    r = Pth[0]
-    s = Pth[1]
-    D = [[np.cos(s), -r * np.sin(s)],
+    r = Pth[..., 0]
+    s = Pth[..., 1]
+    D = stack_jacobian([[np.cos(s), -r * np.sin(s)],
         [np.sin(s), r * np.cos(s)],
-        [0, 1]]
+        [0, 1]])
 
-    v = np.matmul(D, np.matmul(Q, Dff))
-    return np.linalg.norm(v)
+    return velocity_norm(D, Q, Dff)
 
-# Takes points x, y in the base space and computes the distance between their mappings on the given manifold
-# Q is a linear transformation on x, y in the base Euclidean space; set to identity if not desired
-# The number of segments increases the resolution of the approximation path, but also heavily increases computation time
-# Samples increases the number of sampled points at each segment recalculation
-def learn_distance(x, y, Q, integrand, samples=100, segments=7):
-    dim = len(x)
-    path_segments = []
-    for i in range(segments):
-        path_segments.append((i / (segments-1) * (y - x)) + x)
+# ----------------------------------------------------------------------------------------------------
+#
+# PATH LENGTHS AND DISTANCE APPROXIMATION
+#
+# ----------------------------------------------------------------------------------------------------
+
+# Gauss-Legendre nodes and weights of the given order, mapped to [0, 1]
+@lru_cache(maxsize=None)
+def gauss_legendre_nodes(order):
+    nodes, weights = np.polynomial.legendre.leggauss(order)
+    return 0.5 * (nodes + 1), 0.5 * weights
+
+# Length on the manifold of the straight base space segment from x to y
+# quadrature='quad' integrates adaptively with scipy's quad, one segment at a time (accuracy reference)
+# quadrature='gauss' evaluates the integrand on all nodes of a fixed-order Gauss-Legendre rule in one call;
+#   x and y may then be stacks of segment endpoints (..., dim), and the output has shape (...)
+def segment_length(integrand, x, y, Q, quadrature='quad', order=16):
+    if quadrature == 'quad':
+        return quad(integrand, 0, 1, args=(x, y, Q))[0]
+    elif quadrature == 'gauss':
+        nodes, weights = gauss_legendre_nodes(order)
+        return np.matmul(integrand(nodes, x, y, Q), weights)
+    else:
+        raise ValueError("Unknown quadrature: " + str(quadrature))
+
+# Straight path with the given number of nodes from x to y (both of shape (..., dim))
+def straight_path(x, y, segments):
+    steps = np.linspace(0, 1, segments)[:, None]
+    return x[..., None, :] + steps * (y - x)[..., None, :]
+
+# Moves the end points of path (..., nodes, dim) to x, y (..., dim), dragging its interior nodes along
+# linearly, so that a path learned for nearby end points can seed the search for x, y
+# Paths containing NaNs (no previous path) are replaced by straight paths
+def shift_path(path, x, y):
+    steps = np.linspace(0, 1, path.shape[-2])[:, None]
+    shifted = path + (1 - steps) * (x - path[..., 0, :])[..., None, :] + steps * (y - path[..., -1, :])[..., None, :]
+    unknown = np.isnan(shifted).any(axis=(-2, -1))
+    shifted[unknown] = straight_path(x, y, path.shape[-2])[unknown]
+    return shifted
+
+# Refines path (nodes x dim) in place by random sampling: each interior node is repeatedly moved to the best of
+# samples uniform perturbations around it (if shorter), until a full sweep leaves every node where it is
+def sample_path(path_segments, Q, integrand, samples, quadrature, order):
+    dim = path_segments.shape[1]
 
     convergence = True
     while convergence is True:
@@ -60,22 +131,29 @@ def learn_distance(x, y, Q, integrand, samples=100, segments=7):
             sample_radius = max(np.linalg.norm(this_point - prev_point), np.linalg.norm(this_point - next_point))
 
             s = np.random.uniform(-sample_radius,sample_radius,size=(samples, dim))
-            D1 = quad(integrand, 0, 1, args=(prev_point, this_point, Q))[0]
-            D2 = quad(integrand, 0, 1, args=(this_point, next_point, Q))[0]
 
-            min_dist = D1+D2
-            best_sample = this_point
-            for sample in s:
-                sample = sample + this_point
+            if quadrature == 'gauss':
+                # the current point comes first, so it is kept unless a sample is strictly shorter
+                candidates = np.vstack(([this_point], s + this_point))
+                Distance = segment_length(integrand, prev_point, candidates, Q, quadrature, order) + \
+                           segment_length(integrand, candidates, next_point, Q, quadrature, order)
+                best_sample = candidates[np.argmin(Distance)]
+            else:
+                D1 = segment_length(integrand, prev_point, this_point, Q, quadrature, order)
+                D2 = segment_length(integrand, this_point, next_point, Q, quadrature, order)
 
+                min_dist = D1+D2
+                best_sample = this_point
+                for sample in s:
+                    sample = sample + this_point
 
-                D1 = quad(integrand, 0, 1, args=(prev_point, sample, Q))[0]
-                D2 = quad(integrand, 0, 1, args=(sample, next_point, Q))[0]
+                    D1 = segment_length(integrand, prev_point, sample, Q, quadrature, order)
+                    D2 = segment_length(integrand, sample, next_point, Q, quadrature, order)
 
-                Distance = D1 + D2
-                if Distance < min_dist:
-                    min_dist = Distance
-                    best_sample = sample
+                    Distance = D1 + D2
+                    if Distance < min_dist:
+                        min_dist = Distance
+                        best_sample = sample
 
             if np.linalg.norm(this_point - best_sample) < 10e-6:
                 path_segments[i] = best_sample
@@ -85,9 +163,266 @@ def learn_distance(x, y, Q, integrand, samples=100, segments=7):
 
     # while loop ends
 
-    total_distance = 0
-    for idx in range(len(path_segments[:-1])):
-        Distance = quad(integrand, 0, 1, args=(path_segments[idx], path_segments[idx+1], Q))[0]
-        total_distance += Distance
+# Length of the discrete path through x, the interior nodes and y, and its gradient with respect to the interior
+# nodes by central finite differences; a node only enters its two adjacent segments, so the perturbed lengths
+# for all coordinates of all nodes are evaluated in two vectorized integrand calls
+def path_length(interior, x, y, Q, integrand, order, step):
+    dim = len(x)
+    path = np.vstack(([x], interior.reshape(-1, dim), [y]))
+    length = np.sum(segment_length(integrand, path[:-1], path[1:], Q, 'gauss', order))
+
+    offsets = step * np.eye(dim)
+    perturbed = path[1:-1, None, None, :] + np.stack((offsets, -offsets))[None, :, :, :]   # nodes x 2 x dim x dim
+    before = segment_length(integrand, path[:-2, None, None, :], perturbed, Q, 'gauss', order)
+    after = segment_length(integrand, perturbed, path[2:, None, None, :], Q, 'gauss', order)
+    local_length = before + after
+    grad = (local_length[:, 0, :] - local_length[:, 1, :]) / (2 * step)
+
+    return length, grad.ravel()
+
+# Refines path (nodes x dim) in place by minimizing its length over all interior nodes jointly with L-BFGS,
+# stopping when the relative decrease in length or the gradient falls below tol, or after maxiter iterations
+def minimize_path_length(path_segments, Q, integrand, order, tol, maxiter):
+    if len(path_segments) < 3:
+        return
+    x = path_segments[0]
+    y = path_segments[-1]
+    step = 1e-6 * max(1.0, np.linalg.norm(y - x))
+
+    res = minimize(path_length, path_segments[1:-1].ravel(), args=(x, y, Q, integrand, order, step),
+                   jac=True, method='L-BFGS-B', options={'ftol': tol, 'gtol': tol, 'maxiter': maxiter})
+    path_segments[1:-1] = res.x.reshape(-1, len(x))
+
+# Refines path (nodes x dim) in place with the given method (see learn_distance)
+def refine_path(path_segments, Q, integrand, method, samples, quadrature, order, tol, maxiter):
+    if method == 'sample':
+        sample_path(path_segments, Q, integrand, samples, quadrature, order)
+    elif method == 'lbfgs':
+        minimize_path_length(path_segments, Q, integrand, order, tol, maxiter)
+    else:
+        raise ValueError("Unknown method: " + str(method))
+
+# Lengths of the segments of path (nodes x dim)
+def path_segment_lengths(path_segments, Q, integrand, quadrature, order):
+    if quadrature == 'gauss':
+        return segment_length(integrand, path_segments[:-1], path_segments[1:], Q, quadrature, order)
+    return np.asarray([segment_length(integrand, path_segments[idx], path_segments[idx+1], Q, quadrature, order)
+                       for idx in range(len(path_segments) - 1)])
+
+# One step of adaptive refinement of a converged path (nodes x dim)
+# The error of each segment is estimated as how much shorter it gets when split at an optimized midpoint;
+# segments whose error exceeds their share of rtol * length are split (the worst first, up to max_segments nodes)
+# Output: the subdivided path, and whether the estimated relative error of the whole path is within rtol
+def subdivide_path(path_segments, Q, integrand, method, samples, quadrature, order, tol, maxiter, rtol, max_segments):
+    lengths = path_segment_lengths(path_segments, Q, integrand, quadrature, order)
+    total_distance = np.sum(lengths)
+
+    halves = straight_path(path_segments[:-1], path_segments[1:], 3)   # segments x 3 x dim
+    if method == 'sample' and quadrature == 'gauss':
+        split_lengths = learn_distances_batch(halves, Q, integrand, samples, order)
+    else:
+        split_lengths = np.zeros(len(halves))
+        for idx in range(len(halves)):
+            refine_path(halves[idx], Q, integrand, method, samples, quadrature, order, tol, maxiter)
+            split_lengths[idx] = np.sum(path_segment_lengths(halves[idx], Q, integrand, quadrature, order))
 
+    errors = np.maximum(lengths - split_lengths, 0)
+    if np.sum(errors) <= rtol * total_distance:
+        return path_segments, True
+
+    split = np.zeros(len(lengths), dtype=bool)
+    worst_first = np.argsort(-errors)
+    nsplit = min(max_segments - len(path_segments), np.sum(errors > rtol * total_distance / len(lengths)))
+    split[worst_first[:max(nsplit, 1)]] = True
+
+    new_path = [path_segments[0]]
+    for idx in range(len(lengths)):
+        if split[idx]:
+            new_path.append(halves[idx, 1])
+        new_path.append(path_segments[idx+1])
+    return np.asarray(new_path), False
+
+# Takes points x, y in the base space and computes the distance between their mappings on the given manifold
+# Q is a linear transformation on x, y in the base Euclidean space; set to identity if not desired
+# The number of segments increases the resolution of the approximation path, but also heavily increases computation time
+# method selects how the path is refined:
+#   'sample' - random search around each node (see sample_path); samples increases the number of sampled points
+#              at each segment recalculation
+#   'lbfgs'  - deterministic minimization of the discrete path length (see minimize_path_length), stopping at
+#              tolerance tol or after maxiter iterations; always integrates with Gauss-Legendre rules of the given order
+# quadrature selects how segment lengths are integrated (see segment_length); with 'gauss', all samples
+# around a node are scored in one vectorized integrand call
+# With adaptive, segments is ignored: the path starts with 3 nodes and, after each refinement, the segments with
+# the largest estimated error are split (see subdivide_path), until the estimated relative error is within rtol
+# or the path has max_segments nodes, so that close pairs get few nodes and hard pairs get many
+# init_path (nodes x dim), e.g. the path returned for a previous, nearby pair, is used instead of the straight
+# path as the starting point; with return_path, the optimized path is returned along with the distance
+def learn_distance(x, y, Q, integrand, samples=100, segments=7, quadrature='quad', order=16, init_path=None, return_path=False,
+                   method='sample', tol=1e-8, maxiter=200, adaptive=False, rtol=1e-3, max_segments=65):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if init_path is not None:
+        path_segments = shift_path(np.array(init_path, dtype=float), x, y)
+    elif adaptive:
+        path_segments = straight_path(x, y, 3)
+    else:
+        path_segments = straight_path(x, y, segments)
+
+    refine_path(path_segments, Q, integrand, method, samples, quadrature, order, tol, maxiter)
+
+    if adaptive:
+        while len(path_segments) < max_segments:
+            path_segments, converged = subdivide_path(path_segments, Q, integrand, method, samples, quadrature, order,
+                                                      tol, maxiter, rtol, max_segments)
+            if converged:
+                break
+            refine_path(path_segments, Q, integrand, method, samples, quadrature, order, tol, maxiter)
+
+    total_distance = np.sum(path_segment_lengths(path_segments, Q, integrand, quadrature, order))
+
+    if return_path:
+        return total_distance, path_segments
     return total_distance
+
+# Batched version of learn_distance: approximates the distances between the manifold images of the pairs
+# of base space points X[p], Y[p] (both P x dim) at once
+# The paths of all pairs are held in one P x segments x dim array; at each interior node, the candidate
+# perturbations of every unconverged pair are scored in one vectorized integrand call, and each pair is
+# retired as soon as a full sweep leaves its path unchanged
+# Pairs are processed in chunks of batch_size to bound memory; only method='sample' with quadrature='gauss' is
+# batched, otherwise every pair goes through learn_distance
+# init_paths (P x nodes x dim, NaN rows for pairs without one) and return_paths work as in learn_distance
+# With adaptive, every pair goes through learn_distance with its own number of nodes, so paths are neither
+# taken nor returned
+# Output: array of P distances (and the P x nodes x dim optimized paths)
+def learn_distances(X, Y, Q, integrand, samples=100, segments=7, quadrature='gauss', order=16, batch_size=256, init_paths=None, return_paths=False,
+                    method='sample', tol=1e-8, maxiter=200, adaptive=False, rtol=1e-3, max_segments=65):
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    X = X.reshape(len(X), -1)
+    Y = Y.reshape(len(Y), -1)
+
+    if adaptive:
+        if init_paths is not None or return_paths:
+            raise ValueError("Adaptive refinement does not use fixed-size paths")
+        return np.asarray([learn_distance(x, y, Q, integrand, samples, segments, quadrature, order, None, False,
+                                          method, tol, maxiter, adaptive, rtol, max_segments) for x, y in zip(X, Y)])
+
+    if init_paths is not None:
+        paths = shift_path(np.array(init_paths, dtype=float), X, Y)
+    else:
+        paths = straight_path(X, Y, segments)
+
+    distances = np.zeros(len(X))
+    if method != 'sample' or quadrature != 'gauss':
+        for p in range(len(X)):
+            distances[p], paths[p] = learn_distance(X[p], Y[p], Q, integrand, samples, segments, quadrature, order, paths[p], True,
+                                                    method, tol, maxiter)
+    else:
+        for start in range(0, len(X), batch_size):
+            stop = start + batch_size
+            distances[start:stop] = learn_distances_batch(paths[start:stop], Q, integrand, samples, order)
+
+    if return_paths:
+        return distances, paths
+    return distances
+
+# Optimizes the npairs x nodes x dim paths in place and returns their lengths
+def learn_distances_batch(paths, Q, integrand, samples, order):
+    npairs, segments, dim = paths.shape
+
+    active = np.ones(npairs, dtype=bool)
+    while active.any():
+        pidx = np.flatnonzero(active)
+        moved = np.zeros(len(pidx), dtype=bool)
+
+        for i in range(1, segments-1):
+            this_point = paths[pidx, i]
+            prev_point = paths[pidx, i-1]
+            next_point = paths[pidx, i+1]
+
+            sample_radius = np.maximum(np.linalg.norm(this_point - prev_point, axis=-1),
+                                       np.linalg.norm(this_point - next_point, axis=-1))
+
+            s = np.random.uniform(-1, 1, size=(len(pidx), samples, dim)) * sample_radius[:, None, None]
+            # the current point comes first, so it is kept unless a sample is strictly shorter
+            candidates = np.concatenate((this_point[:, None, :], s + this_point[:, None, :]), axis=1)
+
+            Distance = segment_length(integrand, prev_point[:, None, :], candidates, Q, 'gauss', order) + \
+                       segment_length(integrand, candidates, next_point[:, None, :], Q, 'gauss', order)
+            best_sample = candidates[np.arange(len(pidx)), np.argmin(Distance, axis=1)]
+
+            moved |= np.linalg.norm(this_point - best_sample, axis=-1) >= 10e-6
+            paths[pidx, i] = best_sample
+
+        active[pidx] = moved
+
+    return np.sum(segment_length(integrand, paths[:, :-1], paths[:, 1:], Q, 'gauss', order), axis=1)
+
+# Computes approximate distances like learn_distances, with fixed solver settings, and keeps the optimized
+# paths between calls: pairs solved under the same key (e.g. all pairs of a training set while an optimizer
+# adjusts Q) start from their previous geodesic instead of the straight path, and usually converge in one sweep
+# At most max_keys sets of paths are kept (least recently used are dropped first); see learn_distance for the
+# other settings
+# A key only identifies a set by its size, so a kept path is reused only if its end points are within max_shift
+# times the distance between the new end points (as when Q moves a little); other pairs start from the straight path
+class GeodesicSolver:
+    def __init__(self, samples=100, segments=7, quadrature='gauss', order=16, warm_start=True, max_keys=8,
+                 method='sample', tol=1e-8, maxiter=200, adaptive=False, rtol=1e-3, max_segments=65, max_shift=0.25):
+        self.samples = samples
+        self.segments = segments
+        self.quadrature = quadrature
+        self.order = order
+        self.method = method
+        self.tol = tol
+        self.maxiter = maxiter
+        self.adaptive = adaptive
+        self.rtol = rtol
+        self.max_segments = max_segments
+        self.warm_start = warm_start
+        self.max_keys = max_keys
+        self.max_shift = max_shift
+        self.paths = OrderedDict()   # (key, npairs, dim) -> npairs x nodes x dim paths, NaN where never solved
+
+    # Settings that determine the distances computed (used e.g. to key cached distances)
+    def settings(self):
+        return {'samples': self.samples, 'segments': self.segments, 'quadrature': self.quadrature, 'order': self.order,
+                'method': self.method, 'tol': self.tol, 'maxiter': self.maxiter,
+                'adaptive': self.adaptive, 'rtol': self.rtol, 'max_segments': self.max_segments}
+
+    # Input: X, Y (P x dim) pairs of base space points
+    #        key, npairs - identify a set of npairs pairs whose paths are kept; None disables warm starts
+    #        which - indices of the pairs X, Y within that set (default: all of them, in order)
+    # Output: array of P distances
+    def distances(self, X, Y, Q, integrand, key=None, npairs=None, which=None):
+        X = np.asarray(X, dtype=float)
+        Y = np.asarray(Y, dtype=float)
+        X = X.reshape(len(X), -1)
+        Y = Y.reshape(len(Y), -1)
+
+        # adaptive paths have varying numbers of nodes, so they are not kept
+        if key is None or not self.warm_start or self.adaptive:
+            return learn_distances(X, Y, Q, integrand, **self.settings())
+
+        if npairs is None:
+            npairs = len(X)
+        if which is None:
+            which = np.arange(len(X))
+
+        full_key = (key, npairs, X.shape[1])
+        if full_key not in self.paths:
+            self.paths[full_key] = np.full((npairs, self.segments, X.shape[1]), np.nan)
+        self.paths.move_to_end(full_key)
+        while len(self.paths) > self.max_keys:
+            self.paths.popitem(last=False)
+
+        stored = self.paths[full_key]
+        init_paths = stored[which]
+        shift = np.linalg.norm(init_paths[:, 0] - X, axis=-1) + np.linalg.norm(init_paths[:, -1] - Y, axis=-1)
+        init_paths[~(shift <= self.max_shift * np.linalg.norm(Y - X, axis=-1))] = np.nan
+        dist, paths = learn_distances(X, Y, Q, integrand, init_paths=init_paths, return_paths=True, **self.settings())
+        stored[which] = paths
+        return dist
+
+    def clear(self):
+        self.paths.clear()
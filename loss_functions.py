@@ -1,5 +1,6 @@
 import numpy as np
-from manifold_functions import map_dataset_to_mfd
+from neighbor_index import VPTree
+from manifold_functions import map_dataset_to_mfd, pairwise_mfd_dist, weighted_dist_grad, has_dist_grad, paired_dist_grad, paired_mfd_dist, is_exact_metric
 
 # ----------------------------------------------------------------------------------------------------
 #
@@ -7,22 +8,80 @@ from manifold_functions import map_dataset_to_mfd
 #
 # ----------------------------------------------------------------------------------------------------
 
+# State of one MMC fit, passed to every evaluation of its loss: the similarity and dissimilarity pairs of its labels
+# (which do not change between evaluations), so they are built once per fit
+# Fits with separate states do not interfere, so they can run concurrently
+def new_mmc_state():
+    return {}
+
 # Gets all similarity and dissimilarity pairs in a dataset (for MMC loss function)
 # Input: labels of points
-# Output: pairs of indices of similar points
-#         pairs of indices of dissimilar points
-def get_sim_dis_pairs(labels):
-    sim_idxs = []
-    dis_idxs = []
-    for i in range(len(labels)):
-        for j in range(i+1, len(labels)):
-            if labels[i] == labels[j]:
-                sim_idxs.append( [i, j] )
-            else:
-                dis_idxs.append( [i, j] )
+#        max_dis_pairs - if given, at most this many dissimilar pairs are returned: a random subsample with the
+#                        same number of pairs from every pair of classes (as far as they have that many)
+#        seed - seed of the subsample
+#        state - if given, state of the fit (see new_mmc_state) in which the pairs are kept
+# Output: P x 2 int32 array of index pairs (i < j) of similar points
+#         P x 2 int32 array of index pairs (i < j) of dissimilar points
+def get_sim_dis_pairs(labels, max_dis_pairs=None, seed=0, state=None):
+    labels = np.asarray(labels).ravel()
+    signature = (labels.tobytes(), labels.dtype.str, max_dis_pairs, seed)
+    if state is not None and state.get('signature') == signature:
+        return state['sim'], state['dis']
 
+    if max_dis_pairs is None:
+        I, J = np.triu_indices(len(labels), 1)
+        same = labels[I] == labels[J]
+        sim_idxs = np.stack((I[same], J[same]), axis=1).astype(np.int32)
+        dis_idxs = np.stack((I[~same], J[~same]), axis=1).astype(np.int32)
+    else:
+        members = [np.flatnonzero(labels == c) for c in np.unique(labels)]
+        sim_idxs = []
+        for idx in members:
+            I, J = np.triu_indices(len(idx), 1)
+            sim_idxs.append(np.stack((idx[I], idx[J]), axis=1))
+        sim_idxs = np.concatenate(sim_idxs).astype(np.int32)
+        sim_idxs = sim_idxs[np.lexsort((sim_idxs[:, 1], sim_idxs[:, 0]))]
+        dis_idxs = get_balanced_dis_pairs(members, max_dis_pairs, np.random.default_rng(seed))
+
+    if state is not None:
+        state['signature'] = signature
+        state['sim'] = sim_idxs
+        state['dis'] = dis_idxs
     return sim_idxs, dis_idxs
 
+# Input: members - indices of the points of each class, max_pairs, rng
+# Output: up to max_pairs x 2 int32 array of distinct dissimilar pairs (i < j), drawn uniformly within each pair of
+#         classes, with the quota of pairs of classes that have too few pairs spread over the others
+def get_balanced_dis_pairs(members, max_pairs, rng):
+    class_pairs = [(a, b) for a in range(len(members)) for b in range(a + 1, len(members))]
+    available = np.array([len(members[a]) * len(members[b]) for a, b in class_pairs], dtype=np.int64)
+
+    # equal quotas, capped by the pairs available
+    quota = np.zeros(len(class_pairs), dtype=np.int64)
+    left = min(max_pairs, available.sum())
+    while left > 0:
+        open_pairs = np.flatnonzero(quota < available)
+        share = left // len(open_pairs)
+        if share == 0:
+            quota[open_pairs[:left]] += 1
+            break
+        add = np.minimum(share, available[open_pairs] - quota[open_pairs])
+        quota[open_pairs] += add
+        left -= add.sum()
+
+    dis_idxs = []
+    for (a, b), q in zip(class_pairs, quota):
+        if q == 0:
+            continue
+        flat = rng.choice(len(members[a]) * len(members[b]), size=q, replace=False)
+        I, J = members[a][flat // len(members[b])], members[b][flat % len(members[b])]
+        dis_idxs.append(np.stack((np.minimum(I, J), np.maximum(I, J)), axis=1))
+
+    if len(dis_idxs) == 0:
+        return np.zeros((0, 2), dtype=np.int32)
+    dis_idxs = np.concatenate(dis_idxs).astype(np.int32)
+    return dis_idxs[np.lexsort((dis_idxs[:, 1], dis_idxs[:, 0]))]
+
 # MMC Loss Function
 # Inputs:
 #   Q - variable of optimization, the linear transformation affecting the dataset
@@ -33,28 +92,50 @@ def get_sim_dis_pairs(labels):
 #   mfd_integrand - integrand of the arc length integral of the manifold, if explicit distance is unknown
 #   B - dataset of points in base space
 #   labels - labels of points
+#   return_grad - also return the gradient with respect to Q (only for manifolds with has_dist_grad)
+#   max_dis_pairs - estimate the mean over dissimilar pairs on a class-balanced subsample (see get_sim_dis_pairs)
+#   state - state of the fit (see new_mmc_state), updated in place; without it the pairs are built on every call
 # Outputs:
 #   loss - value of loss for given parameters
-def mmc_loss_generic(Q, reg, lmbd, mfd_generic, mfd_dist_generic, mfd_integrand, B, labels):
+#   grad - gradient of loss with respect to Q, flattened (if return_grad)
+def mmc_loss_generic(Q, reg, lmbd, mfd_generic, mfd_dist_generic, mfd_integrand, B, labels, return_grad=False, max_dis_pairs=None, state=None):
     dim = len(B[0])
     Q = Q.reshape(dim, dim)
 
+    if return_grad:
+        return mmc_loss_grad(Q, reg, lmbd, mfd_generic, mfd_dist_generic, B, labels, max_dis_pairs, state)
+
     total = 0
     FQB = map_dataset_to_mfd(B, Q, mfd_generic)
-    sim_idxs, dis_idxs = get_sim_dis_pairs(labels)
-
-    nsim_idxs = len(sim_idxs)
-    ndis_idxs = len(dis_idxs)
+    dist = pairwise_mfd_dist(FQB, None, mfd_dist_generic, mfd_integrand)
+    sim_idxs, dis_idxs = get_sim_dis_pairs(labels, max_dis_pairs, state=state)
 
-    for sim_idx in sim_idxs:
-        total += (1-reg) * mfd_dist_generic(FQB[sim_idx[0]], FQB[sim_idx[1]], mfd_integrand) / nsim_idxs
+    if len(sim_idxs) > 0:
+        total += (1-reg) * dist[sim_idxs[:, 0], sim_idxs[:, 1]].mean()
 
-    for dis_idx in dis_idxs:
-        total -= (reg)   * mfd_dist_generic(FQB[dis_idx[0]], FQB[dis_idx[1]], mfd_integrand) / ndis_idxs
+    if len(dis_idxs) > 0:
+        total -= (reg)   * dist[dis_idxs[:, 0], dis_idxs[:, 1]].mean()
 
     total += lmbd * (np.multiply(Q, Q).sum())
     return total
 
+# MMC loss and its gradient with respect to Q, in closed form through the chart and the distance
+def mmc_loss_grad(Q, reg, lmbd, mfd_generic, mfd_dist_generic, B, labels, max_dis_pairs=None, state=None):
+    sim_idxs, dis_idxs = get_sim_dis_pairs(labels, max_dis_pairs, state=state)
+
+    # the loss is a weighted sum of the pairwise distances
+    W = np.zeros((len(B), len(B)))
+    if len(sim_idxs) > 0:
+        W[sim_idxs[:, 0], sim_idxs[:, 1]] = (1-reg) / len(sim_idxs)
+    if len(dis_idxs) > 0:
+        W[dis_idxs[:, 0], dis_idxs[:, 1]] = -reg / len(dis_idxs)
+
+    total, grad = weighted_dist_grad(Q, B, W, mfd_generic, mfd_dist_generic)
+
+    total += lmbd * (np.multiply(Q, Q).sum())
+    grad += 2 * lmbd * Q
+    return total, grad.ravel()
+
 # ----------------------------------------------------------------------------------------------------
 #
 # LMNN LOSS FUNCTION
@@ -62,12 +143,13 @@ def mmc_loss_generic(Q, reg, lmbd, mfd_generic, mfd_dist_generic, mfd_integrand,
 # ----------------------------------------------------------------------------------------------------
 
 # Returns indices of true neighbors (neighbors with same label) and imposter neighbors (neighbors with different label)
-def get_all_neighbors_of(FQx, label_of_FQx, FQB, labels, radius, k, mfd_dist_generic, mfd_integrand, update=False):
-    dst_from_FQx = []
-    for idx, FQxi in enumerate(FQB):
-        dst_from_FQx.append( mfd_dist_generic(FQx, FQxi, mfd_integrand))
-
-    idx_of_points = np.argsort(np.asarray(dst_from_FQx))
+# idx_of_points (the k+1 or more points of FQB nearest to FQx, nearest first) is found from dst_from_FQx (distances
+# from FQx to every point of FQB) unless passed in; dst_from_FQx is computed here unless passed in
+def get_all_neighbors_of(FQx, label_of_FQx, FQB, labels, radius, k, mfd_dist_generic, mfd_integrand, update=False, dst_from_FQx=None, idx_of_points=None):
+    if idx_of_points is None:
+        if dst_from_FQx is None:
+            dst_from_FQx = pairwise_mfd_dist([FQx], FQB, mfd_dist_generic, mfd_integrand)[0]
+        idx_of_points = np.argsort(np.asarray(dst_from_FQx))
 
     true_neighbors = []
     imposter_neighbors = []
@@ -86,52 +168,221 @@ def get_all_neighbors_of(FQx, label_of_FQx, FQB, labels, radius, k, mfd_dist_gen
 
     return true_neighbors_idx, imposter_neighbors_idx
 
-all_FQx_nbrs = {}
-all_FQx_impos = {}
+# State of one LMNN fit, passed to every evaluation of its loss: the target neighbors and impostors found so far for
+# every point ('nbrs', 'impos': index -> list of indices) and a version counting their updates (code changing them
+# must increment it), the (point, target neighbor) pairs and triplets built from them, and the active set of
+# triplets with the number of loss evaluations since it was refreshed
+# Fits with separate states do not interfere, so they can run concurrently
+def new_lmnn_state():
+    return {'nbrs': {}, 'impos': {}, 'version': 0}
 
-def lmnn_loss_generic(Q, radius, k, reg, lmbd, mfd_generic, mfd_dist_generic, mfd_integrand, B, labels, update=False):
+# Input: number of points, state of the fit
+# Output: n_pairs x 2 array of (point, target neighbor) indices, n_triplets x 3 array of (point, target neighbor, impostor)
+# Rebuilt whenever the version of the target neighbors and impostors differs from the one they were last built from
+def get_lmnn_triplets(npts, state):
+    signature = (npts, state['version'])
+    if state.get('signature') != signature:
+        pairs = []
+        triplets = []
+        for idx in range(npts):
+            nbrs = state['nbrs'].get(idx, [])
+            impos = state['impos'].get(idx, [])
+            pairs.extend([idx, j] for j in nbrs)
+            triplets.extend([idx, j, l] for j in nbrs for l in impos)
+
+        state['signature'] = signature
+        state['pairs'] = np.asarray(pairs, dtype=int).reshape(-1, 2)
+        state['triplets'] = np.asarray(triplets, dtype=int).reshape(-1, 3)
+        state.pop('active', None)
+
+    return state['pairs'], state['triplets']
+
+# Distances under the current Q of the pairs (I[p], J[p]) of points FQB, each distinct pair computed once; taken
+# from dist (the full distance matrix) if given
+def pair_dists(FQB, I, J, mfd_dist_generic, mfd_integrand, dist=None):
+    if dist is not None:
+        return dist[I, J]
+    codes, inverse = np.unique(np.minimum(I, J) * len(FQB) + np.maximum(I, J), return_inverse=True)
+    if len(codes) == 0:
+        return np.zeros(len(I))
+    return paired_mfd_dist(FQB[codes // len(FQB)], FQB[codes % len(FQB)], mfd_dist_generic, mfd_integrand)[inverse.ravel()]
+
+# LMNN Loss Function
+# Inputs (as for MMC, and):
+#   k - number of nearest neighbors considered when updating target neighbors and impostors
+#   update - recompute the nearest neighbors under Q, adding them to the target neighbors / impostors of state; found
+#       with a VPTree for exact metrics, and from the full distance matrix otherwise (see is_exact_metric)
+#   return_grad - also return the gradient with respect to Q (only for manifolds with has_dist_grad)
+#   active_refresh, active_margin - hinge terms are evaluated on an active set of triplets: those within
+#       active_margin of violating the margin when the set was last refreshed, which happens on updates, every
+#       active_refresh evaluations (0 evaluates every triplet every time) and whenever a distance of the active set
+#       has moved by more than active_margin / 2; in between, only the distances of the target neighbor pairs and
+#       the active triplets are computed
+#   state - state of the fit (see new_lmnn_state), updated in place; a fresh one by default
+# Outputs:
+#   loss - value of loss for given parameters
+#   grad - gradient of loss with respect to Q, flattened (if return_grad)
+def lmnn_loss_generic(Q, radius, k, reg, lmbd, mfd_generic, mfd_dist_generic, mfd_integrand, B, labels, update=False,
+                      return_grad=False, active_refresh=10, active_margin=0.5, state=None):
     dim = len(B[0])
     Q = Q.reshape(dim, dim)
-    total = 0
-    tmp_v1 = 0
-    tmp_v2 = 0
+    state = new_lmnn_state() if state is None else state
 
     FQB = map_dataset_to_mfd(B, Q, mfd_generic)
-    for idx, FQx in enumerate(FQB):
-        label_of_FQx = labels[idx]
+    dist = None
 
-        if update:
-            FQy_nbrs_idx, FQz_nbrs_idx = get_all_neighbors_of(FQx, label_of_FQx, FQB, labels, radius, k, mfd_dist_generic, mfd_integrand, update)
+    if update:
+        if is_exact_metric(mfd_dist_generic, mfd_integrand):
+            _, nbrs = VPTree(FQB, mfd_dist_generic, mfd_integrand).query(FQB, k+1)
+        else:
+            dist = pairwise_mfd_dist(FQB, None, mfd_dist_generic, mfd_integrand)
+            nbrs = np.argsort(dist, axis=1)[:, :k+1]
+        for idx, FQx in enumerate(FQB):
+            FQy_nbrs_idx, FQz_nbrs_idx = get_all_neighbors_of(FQx, labels[idx], FQB, labels, radius, k, mfd_dist_generic, mfd_integrand, update, None, nbrs[idx])
             try:
-                all_FQx_nbrs[str(idx)] = list(set(all_FQx_nbrs[str(idx)]).union(set(FQy_nbrs_idx)))
+                state['nbrs'][idx] = list(set(state['nbrs'][idx]).union(set(FQy_nbrs_idx)))
             except KeyError:
-                all_FQx_nbrs[str(idx)] = FQy_nbrs_idx
+                state['nbrs'][idx] = FQy_nbrs_idx
             try:
-                all_FQx_impos[str(idx)] = list(set(all_FQx_impos[str(idx)]).union(set(FQz_nbrs_idx)))
+                state['impos'][idx] = list(set(state['impos'][idx]).union(set(FQz_nbrs_idx)))
             except KeyError:
-                all_FQx_impos[str(idx)] = FQz_nbrs_idx
-        else:
-            FQy_nbrs_idx = []
-            FQz_nbrs_idx = []
-
-        try:
-            tmp_FQx_nbrs = list(set(all_FQx_nbrs[str(idx)]).union(set(FQy_nbrs_idx)))
-        except KeyError:
-            tmp_FQx_nbrs = FQy_nbrs_idx
-        try:
-            tmp_FQx_impos =list(set(all_FQx_impos[str(idx)]).union(set(FQz_nbrs_idx)))
-        except KeyError:
-            tmp_FQx_impos = FQz_nbrs_idx
-
-        for FQy_idx in tmp_FQx_nbrs:
-            total += (1 - reg) * mfd_dist_generic(FQx, FQB[FQy_idx], mfd_integrand)
-            tmp_v1 += mfd_dist_generic(FQx, FQB[FQy_idx], mfd_integrand)
-
-            for FQz_idx in tmp_FQx_impos:
-                if mfd_dist_generic(FQx,FQB[FQz_idx], mfd_integrand) < mfd_dist_generic(FQx,FQB[FQy_idx], mfd_integrand)+1:  # +1 is the margin
-                    total += reg * (1 + mfd_dist_generic(FQx, FQB[FQy_idx], mfd_integrand) - mfd_dist_generic(FQx, FQB[FQz_idx], mfd_integrand))
-                    tmp_v2 += (1 + mfd_dist_generic(FQx, FQB[FQy_idx], mfd_integrand) - mfd_dist_generic(FQx, FQB[FQz_idx], mfd_integrand))
+                state['impos'][idx] = FQz_nbrs_idx
+        state['version'] += 1
+
+    pairs, triplets = get_lmnn_triplets(len(FQB), state)
+
+    # distances of the target neighbor pairs and the active triplets, refreshing the active set first if due
+    # a triplet left out was at least active_margin from violating the margin, so it can only become violated once
+    # distances have moved by about active_margin / 2 since the refresh
+    evals = state.get('evals', 0)
+    refresh = update or 'active' not in state or active_refresh <= 0 or evals >= active_refresh
+    if not refresh:
+        active = state['active']
+        d = pair_dists(FQB, np.concatenate((pairs[:, 0], active[:, 0], active[:, 0])), np.concatenate((pairs[:, 1], active[:, 1], active[:, 2])),
+                       mfd_dist_generic, mfd_integrand)
+        refresh = len(d) > 0 and np.abs(d - state['active_dist']).max() > active_margin / 2
+    if refresh:
+        d = pair_dists(FQB, np.concatenate((pairs[:, 0], triplets[:, 0], triplets[:, 0])), np.concatenate((pairs[:, 1], triplets[:, 1], triplets[:, 2])),
+                       mfd_dist_generic, mfd_integrand, dist)
+        d_pairs, d_near, d_far = np.split(d, [len(pairs), len(pairs) + len(triplets)])
+        keep = 1 + d_near - d_far > -active_margin
+        state['active'] = active = triplets[keep]
+        d = np.concatenate((d_pairs, d_near[keep], d_far[keep]))
+        state['active_dist'] = d
+        evals = 0
+    state['evals'] = evals + 1
+    d_pairs, d_near, d_far = np.split(d, [len(pairs), len(pairs) + len(active)])
+
+    # hinge terms: +1 is the margin
+    hinge = 1 + d_near - d_far
+    violated = active[hinge > 0]
 
+    total = (1 - reg) * np.sum(d_pairs) + reg * np.sum(hinge[hinge > 0])
     total += lmbd * (np.multiply(Q, Q).sum())
 
-    return total
+    if not return_grad:
+        return total
+
+    # the loss is a weighted sum of distances plus the constant margins of the violated triplets
+    I = np.concatenate((pairs[:, 0], violated[:, 0], violated[:, 0]))
+    J = np.concatenate((pairs[:, 1], violated[:, 1], violated[:, 2]))
+    w = np.concatenate((np.full(len(pairs), 1 - reg), np.full(len(violated), reg), np.full(len(violated), -reg)))
+    _, grad = paired_dist_grad(Q, np.asarray(B, dtype=float)[I], np.asarray(B, dtype=float)[J], w, mfd_generic, mfd_dist_generic)
+    grad += 2 * lmbd * Q
+    return total, grad.ravel()
+
+# ----------------------------------------------------------------------------------------------------
+#
+# MINIBATCH LOSS FUNCTIONS
+#
+# ----------------------------------------------------------------------------------------------------
+
+# Distances of pairs (i, j) of points of B under Q, and the gradient of sum_p w_p d_p with respect to Q
+# Output: distances, gradient (None unless return_grad)
+def minibatch_dists(Q, B, I, J, w, mfd_generic, mfd_dist_generic, mfd_integrand, return_grad=False):
+    B = np.asarray(B, dtype=float)
+    if has_dist_grad(mfd_generic, mfd_dist_generic):
+        dist, grad = paired_dist_grad(Q, B[I], B[J], np.zeros(len(I)) if w is None else w, mfd_generic, mfd_dist_generic)
+        return dist, grad if return_grad else None
+
+    dist = paired_mfd_dist(map_dataset_to_mfd(B[I], Q, mfd_generic), map_dataset_to_mfd(B[J], Q, mfd_generic), mfd_dist_generic, mfd_integrand)
+    return dist, None
+
+# Minibatch MMC Loss Function
+# The means over all similar and all dissimilar pairs in the MMC loss are estimated on the pairs given
+# Inputs (as for MMC, and):
+#   sim_idxs, dis_idxs - P x 2 arrays of indices of similar and dissimilar pairs of points of B
+# Outputs:
+#   loss - value of loss for given parameters
+#   grad - gradient of loss with respect to Q, flattened (if return_grad)
+def mmc_minibatch_loss(Q, reg, lmbd, mfd_generic, mfd_dist_generic, mfd_integrand, B, sim_idxs, dis_idxs, return_grad=False):
+    dim = len(B[0])
+    Q = Q.reshape(dim, dim)
+
+    I = np.concatenate((sim_idxs[:, 0], dis_idxs[:, 0]))
+    J = np.concatenate((sim_idxs[:, 1], dis_idxs[:, 1]))
+    w = np.concatenate((np.full(len(sim_idxs), (1-reg) / max(len(sim_idxs), 1)), np.full(len(dis_idxs), -reg / max(len(dis_idxs), 1))))
+
+    dist, grad = minibatch_dists(Q, B, I, J, w, mfd_generic, mfd_dist_generic, mfd_integrand, return_grad)
+    total = np.sum(w * dist) + lmbd * (np.multiply(Q, Q).sum())
+
+    if not return_grad:
+        return total
+    grad += 2 * lmbd * Q
+    return total, grad.ravel()
+
+# Minibatch LMNN Loss Function
+# Averages, rather than sums, the target neighbor distances and the hinge terms over the triplets given
+# Inputs (as for LMNN, and):
+#   triplets - T x 3 array of (point, target neighbor, impostor) indices of points of B
+# Outputs:
+#   loss - value of loss for given parameters
+#   grad - gradient of loss with respect to Q, flattened (if return_grad)
+def lmnn_minibatch_loss(Q, reg, lmbd, mfd_generic, mfd_dist_generic, mfd_integrand, B, triplets, return_grad=False):
+    dim = len(B[0])
+    Q = Q.reshape(dim, dim)
+    T = max(len(triplets), 1)
+
+    # distances are needed before the weights of the gradient are known (they depend on the violated triplets)
+    dist, _ = minibatch_dists(Q, B, np.concatenate((triplets[:, 0], triplets[:, 0])), np.concatenate((triplets[:, 1], triplets[:, 2])),
+                              None, mfd_generic, mfd_dist_generic, mfd_integrand, False)
+    d_ij, d_il = dist[:len(triplets)], dist[len(triplets):]
+
+    # hinge terms: +1 is the margin
+    hinge = 1 + d_ij - d_il
+    violated = hinge > 0
+
+    total = (1-reg) * np.sum(d_ij) / T + reg * np.sum(hinge[violated]) / T
+    total += lmbd * (np.multiply(Q, Q).sum())
+
+    if not return_grad:
+        return total
+
+    w = np.concatenate(((1-reg) / T + reg * violated / T, -reg * violated / T))
+    _, grad = minibatch_dists(Q, B, np.concatenate((triplets[:, 0], triplets[:, 0])), np.concatenate((triplets[:, 1], triplets[:, 2])),
+                              w, mfd_generic, mfd_dist_generic, mfd_integrand, True)
+    grad += 2 * lmbd * Q
+    return total, grad.ravel()
+
+# Target neighbors for minibatch LMNN: the k nearest points with the same label, under Q
+# Found with a VPTree over the points of each label for exact metrics, and by brute force otherwise (see
+# is_exact_metric)
+# Output: n_pairs x 2 array of (point, target neighbor) indices
+def get_target_neighbors(B, Q, labels, k, mfd_generic, mfd_dist_generic, mfd_integrand):
+    FQB = map_dataset_to_mfd(B, Q, mfd_generic)
+    labels = np.asarray(labels).ravel()
+    pairs = []
+
+    for c in np.unique(labels):
+        members = np.flatnonzero(labels == c)
+        if is_exact_metric(mfd_dist_generic, mfd_integrand):
+            _, nbrs = VPTree(FQB[members], mfd_dist_generic, mfd_integrand).query(FQB[members], k+1)
+        else:
+            nbrs = np.argsort(pairwise_mfd_dist(FQB[members], None, mfd_dist_generic, mfd_integrand), axis=1)[:, :k+1]
+
+        # each point is its own nearest neighbor, unless it has duplicates
+        for row, nbr in zip(members, nbrs):
+            nbr = members[nbr[nbr >= 0]]
+            pairs.extend([row, j] for j in nbr[nbr != row][:k])
+
+    return np.asarray(pairs, dtype=int).reshape(-1, 2)
@@ -5,178 +5,282 @@
 # ----------------------------------------------------------------------------------------------------
 
 import numpy as np
-from learn_manifold_distance import learn_distance
-from scipy.optimize import minimize
+from collections import Counter
+from learn_manifold_distance import GeodesicSolver, linear_path, stack_jacobian, velocity_norm
+from geodesic_cache import GeodesicCache
+
+# Solver used by the approximate geodesic distances below; its settings can be changed, e.g. set its
+# quadrature to 'quad' to use scipy's adaptive quadrature as an accuracy reference (see learn_manifold_distance.py)
+geodesic_solver = GeodesicSolver(samples=100, segments=7, quadrature='gauss', order=16)
+
+# Memoizes the approximate geodesic distances (see geodesic_cache.py); None disables caching
+geodesic_cache = GeodesicCache()
+
+# Number of pairs whose distance was computed by each method of cached_learn_distances: 'exact' (a formula from
+# exact_dist_of), 'cache' (found in geodesic_cache) or 'solver' (geodesic_solver)
+dist_method_counts = Counter()
+
+# Method cached_learn_distances uses for the metric of integrand: 'exact' or 'solver' (possibly through the cache)
+def dist_method(integrand):
+    return 'exact' if integrand in exact_dist_of else 'solver'
+
+# Geodesic distances between the manifold images of base space points BX[p] and BY[p]
+# Uses the exact formula for integrand if there is one in exact_dist_of; otherwise approximates them with
+# geodesic_solver, solved in one batch for the pairs not found in geodesic_cache
+# key identifies the set of pairs for warm starting their paths (see GeodesicSolver)
+def cached_learn_distances(BX, BY, integrand, key=None):
+    BX = np.asarray(BX, dtype=float)
+    BY = np.asarray(BY, dtype=float)
+    BX = BX.reshape(len(BX), -1)
+    BY = BY.reshape(len(BY), -1)
+    I = np.eye(BX.shape[1])
+
+    if integrand in exact_dist_of:
+        dist_method_counts['exact'] += len(BX)
+        return exact_dist_of[integrand](BX, BY)
+
+    if geodesic_cache is None:
+        dist_method_counts['solver'] += len(BX)
+        return geodesic_solver.distances(BX, BY, I, integrand, key)
+
+    settings = geodesic_solver.settings()
+    dist, found, keys = geodesic_cache.lookup(BX, BY, integrand, settings)
+    missing = np.flatnonzero(~found)
+    dist_method_counts['cache'] += len(BX) - len(missing)
+    dist_method_counts['solver'] += len(missing)
+    if len(missing) > 0:
+        dist[missing] = geodesic_solver.distances(BX[missing], BY[missing], I, integrand, key, len(BX), missing)
+        geodesic_cache.store(keys[missing], dist[missing], integrand, settings)
+    return dist
+
 
+# Charts take a single point (d,) or a batch of points (n x d) in the base space and return
+# the corresponding point (D,) or (n x D) contiguous float array on the manifold
+# Inverse charts do the reverse, recovering base space coordinates (as far as the chart allows)
+def stack_chart(coords):
+    return np.ascontiguousarray(np.stack(coords, axis=-1), dtype=float)
+
+# Points on a manifold (n x D) carrying their base space coordinates as recovered by inverse_chart (n x k),
+# computed once by map_dataset_to_mfd so that distance functions need not invert the chart again
+# Indexing rows (X[i], X[rows], X[mask]) keeps the matching base space coordinates; other results are plain arrays
+# The points and their base space coordinates are read-only, so that the coordinates cannot go stale; copy the
+# points (np.array(X)) to modify them
+class MfdPoints(np.ndarray):
+    def __new__(cls, points, inverse_chart):
+        obj = np.asarray(points, dtype=float).view(cls)
+        obj.inverse_chart = inverse_chart
+        obj.base_coords = inverse_chart(np.asarray(obj))
+        obj.setflags(write=False)
+        obj.base_coords.setflags(write=False)
+        return obj
+
+    def __array_finalize__(self, obj):
+        self.inverse_chart = None
+        self.base_coords = None
+
+    def __getitem__(self, idx):
+        out = super().__getitem__(idx)
+        if not isinstance(out, MfdPoints):
+            return out
+        if self.base_coords is not None and not isinstance(idx, tuple) and self.ndim == 2:
+            out.inverse_chart = self.inverse_chart
+            out.base_coords = self.base_coords[idx]
+            out.setflags(write=False)
+            out.base_coords.setflags(write=False)
+            return out
+        return out.view(np.ndarray)
+
+    def __array_wrap__(self, arr, context=None, return_scalar=False):
+        arr = np.asarray(arr)
+        return arr[()] if return_scalar else arr
+
+    def __reduce__(self):
+        return (np.asarray, (np.asarray(self),))
+
+# Input: X (n x D) or (D) points on a manifold, inverse_chart of the manifold
+# Output: base space coordinates of X, cached on X if it came from map_dataset_to_mfd
+def base_coords_of(X, inverse_chart):
+    if getattr(X, 'inverse_chart', None) is inverse_chart and X.base_coords is not None:
+        return X.base_coords
+    return inverse_chart(np.asarray(X, dtype=float))
+
+# Base space coordinates with the first one folded to be non-negative, as the approximate geodesic distances take them
+def fold_base_coords(B):
+    return np.concatenate((np.abs(B[..., :1]), B[..., 1:]), axis=-1)
 
 # FUNCTIONS FOR KLEIN BOTTLE:
 def klein_mfd(x):
-    u = x[0]
-    v = x[1]
+    x = np.asarray(x, dtype=float)
+    u = x[..., 0]
+    v = x[..., 1]
     mp = [np.cos(u) * (np.cos(0.5 * u) * (np.sqrt(2) + np.cos(v)) + np.sin(0.5 * u) * np.sin(v) * np.cos(v)), \
           np.sin(u) * (np.cos(0.5 * u) * (np.sqrt(2) + np.cos(v)) + np.sin(0.5 * u) * np.sin(v) * np.cos(v)), \
           -np.sin(0.5 * u) * (np.sqrt(2) + np.cos(v)) + np.cos(0.5 * u) * np.sin(v) * np.cos(v)]
-    return mp
+    return stack_chart(mp)
 
 def integrand_klein(t, x, y, Q):
-    Pth = (1 - t) * x + (y * t)
-    Dff = y-x   # 2 x 1
-    u = Pth[0]
-    v = Pth[1]
+    Pth, Dff = linear_path(t, x, y)
+    u = Pth[..., 0]
+    v = Pth[..., 1]
 
     a = np.cos(0.5 * u) * (np.sqrt(2) + np.cos(v)) + np.sin(0.5 * u) * np.sin(v) * np.cos(v)
     da_du = -0.5 * np.sin(0.5 * u) * (np.sqrt(2) + np.cos(v)) + 0.5 * np.cos(0.5 * u) * np.sin(v) * np.cos(v)
     da_dv = -np.sin(v) * np.cos(0.5 * u) + np.sin(0.5 * u) * (np.cos(2 * v))
 
-    D = [ [np.cos(u) * da_du - a * np.sin(u), np.cos(u) * da_dv], \
+    D = stack_jacobian([ [np.cos(u) * da_du - a * np.sin(u), np.cos(u) * da_dv], \
           [np.sin(u) * da_du + a * np.cos(u), np.sin(u) * da_dv], \
           [-0.5 * np.cos(0.5 * u) * (np.sqrt(2) + np.cos(v)) - 0.5 * np.sin(0.5 * u) * np.sin(v) * np.cos(v), \
-                            np.sin(v) * np.sin(0.5 * u) + np.cos(0.5 * u) (np.cos(2 * v))]]
+                            np.sin(v) * np.sin(0.5 * u) + np.cos(0.5 * u) * (np.cos(2 * v))]])
 
-    v = np.matmul(D, np.matmul(Q, Dff))
-    return np.linalg.norm(v)
+    return velocity_norm(D, Q, Dff)
 
 def klein_obj(v, u, z):
-    return (-np.sin(0.5 * u) * (np.sqrt(2) + np.cos(v)) + 0.5 * np.cos(0.5 * 2) * np.sin(2 * v) - z)**2
+    return (-np.sin(0.5 * u) * (np.sqrt(2) + np.cos(v)) + 0.5 * np.cos(0.5 * u) * np.sin(2 * v) - z)**2
+
+# Input: x (n x 3) or (3) points on the Klein bottle
+# Output: base space coordinates (u, v): u = arctan(x_1 / x_0), and v in [0, 2 pi) fitting both the height x_2
+#         (klein_obj) and the distance from the axis |(x_0, x_1)|, which tells apart the roots of klein_obj
+# v is found for all points at once: Gauss-Newton steps from a grid of starting values, keeping the best fit (the
+# fit has several local minima in v, so the best grid value alone can end in the wrong one)
+def klein_inverse_chart(x, grid=32, iters=20):
+    x = np.asarray(x, dtype=float)
+    u = np.arctan(x[..., 1] / x[..., 0])
+    rho_sq = x[..., 0]**2 + x[..., 1]**2
+    z = x[..., 2]
+
+    cu = np.cos(0.5 * u)[..., None]
+    su = np.sin(0.5 * u)[..., None]
+
+    def residuals(v):
+        a = cu * (np.sqrt(2) + np.cos(v)) + su * np.sin(v) * np.cos(v)
+        r_z = -su * (np.sqrt(2) + np.cos(v)) + 0.5 * cu * np.sin(2 * v) - z[..., None]
+        r_rho = a**2 - rho_sq[..., None]
+        return r_z, r_rho, a
+
+    v = np.broadcast_to(np.linspace(0, 2 * np.pi, grid, endpoint=False), u.shape + (grid,))
+    for _ in range(iters):
+        r_z, r_rho, a = residuals(v)
+        dz = su * np.sin(v) + cu * np.cos(2 * v)
+        drho = 2 * a * (-cu * np.sin(v) + su * np.cos(2 * v))
+        step = (dz * r_z + drho * r_rho) / np.maximum(dz**2 + drho**2, 1e-12)
+        v = v - np.clip(step, -0.5, 0.5)
+        if np.max(np.abs(step)) < 1e-12:
+            break
+
+    r_z, r_rho, _ = residuals(v)
+    v = np.take_along_axis(v, np.argmin(r_z**2 + r_rho**2, axis=-1)[..., None], axis=-1)[..., 0]
+    return stack_chart([u, np.mod(v, 2 * np.pi)])
 
 def klein_mfd_dist(x, y, integrand=integrand_klein):
-    xu = np.arctan(x[1]/x[0])
-    xv0 = 2
-    min_coord = minimize(klein_obj, xv0, args=(xu, x[2]), method='Powell', options={'disp': True})
-    xv = min_coord.x
-
-    yu = np.arctan(y[1]/y[0])
-    yv0 = 2
-    min_coord = minimize(klein_obj, yv0, args=(yu, y[2]), method='Powell', options={'disp': True})
-    yv = min_coord.x
-
-    bx = np.asarray([np.abs(xu), xv])
-    by = np.asarray([np.abs(yu), yv])
-    I = np.identity(2)
-    dist = learn_distance(bx, by, I, integrand)
+    bx = fold_base_coords(base_coords_of(x, klein_inverse_chart))
+    by = fold_base_coords(base_coords_of(y, klein_inverse_chart))
+    dist = cached_learn_distances([bx], [by], integrand)[0]
     return dist
 
 
 # FUNCTIONS FOR SWISSROLL MANIFOLD:
 def swiss_mfd(x):
-    r = x[0]
-    s = x[1]
+    x = np.asarray(x, dtype=float)
+    r = x[..., 0]
+    s = x[..., 1]
     mp = [r * np.cos(r), s, r * np.sin(r)]
-    return mp
+    return stack_chart(mp)
 
 def integrand_swiss(t, x, y, Q):
-    Pth = (1 - t) * x + (y * t)
-    Dff = y-x   # 2 x 1
+    Pth, Dff = linear_path(t, x, y)
 
-    r = Pth[0]
-    s = Pth[1]
-    D = np.asarray([[np.cos(r) - r * np.sin(r), 0],
+    r = Pth[..., 0]
+    s = Pth[..., 1]
+    D = stack_jacobian([[np.cos(r) - r * np.sin(r), 0],
         [0, 1],
-        [np.sin(r) + r * np.cos(r), 0]]).astype(float)
-    v = np.matmul(D, np.matmul(Q, Dff))
-    return np.linalg.norm(v)
-
-def swiss_mfd_base_dist(x, y, integrand):
-    xr = np.arctan(x[2] / x[0])
-    xs = x[1]
+        [np.sin(r) + r * np.cos(r), 0]])
+    return velocity_norm(D, Q, Dff)
 
-    yr = np.arctan(y[2] / y[0])
-    ys = y[1]
+def swiss_inverse_chart(x):
+    return stack_chart([np.arctan(x[..., 2] / x[..., 0]), x[..., 1]])
 
-    bx = np.asarray([xr, xs])
-    by = np.asarray([yr, ys])
+def swiss_mfd_base_dist(x, y, integrand):
+    bx = base_coords_of(x, swiss_inverse_chart)
+    by = base_coords_of(y, swiss_inverse_chart)
 
     return np.linalg.norm(bx - by)
 
 def swiss_mfd_dist(x, y, integrand=integrand_swiss):
-    xr = np.arctan(x[2] / x[0])
-    xs = x[1]
-
-    yr = np.arctan(y[2] / y[0])
-    ys = y[1]
-
-    bx = np.asarray([np.abs(xr), xs])
-    by = np.asarray([np.abs(yr), ys])
-    dist = learn_distance(bx, by, np.eye(2), integrand)
+    bx = fold_base_coords(base_coords_of(x, swiss_inverse_chart))
+    by = fold_base_coords(base_coords_of(y, swiss_inverse_chart))
+    dist = cached_learn_distances([bx], [by], integrand)[0]
     return dist
 
 # FUNCTIONS FOR TORUS MANIFOLD
 # Outer radius 4, inner radius 1
 
 def torus_mfd(x):
-    r = x[0]
-    s = x[1]
+    x = np.asarray(x, dtype=float)
+    r = x[..., 0]
+    s = x[..., 1]
     mp = [4 + np.cos(r) * np.cos(s), 4 + np.cos(r) * np.sin(s), np.sin(r)]
-    return mp
+    return stack_chart(mp)
 
 def integrand_torus(t, x, y, Q):
-    Pth = (1 - t) * x + (y * t)
-    Dff = y-x   # 2 x 1
+    Pth, Dff = linear_path(t, x, y)
 
-    r = Pth[0]
-    s = Pth[1]
-    D = np.asarray([[-np.sin(r) * np.cos(s), -np.sin(s) * np.cos(r)],
+    r = Pth[..., 0]
+    s = Pth[..., 1]
+    D = stack_jacobian([[-np.sin(r) * np.cos(s), -np.sin(s) * np.cos(r)],
         [-np.sin(r) * np.sin(s), np.cos(r) * np.cos(s)],
         [np.cos(r), 0]])
-    v = np.matmul(D, np.matmul(Q, Dff))
-    return np.linalg.norm(v)
-
-def torus_mfd_base_dist(x, y, integrand):
-    xr = np.arcsin(x[2])
-    xs = np.arctan( (x[1] - 4) / (x[0] - 4))
+    return velocity_norm(D, Q, Dff)
 
-    yr = np.arcsin(y[2])
-    ys = np.arctan( (y[1] - 4) / (y[0] - 4))
+def torus_inverse_chart(x):
+    return stack_chart([np.arcsin(x[..., 2]), np.arctan((x[..., 1] - 4) / (x[..., 0] - 4))])
 
-    bx = np.asarray([xr, xs])
-    by = np.asarray([yr, ys])
+def torus_mfd_base_dist(x, y, integrand):
+    bx = base_coords_of(x, torus_inverse_chart)
+    by = base_coords_of(y, torus_inverse_chart)
 
     return np.linalg.norm(bx - by)
 
 def torus_mfd_dist(x, y, integrand=integrand_torus):
-    xr = np.arcsin(x[2])
-    xs = np.arctan( (x[1] - 4) / (x[0] - 4))
-
-    yr = np.arcsin(y[2])
-    ys = np.arctan( (y[1] - 4) / (y[0] - 4))
+    bx = fold_base_coords(base_coords_of(x, torus_inverse_chart))
+    by = fold_base_coords(base_coords_of(y, torus_inverse_chart))
 
-    bx = np.asarray([np.abs(xr), xs])
-    by = np.asarray([np.abs(yr), ys])
-
-    dist = learn_distance(bx, by, np.eye(2), integrand)
+    dist = cached_learn_distances([bx], [by], integrand)[0]
     return dist
 
 # FUNCTIONS FOR TREFOIL MANIFOLD
 
+# The trefoil is a curve, applied to every base space coordinate: a point with d coordinates maps to the 3 x d
+# array of the curve's coordinates (row j holding coordinate j of the curve at each of them), flattened to 3d
 def trefoil_mfd(x):
-    return [np.cos(x) + 2 * np.cos(2 * x), np.sin(x) - 2 * np.sin(2 * x), 2 * np.sin(3*x)]
+    x = np.asarray(x, dtype=float)
+    mp = np.stack([np.cos(x) + 2 * np.cos(2 * x), np.sin(x) - 2 * np.sin(2 * x), 2 * np.sin(3*x)], axis=-2)
+    return np.ascontiguousarray(mp.reshape(mp.shape[:-2] + (-1,)))
+
+def trefoil_inverse_chart(x):
+    x = np.asarray(x, dtype=float)
+    return np.arcsin(x.reshape(x.shape[:-1] + (3, -1))[..., 2, :] / 2) / 3
 
 def trefoil_mfd_base_dist(x, y, integrand):
-    xt = np.arcsin(x[2] / 2) / 3
-    yt = np.arcsin(y[2] / 2) / 3
+    xt = base_coords_of(x, trefoil_inverse_chart)
+    yt = base_coords_of(y, trefoil_inverse_chart)
 
     return np.linalg.norm(xt - yt)
 
 def integrand_trefoil(t, x, y, Q):
-    Pth = (1 - t) * x + (y * t)
-    Dff = y-x   # 1 x 1
+    Pth, Dff = linear_path(t, x, y)
 
-    r = Pth[0]
-    D = np.asarray([[-np.sin(r) - 4 * np.sin(2 * r)],
-        [np.cos(r) - 4 * np.sin(2 * r)],
+    r = Pth[..., 0]
+    D = stack_jacobian([[-np.sin(r) - 4 * np.sin(2 * r)],
+        [np.cos(r) - 4 * np.cos(2 * r)],
         [6 * np.cos(3 * r)]])
 
-    v = np.matmul(D, np.matmul(Q, Dff))
-    return np.linalg.norm(v)
+    return velocity_norm(D, Q, Dff)
 
 def trefoil_mfd_dist(x, y, integrand=integrand_trefoil):
-    xt = np.arcsin(x[2] / 2) / 3
-    yt = np.arcsin(y[2] / 2) / 3
-
-    bx = np.asarray([np.abs(xt)])
-    by = np.asarray([np.abs(yt)])
+    bx = fold_base_coords(base_coords_of(x, trefoil_inverse_chart))
+    by = fold_base_coords(base_coords_of(y, trefoil_inverse_chart))
 
-    dist = learn_distance(bx, by, np.eye(1), integrand)
+    dist = cached_learn_distances([bx], [by], integrand)[0]
     return dist
 
 # FUNCTIONS FOR HELICOID MANIFOLD:
@@ -184,38 +288,34 @@ def trefoil_mfd_dist(x, y, integrand=integrand_trefoil):
 # Input: base space coordinates
 # Output: helicoid coordinates
 def helicoid_mfd(x):
-    r = x[0]
-    t = x[1]
+    x = np.asarray(x, dtype=float)
+    r = x[..., 0]
+    t = x[..., 1]
     mp = [r*np.cos(t), r*np.sin(t), t]
-    return mp   # helicoid map
+    return stack_chart(mp)   # helicoid map
 
 # Arc length integrand for the helicoid; used in computing distance between points on the helicoid
 def integrand_helicoid(t, x, y, Q):
-    Pth = (1 - t) * x + (y * t)
-    Dff = y-x   # 2 x 1
+    Pth, Dff = linear_path(t, x, y)
 
-    r = Pth[0]
-    s = Pth[1]
-    D = [[np.cos(s), -r * np.sin(s)],
+    r = Pth[..., 0]
+    s = Pth[..., 1]
+    D = stack_jacobian([[np.cos(s), -r * np.sin(s)],
         [np.sin(s), r * np.cos(s)],
-        [0, 1]]
+        [0, 1]])
 
-    v = np.matmul(D, np.matmul(Q, Dff))
-    return np.linalg.norm(v)
+    return velocity_norm(D, Q, Dff)
+
+def helicoid_inverse_chart(x):
+    return stack_chart([x[..., 0] / np.cos(x[..., 2]), x[..., 2]])
 
 # Input: x,y points on helicoid
 # Output: apprxoimate distance between x,y
 def helicoid_mfd_dist(x, y, integrand=integrand_helicoid):
-    xr = x[0] / np.cos(x[2])
-    xs = x[2]
-
-    yr = y[0]/np.cos(y[2])
-    ys = y[2]
-
-    bx = np.asarray([np.abs(xr), xs])
-    by = np.asarray([np.abs(yr), ys])
+    bx = fold_base_coords(base_coords_of(x, helicoid_inverse_chart))
+    by = fold_base_coords(base_coords_of(y, helicoid_inverse_chart))
 
-    dist = learn_distance(bx, by, np.eye(2), integrand)
+    dist = cached_learn_distances([bx], [by], integrand)[0]
     return dist
 
 # FUNCTIONS FOR HYPERBOLOID:
@@ -223,8 +323,9 @@ def helicoid_mfd_dist(x, y, integrand=integrand_helicoid):
 # Input: base space coordinates
 # Output: hyperboloid coordinates
 def hyp_mfd(x):
-    x0 = np.sqrt(1 + np.sum(np.power(x, 2)))
-    x = np.concatenate(([x0], x))
+    x = np.asarray(x, dtype=float)
+    x0 = np.sqrt(1 + np.sum(np.power(x, 2), axis=-1, keepdims=True))
+    x = np.concatenate((x0, x), axis=-1)
     return x   # hyperbolic map
 
 # Input: x,y points on hyperboloid
@@ -238,24 +339,427 @@ def hyp_mfd_dist(x,y, integrand):
     xGy = np.matmul(xtail.T,ytail) - x0*y0
     return np.arccosh(-xGy)
 
+# Input: X (n x D), Y (n x D) or (D) points or tangent vectors in hyperboloid coordinates
+# Output: n Minkowski inner products <X_i, Y_i> = -X_i0 Y_i0 + sum_j X_ij Y_ij
+def hyp_mfd_inner(X, Y):
+    return np.sum(X[..., 1:] * Y[..., 1:], axis=-1) - X[..., 0] * Y[..., 0]
+
+# Input: mu (D) point on hyperboloid, X (n x D) points on hyperboloid
+# Output: n x D tangent vectors at mu pointing to the X, with Minkowski norm equal to their distance from mu
+def hyp_mfd_log(mu, X):
+    c = np.maximum(-hyp_mfd_inner(X, mu), 1.0)
+    dist = np.arccosh(c)
+    scale = np.ones_like(dist)
+    nonzero = dist > 1e-12
+    scale[nonzero] = dist[nonzero] / np.sinh(dist[nonzero])
+    return scale[:, None] * (X - c[:, None] * mu)
+
+# Input: mu (D) point on hyperboloid, v (D) tangent vector at mu
+# Output: the point reached from mu along the geodesic with initial velocity v after unit time
+def hyp_mfd_exp(mu, v):
+    norm = np.sqrt(max(hyp_mfd_inner(v, v), 0.0))
+    x = np.cosh(norm) * mu + (np.sinh(norm) / norm if norm > 1e-12 else 1.0) * v
+    return x / np.sqrt(-hyp_mfd_inner(x, x))   # back onto the hyperboloid, against rounding
+
+# Input: X (n x D) points on hyperboloid
+# Output: their Frechet (Karcher) mean, by iters gradient steps from the Lorentzian centroid (the normalized sum)
+def hyp_mfd_frechet_mean(X, iters=5, tol=1e-10):
+    X = np.asarray(X, dtype=float)
+    s = np.sum(X, axis=0)
+    mu = s / np.sqrt(-hyp_mfd_inner(s, s))
+    for _ in range(iters):
+        v = np.mean(hyp_mfd_log(mu, X), axis=0)
+        mu = hyp_mfd_exp(mu, v)
+        if hyp_mfd_inner(v, v) < tol**2:
+            break
+    return mu
+
 # FUNCTIONS FOR EUCLIDEAN SPACE:
 
 # Base space is equal to manifold, thus identity function
 def euclid_mfd(x):
-    return x   # identity map
+    return np.ascontiguousarray(x, dtype=float)   # identity map
 
 # Euclidean distance
 def euclid_mfd_dist(x,y, integrand):
     return np.linalg.norm(x-y)
 
+# ----------------------------------------------------------------------------------------------------
+#
+# EXACT GEODESIC DISTANCES
+#
+# ----------------------------------------------------------------------------------------------------
+
+# The swiss roll is developable: with the arc length A(r) of the spiral (r cos r, r sin r) as first coordinate it
+# unrolls isometrically onto a plane, where geodesics are straight lines
+def swiss_arc_length(r):
+    return 0.5 * (r * np.sqrt(1 + r**2) + np.arcsinh(r))
+
+# Input: BX, BY (P x 2) pairs of swiss roll base space coordinates
+# Output: the P geodesic distances, exactly
+def swiss_exact_dist(BX, BY):
+    dA = swiss_arc_length(BX[:, 0]) - swiss_arc_length(BY[:, 0])
+    return np.hypot(dA, BX[:, 1] - BY[:, 1])
+
+# Input: integrand - arc length integrand of a closed curve with parameter period, npts - table size
+# Output: parameter values t (npts) evenly spaced over one period and the arc length S(t) from 0 to each of them
+#         (trapezoidal rule), from which arc_length interpolates
+def arc_length_table(integrand, period, npts=2**16):
+    t = np.linspace(0, period, npts)
+    speed = integrand(0.0, t[:, None], t[:, None] + 1, np.eye(1))
+    S = np.concatenate(([0.0], np.cumsum(0.5 * (speed[1:] + speed[:-1]) * np.diff(t))))
+    return t, S
+
+# Arc length from 0 to t along a curve with arc length table (t, S), for any t (whole periods add S[-1] each)
+def arc_length(table, t):
+    tt, S = table
+    periods = np.floor(t / tt[-1])
+    return periods * S[-1] + np.interp(t - periods * tt[-1], tt, S)
+
+# The trefoil is a closed curve: the geodesic distance between two of its points is the shorter of the two arcs
+# between them, min(|S(a) - S(b)|, L - |S(a) - S(b)|) for its length L; a point with several base space coordinates
+# lies on a product of trefoils, which is flat in the arc length of each
+trefoil_arc_length_table = arc_length_table(integrand_trefoil, 2 * np.pi)
+
+# Input: BX, BY (P x d) pairs of trefoil base space coordinates
+# Output: the P geodesic distances, from the arc length table
+def trefoil_exact_dist(BX, BY):
+    length = trefoil_arc_length_table[1][-1]
+    dS = np.mod(arc_length(trefoil_arc_length_table, BX) - arc_length(trefoil_arc_length_table, BY), length)
+    return np.linalg.norm(np.minimum(dS, length - dS), axis=-1)
+
+# Exact distances for the metrics of arc length integrands, used by cached_learn_distances in place of the
+# geodesic solver
+exact_dist_of = {
+    integrand_swiss: swiss_exact_dist,
+    integrand_trefoil: trefoil_exact_dist,
+}
+
+# ----------------------------------------------------------------------------------------------------
+#
+# ALL-PAIRS DISTANCE MATRICES
+#
+# ----------------------------------------------------------------------------------------------------
+
+# Input: X (n x D) and Y (m x D) points on hyperboloid; Y defaults to X
+# Output: n x m matrix of hyperbolic distances, from one Minkowski Gram matrix
+def hyp_mfd_pairwise_dist(X, Y=None, integrand=None):
+    X = np.asarray(X, dtype=float)
+    symmetric = Y is None
+    Y = X if symmetric else np.asarray(Y, dtype=float)
+
+    xGy = np.matmul(X[:, 1:], Y[:, 1:].T) - np.outer(X[:, 0], Y[:, 0])
+    # rounding can push -xGy slightly below 1 for (nearly) identical points
+    dist = np.arccosh(np.maximum(-xGy, 1.0))
+    if symmetric:
+        np.fill_diagonal(dist, 0.0)
+    return dist
+
+# Input: X (n x D) and Y (m x D) points in Euclidean space; Y defaults to X
+# Output: n x m matrix of Euclidean distances, using |x|^2 + |y|^2 - 2<x,y>
+def euclid_mfd_pairwise_dist(X, Y=None, integrand=None):
+    X = np.asarray(X, dtype=float)
+    symmetric = Y is None
+    Y = X if symmetric else np.asarray(Y, dtype=float)
+
+    sq_dist = np.sum(X**2, axis=1)[:, None] + np.sum(Y**2, axis=1)[None, :] - 2 * np.matmul(X, Y.T)
+    dist = np.sqrt(np.maximum(sq_dist, 0.0))
+    if symmetric:
+        np.fill_diagonal(dist, 0.0)
+    return dist
+
+# Input: X (n x k) and Y (m x k) base space coordinates
+# Output: n x m matrix of Euclidean distances between them
+def base_pairwise_dist(BX, BY):
+    BX = BX.reshape(len(BX), -1)
+    BY = BY.reshape(len(BY), -1)
+    return np.linalg.norm(BX[:, None, :] - BY[None, :, :], axis=-1)
+
+# Input: X (n x D) and Y (m x D) points on a manifold (Y defaults to X), inverse_chart of the manifold
+# Output: n x m matrix of Euclidean distances between their base space coordinates
+def base_coords_pairwise_dist(X, Y, inverse_chart):
+    BX = base_coords_of(X, inverse_chart)
+    BY = BX if Y is None else base_coords_of(Y, inverse_chart)
+    return base_pairwise_dist(BX, BY)
+
+def swiss_mfd_base_pairwise_dist(X, Y=None, integrand=None):
+    return base_coords_pairwise_dist(X, Y, swiss_inverse_chart)
+
+def torus_mfd_base_pairwise_dist(X, Y=None, integrand=None):
+    return base_coords_pairwise_dist(X, Y, torus_inverse_chart)
+
+def trefoil_mfd_base_pairwise_dist(X, Y=None, integrand=None):
+    return base_coords_pairwise_dist(X, Y, trefoil_inverse_chart)
+
+# Input: BX (n x k) and BY (m x k) base space coordinates; BY None means all pairs within BX
+# Output: n x m matrix of approximate geodesic distances, solved for all pairs in one cached_learn_distances call
+def geodesic_pairwise_dist(BX, BY, integrand):
+    BX = BX.reshape(len(BX), -1)
+
+    # paths are warm started from the previous call on a dataset of the same size, e.g. while Q is optimized
+    if BY is None:
+        iu, ju = np.triu_indices(len(BX), 1)
+        dist = np.zeros((len(BX), len(BX)))
+        dist[iu, ju] = cached_learn_distances(BX[iu], BX[ju], integrand, ('pairwise', integrand, len(BX)))
+        dist[ju, iu] = dist[iu, ju]
+        return dist
+
+    BY = BY.reshape(len(BY), -1)
+    ii, jj = np.meshgrid(np.arange(len(BX)), np.arange(len(BY)), indexing='ij')
+    dist = cached_learn_distances(BX[ii.ravel()], BY[jj.ravel()], integrand, ('pairwise', integrand, len(BX), len(BY)))
+    return dist.reshape(len(BX), len(BY))
+
+# Input: X (n x D) and Y (m x D) points on a manifold (Y defaults to X), inverse_chart of the manifold
+# Output: n x m matrix of approximate geodesic distances between them
+def geodesic_coords_pairwise_dist(X, Y, inverse_chart, integrand):
+    BX = fold_base_coords(base_coords_of(X, inverse_chart))
+    BY = None if Y is None else fold_base_coords(base_coords_of(Y, inverse_chart))
+    return geodesic_pairwise_dist(BX, BY, integrand)
+
+def swiss_mfd_pairwise_dist(X, Y=None, integrand=None):
+    return geodesic_coords_pairwise_dist(X, Y, swiss_inverse_chart, integrand_swiss if integrand is None else integrand)
+
+def torus_mfd_pairwise_dist(X, Y=None, integrand=None):
+    return geodesic_coords_pairwise_dist(X, Y, torus_inverse_chart, integrand_torus if integrand is None else integrand)
+
+def trefoil_mfd_pairwise_dist(X, Y=None, integrand=None):
+    return geodesic_coords_pairwise_dist(X, Y, trefoil_inverse_chart, integrand_trefoil if integrand is None else integrand)
+
+def klein_mfd_pairwise_dist(X, Y=None, integrand=None):
+    return geodesic_coords_pairwise_dist(X, Y, klein_inverse_chart, integrand_klein if integrand is None else integrand)
+
+def helicoid_mfd_pairwise_dist(X, Y=None, integrand=None):
+    return geodesic_coords_pairwise_dist(X, Y, helicoid_inverse_chart, integrand_helicoid if integrand is None else integrand)
+
+# Vectorized all-pairs versions of the pointwise distance functions above
+pairwise_dist_of = {
+    klein_mfd_dist: klein_mfd_pairwise_dist,
+    swiss_mfd_dist: swiss_mfd_pairwise_dist,
+    torus_mfd_dist: torus_mfd_pairwise_dist,
+    trefoil_mfd_dist: trefoil_mfd_pairwise_dist,
+    helicoid_mfd_dist: helicoid_mfd_pairwise_dist,
+    hyp_mfd_dist: hyp_mfd_pairwise_dist,
+    euclid_mfd_dist: euclid_mfd_pairwise_dist,
+    swiss_mfd_base_dist: swiss_mfd_base_pairwise_dist,
+    torus_mfd_base_dist: torus_mfd_base_pairwise_dist,
+    trefoil_mfd_base_dist: trefoil_mfd_base_pairwise_dist,
+}
+
+# Default integrands of the geodesic distance functions above
+geodesic_integrand_of = {
+    klein_mfd_dist: integrand_klein,
+    swiss_mfd_dist: integrand_swiss,
+    torus_mfd_dist: integrand_torus,
+    trefoil_mfd_dist: integrand_trefoil,
+    helicoid_mfd_dist: integrand_helicoid,
+}
+
+# Whether mfd_dist_generic (with mfd_integrand, or its default integrand) is computed exactly, in closed form or by a
+# formula of exact_dist_of, so that it obeys the triangle inequality (as VPTree needs); distances approximated by
+# geodesic_solver need not
+def is_exact_metric(mfd_dist_generic, mfd_integrand=None):
+    if mfd_dist_generic not in pairwise_dist_of:
+        return False
+    if mfd_dist_generic not in geodesic_integrand_of:
+        return True
+    return dist_method(geodesic_integrand_of[mfd_dist_generic] if mfd_integrand is None else mfd_integrand) == 'exact'
+
+# Input: X, Y (P x D) pairs of points on a manifold, inverse_chart of the manifold
+# Output: the P Euclidean distances between their base space coordinates
+def base_coords_paired_dist(X, Y, inverse_chart):
+    BX = base_coords_of(X, inverse_chart)
+    BY = base_coords_of(Y, inverse_chart)
+    return np.linalg.norm((BX - BY).reshape(len(BX), -1), axis=1)
+
+# Input: X, Y (P x D) pairs of points on a manifold, inverse_chart of the manifold
+# Output: the P approximate geodesic distances between them, solved in one cached_learn_distances call
+def geodesic_coords_paired_dist(X, Y, inverse_chart, integrand):
+    if len(X) == 0:
+        return np.zeros(0)
+    BX = fold_base_coords(base_coords_of(X, inverse_chart))
+    BY = fold_base_coords(base_coords_of(Y, inverse_chart))
+    return cached_learn_distances(BX, BY, integrand, ('paired', integrand, len(BX)))
+
+def hyp_mfd_paired_dist(X, Y, integrand=None):
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    return np.arccosh(np.maximum(X[:, 0] * Y[:, 0] - np.sum(X[:, 1:] * Y[:, 1:], axis=1), 1.0))
+
+def euclid_mfd_paired_dist(X, Y, integrand=None):
+    return np.linalg.norm(np.asarray(X, dtype=float) - np.asarray(Y, dtype=float), axis=1)
+
+# Vectorized versions of the pointwise distance functions above over P pairs of points (X, Y, integrand -> P distances)
+paired_dist_of = {
+    klein_mfd_dist: lambda X, Y, integrand=None: geodesic_coords_paired_dist(X, Y, klein_inverse_chart, integrand or integrand_klein),
+    swiss_mfd_dist: lambda X, Y, integrand=None: geodesic_coords_paired_dist(X, Y, swiss_inverse_chart, integrand or integrand_swiss),
+    torus_mfd_dist: lambda X, Y, integrand=None: geodesic_coords_paired_dist(X, Y, torus_inverse_chart, integrand or integrand_torus),
+    trefoil_mfd_dist: lambda X, Y, integrand=None: geodesic_coords_paired_dist(X, Y, trefoil_inverse_chart, integrand or integrand_trefoil),
+    helicoid_mfd_dist: lambda X, Y, integrand=None: geodesic_coords_paired_dist(X, Y, helicoid_inverse_chart, integrand or integrand_helicoid),
+    hyp_mfd_dist: hyp_mfd_paired_dist,
+    euclid_mfd_dist: euclid_mfd_paired_dist,
+    swiss_mfd_base_dist: lambda X, Y, integrand=None: base_coords_paired_dist(X, Y, swiss_inverse_chart),
+    torus_mfd_base_dist: lambda X, Y, integrand=None: base_coords_paired_dist(X, Y, torus_inverse_chart),
+    trefoil_mfd_base_dist: lambda X, Y, integrand=None: base_coords_paired_dist(X, Y, trefoil_inverse_chart),
+}
+
+# ----------------------------------------------------------------------------------------------------
+#
+# GRADIENTS OF WEIGHTED DISTANCE SUMS
+#
+# ----------------------------------------------------------------------------------------------------
+
+# Input: QB (n x d) points in the base space (after applying Q), mapped onto the hyperboloid by hyp_mfd
+#        W (n x n) weights of the pairwise distances
+# Output: sum_ij W_ij d(hyp_mfd(QB_i), hyp_mfd(QB_j)), and its gradient with respect to QB (n x d)
+def hyp_mfd_weighted_dist_grad(QB, W):
+    QB = np.asarray(QB, dtype=float)
+    x0 = hyp_mfd(QB)[:, 0]
+    c = np.maximum(np.outer(x0, x0) - np.matmul(QB, QB.T), 1.0)   # cosh of the distances
+    dist = np.arccosh(c)
+
+    # d arccosh(c) / dc = 1 / sqrt(c^2 - 1), and dc_ij / dQB_i = x0_j QB_i / x0_i - QB_j
+    sinh_dist = np.sqrt(c**2 - 1)
+    A = np.zeros_like(c)
+    nonzero = sinh_dist > 1e-12
+    A[nonzero] = (W + W.T)[nonzero] / sinh_dist[nonzero]
+    grad = (np.matmul(A, x0) / x0)[:, None] * QB - np.matmul(A, QB)
+
+    return np.sum(W * dist), grad
+
+# Input: QB (n x d) points in Euclidean space (after applying Q), W (n x n) weights of the pairwise distances
+# Output: sum_ij W_ij |QB_i - QB_j|, and its gradient with respect to QB (n x d)
+def euclid_mfd_weighted_dist_grad(QB, W):
+    QB = np.asarray(QB, dtype=float)
+    dist = euclid_mfd_pairwise_dist(QB)
+
+    A = np.zeros_like(dist)
+    nonzero = dist > 1e-12
+    A[nonzero] = (W + W.T)[nonzero] / dist[nonzero]
+    grad = np.sum(A, axis=1)[:, None] * QB - np.matmul(A, QB)
+
+    return np.sum(W * dist), grad
+
+# Closed-form gradients for pairs of (chart, distance) functions
+weighted_dist_grad_of = {
+    (hyp_mfd, hyp_mfd_dist): hyp_mfd_weighted_dist_grad,
+    (euclid_mfd, euclid_mfd_dist): euclid_mfd_weighted_dist_grad,
+}
+
+def has_dist_grad(mfd_generic, mfd_dist_generic):
+    return (mfd_generic, mfd_dist_generic) in weighted_dist_grad_of
+
+# Input: B (n x d) dataset in the base space, Q (d x d), W (n x n) weights
+# Output: sum_ij W_ij d(F(Q B_i), F(Q B_j)) for the chart F = mfd_generic, and its gradient with respect to Q
+def weighted_dist_grad(Q, B, W, mfd_generic, mfd_dist_generic):
+    B = np.asarray(B, dtype=float)
+    QB = np.matmul(B, Q.T)
+    total, grad_QB = weighted_dist_grad_of[(mfd_generic, mfd_dist_generic)](QB, W)
+    return total, np.matmul(grad_QB.T, B)
+
+# Input: QX, QY (P x d) pairs of points in the base space (after applying Q), mapped onto the hyperboloid by hyp_mfd
+# Output: the P distances d(hyp_mfd(QX_p), hyp_mfd(QY_p)), and their gradients with respect to QX and QY (P x d each)
+def hyp_mfd_paired_dist_grad(QX, QY):
+    QX = np.asarray(QX, dtype=float)
+    QY = np.asarray(QY, dtype=float)
+    x0 = hyp_mfd(QX)[:, 0]
+    y0 = hyp_mfd(QY)[:, 0]
+    c = np.maximum(x0 * y0 - np.sum(QX * QY, axis=1), 1.0)
+    dist = np.arccosh(c)
+
+    sinh_dist = np.sqrt(c**2 - 1)
+    scale = np.zeros_like(c)
+    nonzero = sinh_dist > 1e-12
+    scale[nonzero] = 1 / sinh_dist[nonzero]
+    grad_x = scale[:, None] * ((y0 / x0)[:, None] * QX - QY)
+    grad_y = scale[:, None] * ((x0 / y0)[:, None] * QY - QX)
+
+    return dist, grad_x, grad_y
+
+# Input: QX, QY (P x d) pairs of points in Euclidean space (after applying Q)
+# Output: the P distances |QX_p - QY_p|, and their gradients with respect to QX and QY (P x d each)
+def euclid_mfd_paired_dist_grad(QX, QY):
+    diff = np.asarray(QX, dtype=float) - np.asarray(QY, dtype=float)
+    dist = np.linalg.norm(diff, axis=1)
+
+    scale = np.zeros_like(dist)
+    nonzero = dist > 1e-12
+    scale[nonzero] = 1 / dist[nonzero]
+    grad_x = scale[:, None] * diff
+
+    return dist, grad_x, -grad_x
+
+paired_dist_grad_of = {
+    (hyp_mfd, hyp_mfd_dist): hyp_mfd_paired_dist_grad,
+    (euclid_mfd, euclid_mfd_dist): euclid_mfd_paired_dist_grad,
+}
+
+# Input: BX, BY (P x d) pairs of points in the base space, Q (d x d), w (P) weights
+# Output: the P distances d(F(Q BX_p), F(Q BY_p)) for the chart F = mfd_generic, and the gradient of
+#         sum_p w_p d_p with respect to Q
+def paired_dist_grad(Q, BX, BY, w, mfd_generic, mfd_dist_generic):
+    BX = np.asarray(BX, dtype=float)
+    BY = np.asarray(BY, dtype=float)
+    dist, grad_x, grad_y = paired_dist_grad_of[(mfd_generic, mfd_dist_generic)](np.matmul(BX, Q.T), np.matmul(BY, Q.T))
+    grad = np.matmul((w[:, None] * grad_x).T, BX) + np.matmul((w[:, None] * grad_y).T, BY)
+    return dist, grad
+
+# Input: X, Y (P x D) pairs of points on a manifold
+# Output: the P distances d(X_p, Y_p)
+# Uses the vectorized version of mfd_dist_generic if there is one; otherwise calls it once per pair
+def paired_mfd_dist(X, Y, mfd_dist_generic, mfd_integrand):
+    if mfd_dist_generic in paired_dist_of:
+        return paired_dist_of[mfd_dist_generic](X, Y, mfd_integrand)
+    return np.array([mfd_dist_generic(x, y, mfd_integrand) for x, y in zip(X, Y)], dtype=float)
+
+# Frechet means of sets of points, for distance functions whose manifold has them in closed form or by iterations
+frechet_mean_of = {
+    hyp_mfd_dist: hyp_mfd_frechet_mean,
+    euclid_mfd_dist: lambda X: np.mean(np.asarray(X, dtype=float), axis=0),
+}
+
+# Input: X (n x D), Y (m x D) points on a manifold, Y defaults to X
+#        mfd_dist_generic - pointwise distance function of the manifold
+# Output: n x m distance matrix
+# Uses the vectorized version of mfd_dist_generic if there is one; otherwise calls it once per pair
+# (once per unordered pair when Y is X, since manifold distances are symmetric)
+def pairwise_mfd_dist(X, Y, mfd_dist_generic, mfd_integrand):
+    if mfd_dist_generic in pairwise_dist_of:
+        return pairwise_dist_of[mfd_dist_generic](X, Y, mfd_integrand)
+
+    X = np.asarray(X, dtype=float)
+    if Y is None:
+        dist = np.zeros((len(X), len(X)))
+        for i in range(len(X)):
+            for j in range(i+1, len(X)):
+                dist[i, j] = mfd_dist_generic(X[i], X[j], mfd_integrand)
+                dist[j, i] = dist[i, j]
+        return dist
+
+    Y = np.asarray(Y, dtype=float)
+    dist = np.zeros((len(X), len(Y)))
+    for i in range(len(X)):
+        for j in range(len(Y)):
+            dist[i, j] = mfd_dist_generic(X[i], Y[j], mfd_integrand)
+    return dist
+
+
+# Inverse charts of the charts whose distance functions work in base space coordinates
+inverse_chart_of = {
+    klein_mfd: klein_inverse_chart,
+    swiss_mfd: swiss_inverse_chart,
+    torus_mfd: torus_inverse_chart,
+    trefoil_mfd: trefoil_inverse_chart,
+    helicoid_mfd: helicoid_inverse_chart,
+}
 
 # This function maps a dataset in the base Euclidean space (modified by a matrix Q)
 # onto a specified manifold
+# Input: B (n x d) dataset, Q (d x d), mfd_generic a chart taking n x d arrays
+# Output: n x D array of points on the manifold (MfdPoints, with their base space coordinates recovered by the
+#         inverse chart, if mfd_generic has one in inverse_chart_of)
 def map_dataset_to_mfd(B, Q, mfd_generic):
-    FQB = []
-    for x in B:
-        Qx = np.matmul(Q, x)
-        mQx = mfd_generic(Qx)
-        FQB.append(mQx)
-
-    return FQB
+    B = np.asarray(B, dtype=float)
+    QB = np.matmul(B, np.asarray(Q, dtype=float).T)
+    if mfd_generic in inverse_chart_of:
+        return MfdPoints(mfd_generic(QB), inverse_chart_of[mfd_generic])
+    return mfd_generic(QB)
@@ -1,6 +1,12 @@
-import numpy as np
+import os
+import time
 import scipy.io
-from sklearn.model_selection import train_test_split
+from datasets import load_dataset
+from results_store import ResultsStore, mat_file_name, methods
+from cluster_tests import *
+from classification_tests import *
+from manifold_functions import *
+import manifold_functions
 
 # ----------------------------------------------------------------------------------------------------
 #
@@ -12,12 +18,50 @@ def ensure_dir(path):
     if not os.path.exists(path):
        os.makedirs(path)
 
+# Sets up the approximate geodesic distances for runs on datasetname: solver path refinement, adaptive subdivision,
+# and the directory in which to store them across runs (geocache; None keeps them in memory only)
+def configure_geodesics(datasetname, geosolver='sample', geoadaptive=False, geocache=None):
+    manifold_functions.geodesic_solver.method = geosolver
+    manifold_functions.geodesic_solver.adaptive = geoadaptive
+
+    if geocache:
+        from geodesic_cache import GeodesicCache
+        manifold_functions.geodesic_cache = GeodesicCache(path=os.path.join(geocache, datasetname))
+
+# Runs nrounds of the 'clf' or 'clus' test on dataset (as returned by load_dataset) and saves the errors of the
+# four settings (Euclidean or manifold, identity or learned Q) as .mat files under ./DATASETNAME
+# Q_init, if given, holds the starting points (euc, mfd) of the fits of Q of each round; seed, if given, seeds the
+# train/test split of round r with seed + r, so that runs with the same seed share their splits; n_jobs runs the
+# rounds, fits and evaluations concurrently over that many processes; with a store (see ResultsStore) the errors,
+# learned Q and time taken are appended to it instead of being saved as .mat files; knn_block_size, if given,
+# classifies in blocks of that many points (see knnclassify_mapped), and max_dis_pairs fits the Q of clustering tests
+# on a subsample of the dissimilar pairs (see fit_mmc)
+# Output: (err_euc_orig, err_euc_qlrn, err_mfd_orig, err_mfd_qlrn), list of the Q (euc, mfd) learned in each round
+def run_test(test, datasetname, dataset, K, reg, lmbd, optimizer=None, clustering='kmeans', nrounds=2, Q_init=None, seed=None, n_jobs=None, store=None, knn_block_size=None, max_dis_pairs=None):
+    Beuc, Bhyp, Labels, train_ratio, fxn_mfd, fxn_mfd_dist, fxn_integrand = dataset
+    fxn_euc = euclid_mfd
+    fxn_euc_dist = euclid_mfd_dist
+    seeds = None if seed is None else [seed + r for r in range(nrounds)]
+    start = time.perf_counter()
+
+    if test == 'clf':
+        k = int(K)
+        *errs, Q_learned = do_classification_tests_all(nrounds, train_ratio, k, reg, lmbd, Beuc, fxn_euc, fxn_euc_dist, Bhyp, fxn_mfd, fxn_mfd_dist, fxn_integrand, Labels, optimizer, Q_init, seeds, True, n_jobs, knn_block_size)
+    else:
+        k = 0
+        *errs, Q_learned = do_cluster_tests_all(nrounds, train_ratio, k, reg, lmbd, Beuc, fxn_euc, fxn_euc_dist, Bhyp, fxn_mfd, fxn_mfd_dist, fxn_integrand, Labels, datasetname, optimizer, clustering, Q_init, seeds, True, n_jobs, max_dis_pairs)
+
+    if store is not None:
+        store.append(test, datasetname, k, reg, lmbd, errs, Q_learned, time.perf_counter() - start)
+    else:
+        ensure_dir(os.path.dirname(os.path.abspath(__file__)) + "/" + datasetname)
+        for method, err in zip(methods, errs):
+            scipy.io.savemat('./'+datasetname+'/'+mat_file_name(test, datasetname, k, reg, lmbd, method), mdict = {'arr': err})
+
+    return tuple(errs), Q_learned
+
 if __name__ == "__main__":
 
-    from cluster_tests import *
-    from classification_tests import *
-    from manifold_functions import *
-    import os
     import argparse
 
     parser = argparse.ArgumentParser()
@@ -27,146 +71,38 @@ if __name__ == "__main__":
     parser.add_argument('--lmbd')
     parser.add_argument('--clf', action='store_true')
     parser.add_argument('--clus', action='store_true')
+    parser.add_argument('--geocache', help='directory in which to store approximate geodesic distances across runs')
+    parser.add_argument('--geosolver', default='sample', choices=['sample', 'lbfgs'], help='path refinement used for approximate geodesic distances')
+    parser.add_argument('--optimizer', default='default', choices=['default', 'adam', 'sgd'], help='fit Q on minibatches with Adam or SGD instead of on the full loss')
+    parser.add_argument('--clustering', default='kmeans', choices=['kmeans', 'kmedoids', 'riemannian'], help='clustering method of the --clus tests')
+    parser.add_argument('--geoadaptive', action='store_true', help='adaptively subdivide the paths of approximate geodesic distances')
+    parser.add_argument('--seed', type=int, help='seed of the train/test splits and of the subsample of the swiss, torus and trefoil datasets (random by default)')
+    parser.add_argument('--jobs', type=int, help='run the rounds, fits and evaluations of the test concurrently over this many processes')
+    parser.add_argument('--store', help='append the results to this database (see results_store.py) instead of writing .mat files')
+    parser.add_argument('--knn-block-size', type=int, help='k-NN classify in blocks of this many test and training points instead of with a VPTree, bounding memory')
+    parser.add_argument('--max-dis-pairs', type=int, help='fit the Q of --clus tests on a class-balanced subsample of at most this many dissimilar pairs')
     args = parser.parse_args()
 
     reg = float(args.reg)
     lmbd = float(args.lmbd)
     datasetname = args.dataset
+    optimizer = None if args.optimizer == 'default' else args.optimizer
 
-    if datasetname == 'karate':
-        ensure_dir(os.path.dirname(os.path.abspath(__file__)) + "/karate")
-        Beuc   = scipy.io.loadmat('./data/karate.mat')['Beuc']
-        Bhyp   = scipy.io.loadmat('./data/karate.mat')['Bhyp']
-        Labels = scipy.io.loadmat('./data/karate.mat')['Labels']
-        train_ratio = 0.8
-        fxn_mfd = hyp_mfd
-        fxn_mfd_dist = hyp_mfd_dist
-        fxn_integrand = None
-
-    elif datasetname == 'helicoid':
-        ensure_dir(os.path.dirname(os.path.abspath(__file__)) + "/helicoid")
-        Beuc = scipy.io.loadmat('./data/helicoid.mat')['data']  # 3D
-        Bhyp   = scipy.io.loadmat('./data/helicoid.mat')['base'] # 2D
-        Labels = scipy.io.loadmat('./data/helicoid.mat')['labels']
-        train_ratio = 0.6
-        fxn_mfd = helicoid_mfd
-        fxn_mfd_dist = helicoid_mfd_dist
-        fxn_integrand = integrand_helicoid
-
-    elif datasetname == 'football':
-        ensure_dir(os.path.dirname(os.path.abspath(__file__)) + "/football")
-        Beuc   = scipy.io.loadmat('./data/football.mat')['Beuc']
-        Bhyp   = scipy.io.loadmat('./data/football.mat')['Bhyp']
-        Labels = scipy.io.loadmat('./data/football.mat')['Labels']
-        train_ratio = 0.75
-        fxn_mfd = hyp_mfd
-        fxn_mfd_dist = hyp_mfd_dist
-        fxn_integrand = None
-
-    elif datasetname == 'polbooks':
-        ensure_dir(os.path.dirname(os.path.abspath(__file__)) + "/polbooks")
-        Beuc   = scipy.io.loadmat('./data/polbooks.mat')['Beuc']
-        Bhyp   = scipy.io.loadmat('./data/polbooks.mat')['Bhyp']
-        Labels = scipy.io.loadmat('./data/polbooks.mat')['Labels']
-        train_ratio = 0.7
-        fxn_mfd = hyp_mfd
-        fxn_mfd_dist = hyp_mfd_dist
-        fxn_integrand = None
-
-    elif datasetname == 'adjnoun':
-        ensure_dir(os.path.dirname(os.path.abspath(__file__)) + "/adjnoun")
-        Beuc = scipy.io.loadmat('./data/adjnoun.mat')['Beuc']
-        Bhyp = scipy.io.loadmat('./data/adjnoun.mat')['Bhyp']
-        Labels = scipy.io.loadmat('./data/adjnoun.mat')['Labels']
-        train_ratio = 0.7
-        fxn_mfd = hyp_mfd
-        fxn_mfd_dist = hyp_mfd_dist
-        fxn_integrand = None
-
-    elif datasetname == '20newsgroup':
-        ensure_dir(os.path.dirname(os.path.abspath(__file__)) + "/20newsgroup")
-        Beuc = scipy.io.loadmat('./data/20newsgroup.mat')['Beuc']
-        Bhyp = scipy.io.loadmat('./data/20newsgroup.mat')['Bhyp']
-        Labels = scipy.io.loadmat('./data/20newsgroup.mat')['Labels']
-        train_ratio = 0.7
-        fxn_mfd = hyp_mfd
-        fxn_mfd_dist = hyp_mfd_dist
-        fxn_integrand = None
-
-    elif datasetname == 'klein':
-        ensure_dir(os.path.dirname(os.path.abspath(__file__)) + "/klein")
-        Beuc = scipy.io.loadmat('./data/klein.mat')['Beuc']
-        Bhyp = scipy.io.loadmat('./data/klein.mat')['Bklein']
-        Labels = scipy.io.loadmat('./data/klein.mat')['labels']
-        train_ratio = 0.7
-        fxn_mfd = klein_mfd
-        fxn_mfd_dist = klein_mfd_dist
-        fxn_integrand = integrand_klein
-
-    elif datasetname == 'swiss':
-        ensure_dir(os.path.dirname(os.path.abspath(__file__)) + "/swiss")
-        Beuc = scipy.io.loadmat('./data/swiss.mat')['swiss_base']
-        Bhyp = scipy.io.loadmat('./data/swiss.mat')['swiss_data']
-        Labels = scipy.io.loadmat('./data/swiss.mat')['swiss_labels']
-
-        _, Beuc, __, Bhyp, ___, Labels = train_test_split(Beuc, Bhyp, Labels, test_size=0.4)
-
-        train_ratio = 0.7
-        fxn_mfd = swiss_mfd
-        fxn_mfd_dist = swiss_mfd_base_dist
-        fxn_integrand = None
-
-    elif datasetname == 'torus':
-        ensure_dir(os.path.dirname(os.path.abspath(__file__)) + "/torus")
-        Beuc = scipy.io.loadmat('./data/torus.mat')['torus_base']
-        Bhyp = scipy.io.loadmat('./data/torus.mat')['torus_data']
-        Labels = scipy.io.loadmat('./data/torus.mat')['torus_labels']
-
-        _, Beuc, __, Bhyp, ___, Labels = train_test_split(Beuc, Bhyp, Labels, test_size=0.4)
-
-        train_ratio = 0.7
-        fxn_mfd = torus_mfd
-        fxn_mfd_dist = torus_mfd_base_dist
-        fxn_integrand = None
-
-    elif datasetname == 'trefoil':
-        ensure_dir(os.path.dirname(os.path.abspath(__file__)) + "/trefoil")
-        Beuc = scipy.io.loadmat('./data/trefoil.mat')['trefoil_base']
-        Bhyp = scipy.io.loadmat('./data/trefoil.mat')['trefoil_data']
-        Labels = scipy.io.loadmat('./data/trefoil.mat')['trefoil_labels']
-
-        _, Beuc, __, Bhyp, ___, Labels = train_test_split(Beuc, Bhyp, Labels, test_size=0.4)
-
-        train_ratio = 0.7
-        fxn_mfd = trefoil_mfd
-        fxn_mfd_dist = trefoil_mfd_base_dist
-        fxn_integrand = None
-
-
-    else:
+    dataset = load_dataset(datasetname, args.seed)
+    if dataset is None:
         print('Undefined dataset!')
         exit()
 
-    fxn_euc = euclid_mfd
-    fxn_euc_dist = euclid_mfd_dist
-    nrounds = 2
+    if not (args.clf or args.clus):
+        print("No test type specified, exiting.")
+        exit()
 
-    if args.clf:
-        k = int(args.K)
-        err_euc_orig, err_euc_qlrn, err_mfd_orig, err_mfd_qlrn = do_classification_tests_all(nrounds, train_ratio, k, reg, lmbd, Beuc, fxn_euc, fxn_euc_dist, Bhyp, fxn_mfd, fxn_mfd_dist, fxn_integrand, Labels)
-        scipy.io.savemat('./'+datasetname+'/'+datasetname+'_CLF_err_euc_orig_reg'+str(reg)+'_k'+str(k)+'_lmbd'+str(lmbd)+'.mat', mdict = {'arr': err_euc_orig})
-        scipy.io.savemat('./'+datasetname+'/'+datasetname+'_CLF_err_euc_qlrn_reg'+str(reg)+'_k'+str(k)+'_lmbd'+str(lmbd)+'.mat', mdict = {'arr': err_euc_qlrn})
-        scipy.io.savemat('./'+datasetname+'/'+datasetname+'_CLF_err_mfd_orig_reg'+str(reg)+'_k'+str(k)+'_lmbd'+str(lmbd)+'.mat', mdict = {'arr': err_mfd_orig})
-        scipy.io.savemat('./'+datasetname+'/'+datasetname+'_CLF_err_mfd_qlrn_reg'+str(reg)+'_k'+str(k)+'_lmbd'+str(lmbd)+'.mat', mdict = {'arr': err_mfd_qlrn})
+    if args.clus:
+        check_cluster_method(args.clustering, euclid_mfd_dist, dataset[5])
 
-    elif args.clus:
-        k = 0
-        err_euc_orig, err_euc_qlrn, err_mfd_orig, err_mfd_qlrn = do_cluster_tests_all(nrounds, train_ratio, k, reg, lmbd, Beuc, fxn_euc, fxn_euc_dist, Bhyp, fxn_mfd, fxn_mfd_dist, fxn_integrand, Labels, datasetname)
-        scipy.io.savemat('./'+datasetname+'/'+datasetname+'_CLUS_err_euc_orig_reg'+str(reg)+'_lmbd'+str(lmbd)+'.mat', mdict = {'arr': err_euc_orig})
-        scipy.io.savemat('./'+datasetname+'/'+datasetname+'_CLUS_err_euc_qlrn_reg'+str(reg)+'_lmbd'+str(lmbd)+'.mat', mdict = {'arr': err_euc_qlrn})
-        scipy.io.savemat('./'+datasetname+'/'+datasetname+'_CLUS_err_mfd_orig_reg'+str(reg)+'_lmbd'+str(lmbd)+'.mat', mdict = {'arr': err_mfd_orig})
-        scipy.io.savemat('./'+datasetname+'/'+datasetname+'_CLUS_err_mfd_qlrn_reg'+str(reg)+'_lmbd'+str(lmbd)+'.mat', mdict = {'arr': err_mfd_qlrn})
+    configure_geodesics(datasetname, args.geosolver, args.geoadaptive, args.geocache)
+    run_test('clf' if args.clf else 'clus', datasetname, dataset, args.K, reg, lmbd, optimizer, args.clustering, seed=args.seed, n_jobs=args.jobs,
+             store=ResultsStore(args.store) if args.store else None, knn_block_size=args.knn_block_size, max_dis_pairs=args.max_dis_pairs)
 
-    else:
-        print("No test type specified, exiting.")
-        exit()
+    if args.geocache:
+        manifold_functions.geodesic_cache.save()
@@ -0,0 +1,108 @@
+import numpy as np
+from manifold_functions import pairwise_mfd_dist
+
+# ----------------------------------------------------------------------------------------------------
+#
+# NEAREST NEIGHBOR INDEX
+#
+# ----------------------------------------------------------------------------------------------------
+
+# Vantage-point tree over points on a manifold, for k nearest neighbor queries under any distance that obeys the
+# triangle inequality (e.g. hyp_mfd_dist, euclid_mfd_dist)
+# Each node holds a vantage point and the median mu of the distances from it to the points below the node:
+# points within mu are in the inside subtree, the others in the outside subtree; nodes with at most leaf_size
+# points are leaves
+# Queries are answered in batches: at every node, the distances from all the queries still searching it to the
+# vantage point (or to the points of a leaf) are computed at once with pairwise_mfd_dist, and a subtree is skipped
+# for the queries whose current k-th neighbor is closer than any point the subtree can contain
+class VPTree:
+    def __init__(self, points, mfd_dist_generic, mfd_integrand, leaf_size=64, seed=0):
+        self.points = np.asanyarray(points, dtype=float)   # keeps the base space coordinates of MfdPoints
+        self.mfd_dist_generic = mfd_dist_generic
+        self.mfd_integrand = mfd_integrand
+        self.leaf_size = leaf_size
+
+        # nodes, as parallel lists: vantage point, mu, inside child, outside child, points of leaves (else None)
+        self.vp = []
+        self.mu = []
+        self.inside = []
+        self.outside = []
+        self.leaf = []
+        self.build(np.arange(len(self.points)), np.random.default_rng(seed))
+
+    def dist(self, X, idx):
+        return pairwise_mfd_dist(X, self.points[idx], self.mfd_dist_generic, self.mfd_integrand)
+
+    def new_node(self):
+        for field in (self.vp, self.mu, self.inside, self.outside, self.leaf):
+            field.append(None)
+        return len(self.vp) - 1
+
+    def build(self, idx, rng):
+        root = self.new_node()
+        stack = [(root, idx)]
+        while stack:
+            node, idx = stack.pop()
+            if len(idx) <= self.leaf_size:
+                self.leaf[node] = idx
+                continue
+
+            pick = rng.integers(len(idx))
+            vp, rest = idx[pick], np.delete(idx, pick)
+            d = self.dist(self.points[[vp]], rest)[0]
+            mu = np.median(d)
+            inside = d <= mu
+
+            # all points at the same distance from the vantage point: nothing to split on
+            if inside.all():
+                self.leaf[node] = idx
+                continue
+
+            self.vp[node], self.mu[node] = vp, mu
+            self.inside[node], self.outside[node] = self.new_node(), self.new_node()
+            stack.append((self.inside[node], rest[inside]))
+            stack.append((self.outside[node], rest[~inside]))
+
+    # Input: X (m x D) query points, k
+    # Output: m x k distances to the k nearest points of the tree (in increasing order), and their m x k indices
+    #         (fewer than k neighbors are padded with infinite distances and index -1)
+    def query(self, X, k):
+        X = np.asanyarray(X, dtype=float)
+        self.best_dist = np.full((len(X), k), np.inf)
+        self.best_idx = np.full((len(X), k), -1, dtype=int)
+        if len(self.points) > 0 and len(X) > 0 and k > 0:
+            self.search(0, X, np.arange(len(X)))
+
+        best_dist, best_idx = self.best_dist, self.best_idx
+        del self.best_dist, self.best_idx
+        return best_dist, best_idx
+
+    # Merges candidates (distances D, len(qids) x c, to the points idx) into the running k nearest of the queries
+    def merge(self, qids, D, idx):
+        all_dist = np.concatenate((self.best_dist[qids], D), axis=1)
+        all_idx = np.concatenate((self.best_idx[qids], np.broadcast_to(idx, D.shape)), axis=1)
+        order = np.argsort(all_dist, axis=1, kind='stable')[:, :self.best_dist.shape[1]]
+        self.best_dist[qids] = np.take_along_axis(all_dist, order, axis=1)
+        self.best_idx[qids] = np.take_along_axis(all_idx, order, axis=1)
+
+    def search(self, node, X, qids):
+        if len(qids) == 0:
+            return
+
+        if self.leaf[node] is not None:
+            if len(self.leaf[node]) > 0:
+                self.merge(qids, self.dist(X[qids], self.leaf[node]), self.leaf[node])
+            return
+
+        vp, mu = self.vp[node], self.mu[node]
+        dq = self.dist(X[qids], [vp])[:, 0]
+        self.merge(qids, dq[:, None], [vp])
+
+        # each query first searches the subtree it falls in, then the other one if it can still hold a closer point
+        near_inside = dq <= mu
+        self.search(self.inside[node], X, qids[near_inside])
+        self.search(self.outside[node], X, qids[~near_inside])
+
+        tau = self.best_dist[qids, -1]
+        self.search(self.outside[node], X, qids[near_inside & (dq + tau > mu)])
+        self.search(self.inside[node], X, qids[~near_inside & (dq - tau <= mu)])
@@ -0,0 +1,154 @@
+import io
+import os
+import json
+import time
+import sqlite3
+import numpy as np
+import scipy.io
+
+# ----------------------------------------------------------------------------------------------------
+#
+# RESULTS STORE
+#
+# ----------------------------------------------------------------------------------------------------
+
+# The four settings whose errors a test reports, in the order of do_*_tests_all
+methods = ['euc_orig', 'euc_qlrn', 'mfd_orig', 'mfd_qlrn']
+
+# Name of the .mat file holding the errors of one method over the rounds of a test, as written by run_test
+def mat_file_name(test, datasetname, K, reg, lmbd, method):
+    if test == 'clf':
+        return datasetname+'_CLF_err_'+method+'_reg'+str(float(reg))+'_k'+str(int(K))+'_lmbd'+str(float(lmbd))+'.mat'
+    return datasetname+'_CLUS_err_'+method+'_reg'+str(float(reg))+'_lmbd'+str(float(lmbd))+'.mat'
+
+def Q_to_blob(Q):
+    buf = io.BytesIO()
+    np.save(buf, np.asarray(Q, dtype=float))
+    return buf.getvalue()
+
+def blob_to_Q(blob):
+    return np.load(io.BytesIO(blob))
+
+# Results of metric learning tests in one SQLite database, appended to by any number of processes at once
+# Tables: runs (one row per run of a test: test, dataset, K, reg, lmbd, number of rounds, seconds it took, time it
+# finished), errors (one row per run, round and method, with the error as JSON: the 0-1 error of a classification
+# test, [ARI, NMI] of a clustering test) and Q (the Q learned in each run and round, for 'euc' and 'mfd')
+# Runs are indexed by (dataset, test, K, reg, lmbd); a grid point run more than once keeps all its runs
+# The database is in write-ahead-log mode, so that readers do not block writers; each call opens its own
+# connection, so a store can be passed to forked workers
+class ResultsStore:
+    def __init__(self, path, timeout=60.0):
+        self.path = path
+        self.timeout = timeout
+        with self.connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, test TEXT, dataset TEXT, K INTEGER, reg REAL,
+                    lmbd REAL, nrounds INTEGER, seconds REAL, finished REAL);
+                CREATE TABLE IF NOT EXISTS errors (run INTEGER, round INTEGER, method TEXT, value TEXT);
+                CREATE TABLE IF NOT EXISTS Q (run INTEGER, round INTEGER, space TEXT, Q BLOB);
+                CREATE INDEX IF NOT EXISTS runs_by_point ON runs (dataset, test, K, reg, lmbd);
+                CREATE INDEX IF NOT EXISTS errors_by_run ON errors (run, method);
+                CREATE INDEX IF NOT EXISTS Q_by_run ON Q (run);''')
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout)
+        conn.row_factory = sqlite3.Row
+        return ClosingConnection(conn)
+
+    # Appends a run: errs (err_euc_orig, err_euc_qlrn, err_mfd_orig, err_mfd_qlrn, each a list over the rounds),
+    # Q_learned (list over the rounds of the Q (euc, mfd), or None) and the seconds the run took
+    # Output: id of the run
+    def append(self, test, datasetname, K, reg, lmbd, errs, Q_learned=None, seconds=None):
+        K = int(K) if test == 'clf' else 0
+        with self.connect() as conn:
+            cur = conn.execute('INSERT INTO runs (test, dataset, K, reg, lmbd, nrounds, seconds, finished) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               (test, datasetname, K, float(reg), float(lmbd), len(errs[0]), seconds, time.time()))
+            run = cur.lastrowid
+            conn.executemany('INSERT INTO errors (run, round, method, value) VALUES (?, ?, ?, ?)',
+                             [(run, r, method, json.dumps(np.asarray(err[r]).tolist())) for method, err in zip(methods, errs) for r in range(len(err))])
+            if Q_learned is not None:
+                conn.executemany('INSERT INTO Q (run, round, space, Q) VALUES (?, ?, ?, ?)',
+                                 [(run, r, space, Q_to_blob(Q)) for r, Qs in enumerate(Q_learned) for space, Q in zip(['euc', 'mfd'], Qs)])
+        return run
+
+    # Input: conditions on the runs (None matches anything)
+    # Output: list of the runs matching, oldest first, as dicts of the columns of runs
+    def runs(self, test=None, dataset=None, K=None, reg=None, lmbd=None):
+        where, params = [], []
+        for column, value in (('test', test), ('dataset', dataset), ('K', K), ('reg', reg), ('lmbd', lmbd)):
+            if value is not None:
+                where.append(column + ' = ?')
+                params.append(value)
+        sql = 'SELECT * FROM runs' + (' WHERE ' + ' AND '.join(where) if where else '') + ' ORDER BY id'
+        with self.connect() as conn:
+            return [dict(row) for row in conn.execute(sql, params)]
+
+    # Output: errors of a run, as a dict method -> list over the rounds
+    def errors(self, run):
+        errs = {method: [] for method in methods}
+        with self.connect() as conn:
+            for row in conn.execute('SELECT method, value FROM errors WHERE run = ? ORDER BY round', (run,)):
+                errs[row['method']].append(json.loads(row['value']))
+        return errs
+
+    # Output: Q learned in a run, as a list over the rounds of (euc, mfd)
+    def Q(self, run):
+        Qs = {}
+        with self.connect() as conn:
+            for row in conn.execute('SELECT round, space, Q FROM Q WHERE run = ?', (run,)):
+                Qs.setdefault(row['round'], {})[row['space']] = blob_to_Q(row['Q'])
+        return [(Qs[r]['euc'], Qs[r]['mfd']) for r in sorted(Qs)]
+
+    # Writes the errors of the runs matching the conditions (see runs) as the .mat files run_test writes without a
+    # store, under out_dir/DATASETNAME; of several runs of a grid point, the latest one is written
+    # Output: number of files written
+    def export_mat(self, out_dir='.', **conditions):
+        latest = {}
+        for run in self.runs(**conditions):
+            latest[(run['test'], run['dataset'], run['K'], run['reg'], run['lmbd'])] = run['id']
+
+        nfiles = 0
+        for (test, datasetname, K, reg, lmbd), run in latest.items():
+            os.makedirs(os.path.join(out_dir, datasetname), exist_ok=True)
+            for method, err in self.errors(run).items():
+                scipy.io.savemat(os.path.join(out_dir, datasetname, mat_file_name(test, datasetname, K, reg, lmbd, method)), mdict = {'arr': err})
+                nfiles += 1
+        return nfiles
+
+# sqlite3 connection used as a context manager that commits (or rolls back on an error) and then closes it
+class ClosingConnection:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        finally:
+            self.conn.close()
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('store', help='results database written by metric_learning.py or sweep.py with --store')
+    parser.add_argument('--export', metavar='DIR', help='write the errors as the per-run .mat files under DIR/DATASETNAME')
+    parser.add_argument('--dataset')
+    parser.add_argument('--test', choices=['clf', 'clus'])
+    args = parser.parse_args()
+
+    store = ResultsStore(args.store)
+    if args.export:
+        print(str(store.export_mat(args.export, test=args.test, dataset=args.dataset)) + ' files written')
+    else:
+        for run in store.runs(test=args.test, dataset=args.dataset):
+            errs = store.errors(run['id'])
+            print(run['dataset'], run['test'], 'K=' + str(run['K']), 'reg=' + str(run['reg']), 'lmbd=' + str(run['lmbd']),
+                  str(round(run['seconds'] or 0, 1)) + 's', json.dumps(errs))
@@ -0,0 +1,194 @@
+import numpy as np
+from scipy.optimize import OptimizeResult
+from loss_functions import mmc_minibatch_loss, lmnn_minibatch_loss, get_target_neighbors
+from manifold_functions import has_dist_grad
+
+# ----------------------------------------------------------------------------------------------------
+#
+# STOCHASTIC OPTIMIZATION
+#
+# ----------------------------------------------------------------------------------------------------
+
+# Minimizes fun(x, batch) by stochastic gradient steps on the minibatches drawn by sample(rng)
+# Inputs:
+#   fun - returns (loss, gradient) when jac is True, and the loss alone otherwise (the gradient is then
+#         estimated by central differences of the minibatch loss, with step fd_step)
+#   x0 - initial point
+#   sample - draws a minibatch, given a numpy Generator
+#   heldout - loss on a fixed held-out set, evaluated every check_every steps
+#   method - 'adam' or 'sgd' (with momentum)
+#   lr, decay - the step size at step t is lr / (1 + decay t)
+#   maxiter - maximum number of steps
+#   patience, tol - stop once the held-out loss has not improved by more than tol (relative) in patience checks
+#   seed - seed of the minibatch sampling
+# Output: OptimizeResult; x is the iterate with the lowest held-out loss, and fun is that loss
+def minimize_stochastic(fun, x0, sample, heldout, jac=True, method='adam', lr=0.05, decay=1e-3, momentum=0.9, beta2=0.999,
+                        eps=1e-8, maxiter=2000, check_every=50, patience=5, tol=1e-4, seed=0, fd_step=1e-5):
+    if method not in ('adam', 'sgd'):
+        raise ValueError("Unknown stochastic method '" + str(method) + "', expected 'adam' or 'sgd'")
+
+    rng = np.random.default_rng(seed)
+    x = np.array(x0, dtype=float).ravel()
+    m = np.zeros_like(x)
+    v = np.zeros_like(x)
+    nfev = 0
+
+    best_x = x.copy()
+    best_fun = heldout(x)
+    checks_since_best = 0
+    message = 'Maximum number of iterations reached'
+
+    for t in range(1, maxiter + 1):
+        batch = sample(rng)
+        if jac:
+            _, grad = fun(x, batch)
+            nfev += 1
+        else:
+            grad = np.zeros_like(x)
+            for i in range(len(x)):
+                step = np.zeros_like(x)
+                step[i] = fd_step
+                grad[i] = (fun(x + step, batch) - fun(x - step, batch)) / (2 * fd_step)
+            nfev += 2 * len(x)
+
+        step_size = lr / (1 + decay * t)
+        if method == 'adam':
+            m = momentum * m + (1 - momentum) * grad
+            v = beta2 * v + (1 - beta2) * grad**2
+            x = x - step_size * (m / (1 - momentum**t)) / (np.sqrt(v / (1 - beta2**t)) + eps)
+        else:
+            m = momentum * m + grad
+            x = x - step_size * m
+
+        if t % check_every == 0:
+            f = heldout(x)
+            if f < best_fun - tol * abs(best_fun):
+                best_x, best_fun = x.copy(), f
+                checks_since_best = 0
+            else:
+                checks_since_best += 1
+                if checks_since_best >= patience:
+                    message = 'Held-out loss stopped improving'
+                    break
+
+    if heldout(x) < best_fun:
+        best_x, best_fun = x.copy(), heldout(x)
+
+    return OptimizeResult(x=best_x, fun=best_fun, nit=t, nfev=nfev, success=np.isfinite(best_fun), message=message)
+
+# Samples pairs of points with the same or different labels, and points with a label different from given ones
+# Sampling costs O(P log n) for P samples, after an O(n log n) setup
+class LabelSampler:
+    def __init__(self, labels):
+        labels = np.asarray(labels).ravel()
+        self.n = len(labels)
+        self.order = np.argsort(labels, kind='stable')
+        classes, self.cls, counts = np.unique(labels, return_inverse=True, return_counts=True)
+        self.start = np.concatenate(([0], np.cumsum(counts)[:-1]))[self.cls]   # first position of each point's class in order
+        self.count = counts[self.cls]                                          # size of each point's class
+        self.pos = np.empty(self.n, dtype=int)                                 # position of each point in order
+        self.pos[self.order] = np.arange(self.n)
+
+        # point i is the first of a uniformly random unordered pair with probability proportional to its partners
+        self.cum_same = np.cumsum(self.count - 1)
+        self.cum_diff = np.cumsum(self.n - self.count)
+
+    def npairs(self, same):
+        cum = self.cum_same if same else self.cum_diff
+        return int(cum[-1]) // 2 if self.n > 0 else 0
+
+    # Output: P x 2 array of pairs of points, uniform over the pairs with the same (or different) labels
+    def pairs(self, P, same, rng):
+        cum = self.cum_same if same else self.cum_diff
+        if self.n == 0 or cum[-1] == 0:
+            return np.zeros((0, 2), dtype=int)
+
+        I = np.searchsorted(cum, rng.random(P) * cum[-1], side='right')
+        J = self.same_as(I, rng) if same else self.others(I, rng)
+        return np.stack((I, J), axis=1)
+
+    # Output: for each point of I, a uniformly random other point with the same label
+    def same_as(self, I, rng):
+        r = np.floor(rng.random(len(I)) * (self.count[I] - 1)).astype(int)
+        r += r >= self.pos[I] - self.start[I]
+        return self.order[self.start[I] + r]
+
+    # Output: for each point of I, a uniformly random point with a different label
+    def others(self, I, rng):
+        r = np.floor(rng.random(len(I)) * (self.n - self.count[I])).astype(int)
+        r += np.where(r >= self.start[I], self.count[I], 0)
+        return self.order[r]
+
+# Splits the indices of the training points into those sampled for the updates and a held-out part
+def heldout_split(npts, heldout_ratio, rng):
+    perm = rng.permutation(npts)
+    nheld = min(max(int(round(heldout_ratio * npts)), 2), npts // 2)
+    return perm[nheld:], perm[:nheld]
+
+# Learns Q by minimizing the MMC loss on minibatches of batch_size similar and batch_size dissimilar pairs
+# A heldout_ratio part of the training points is held out: the MMC loss on a fixed sample of heldout_size of
+# their pairs is the convergence criterion
+# method, seed and the remaining options are passed to minimize_stochastic
+def fit_mmc_stochastic(Q0, reg, lmbd, fxn, fxn_dist, fxn_integrand, data_tr, labels_tr, method='adam', batch_size=256,
+                       heldout_ratio=0.1, heldout_size=1024, seed=0, **options):
+    B = np.asarray(data_tr, dtype=float)
+    labels = np.asarray(labels_tr).ravel()
+    rng = np.random.default_rng(seed)
+    idx_fit, idx_held = heldout_split(len(B), heldout_ratio, rng)
+
+    fit_sampler = LabelSampler(labels[idx_fit])
+    held_sampler = LabelSampler(labels[idx_held])
+    held_sim = idx_held[held_sampler.pairs(heldout_size // 2, True, rng)]
+    held_dis = idx_held[held_sampler.pairs(heldout_size // 2, False, rng)]
+
+    jac = has_dist_grad(fxn, fxn_dist)
+
+    def sample(rng):
+        return idx_fit[fit_sampler.pairs(batch_size, True, rng)], idx_fit[fit_sampler.pairs(batch_size, False, rng)]
+
+    def fun(Q, batch):
+        return mmc_minibatch_loss(Q, reg, lmbd, fxn, fxn_dist, fxn_integrand, B, batch[0], batch[1], jac)
+
+    def heldout(Q):
+        return mmc_minibatch_loss(Q, reg, lmbd, fxn, fxn_dist, fxn_integrand, B, held_sim, held_dis)
+
+    return minimize_stochastic(fun, np.ravel(Q0), sample, heldout, jac=jac, method=method, seed=seed, **options)
+
+# Learns Q by minimizing the LMNN loss on minibatches of batch_size triplets
+# Target neighbors are the K nearest points with the same label under Q0 (among the points sampled for the
+# updates, or among the held-out points), and impostors are drawn uniformly among the points with other labels
+# A heldout_ratio part of the training points is held out: the LMNN loss on a fixed sample of heldout_size of
+# their triplets is the convergence criterion
+# method, seed and the remaining options are passed to minimize_stochastic
+def fit_lmnn_stochastic(Q0, K, reg, lmbd, fxn, fxn_dist, fxn_integrand, data_tr, labels_tr, method='adam', batch_size=256,
+                        heldout_ratio=0.1, heldout_size=1024, seed=0, **options):
+    B = np.asarray(data_tr, dtype=float)
+    labels = np.asarray(labels_tr).ravel()
+    rng = np.random.default_rng(seed)
+    idx_fit, idx_held = heldout_split(len(B), heldout_ratio, rng)
+
+    fit_sampler = LabelSampler(labels[idx_fit])
+    held_sampler = LabelSampler(labels[idx_held])
+    fit_targets = get_target_neighbors(B[idx_fit], Q0, labels[idx_fit], K, fxn, fxn_dist, fxn_integrand)
+    held_targets = get_target_neighbors(B[idx_held], Q0, labels[idx_held], K, fxn, fxn_dist, fxn_integrand)
+
+    # triplets are drawn in the local indices of each part, then mapped back to indices of data_tr
+    def triplets_of(idx, sampler, targets, size, rng):
+        if len(targets) == 0 or sampler.npairs(False) == 0:
+            return np.zeros((0, 3), dtype=int)
+        pairs = targets[rng.integers(len(targets), size=size)]
+        return idx[np.concatenate((pairs, sampler.others(pairs[:, 0], rng)[:, None]), axis=1)]
+
+    held_triplets = triplets_of(idx_held, held_sampler, held_targets, heldout_size, rng)
+    jac = has_dist_grad(fxn, fxn_dist)
+
+    def sample(rng):
+        return triplets_of(idx_fit, fit_sampler, fit_targets, batch_size, rng)
+
+    def fun(Q, batch):
+        return lmnn_minibatch_loss(Q, reg, lmbd, fxn, fxn_dist, fxn_integrand, B, batch, jac)
+
+    def heldout(Q):
+        return lmnn_minibatch_loss(Q, reg, lmbd, fxn, fxn_dist, fxn_integrand, B, held_triplets)
+
+    return minimize_stochastic(fun, np.ravel(Q0), sample, heldout, jac=jac, method=method, seed=seed, **options)
@@ -0,0 +1,195 @@
+import os
+import json
+import itertools
+import multiprocessing
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from geodesic_cache import GeodesicCache
+import manifold_functions
+from datasets import load_dataset
+from metric_learning import configure_geodesics, run_test
+from results_store import ResultsStore
+from cluster_tests import check_cluster_method
+import task_pool
+
+try:
+    import fcntl
+except ImportError:   # no file locking on this platform; workers finishing at the same time may then mix log lines
+    fcntl = None
+
+# ----------------------------------------------------------------------------------------------------
+#
+# PARALLEL HYPERPARAMETER SWEEPS
+#
+# ----------------------------------------------------------------------------------------------------
+
+# Datasets of the sweep (name -> load_dataset output), loaded once in the parent process and shared with the
+# workers: with the fork start method they are inherited copy-on-write instead of being sent to each worker
+worker_datasets = None
+
+# Options of the sweep shared by all its grid points (optimizer, clustering, geodesic solver settings, split seed,
+# log path, results store)
+worker_options = None
+
+# Geodesic distance caches of this worker, one per dataset, kept across the grid points it runs
+worker_caches = {}
+
+def set_worker_state(datasets, options):
+    global worker_datasets, worker_options
+    worker_datasets = datasets
+    worker_options = options
+    task_pool.in_worker = True
+
+# Grid point: (test, datasetname, K, reg, lmbd); K is 0 for clustering tests, which do not use it
+def grid_points(test, datasetnames, K_vals, reg_vals, lmbd_vals):
+    if test == 'clus':
+        K_vals = [0]
+    return [(test, d, int(K), float(reg), float(lmbd)) for d, K, reg, lmbd in itertools.product(datasetnames, K_vals, reg_vals, lmbd_vals)]
+
+# Continuation paths through the grid points: one chain per (test, dataset, K, reg), in increasing lmbd, along which
+# each fit of Q starts from the Q learned at the previous grid point; without warm_start every grid point is a chain
+def grid_chains(points, warm_start=True):
+    if not warm_start:
+        return [[p] for p in points]
+    chains = OrderedDict()
+    for p in sorted(points, key=lambda p: p[4]):
+        chains.setdefault(p[:4], []).append(p)
+    return list(chains.values())
+
+# Grid points recorded as finished in the log of a sweep (one JSON object per line), with the Q (euc, mfd) they
+# learned in each round
+# Logs written before the learned Q were kept hold one grid point (a JSON list) per line; those are finished with
+# no Q, so a chain resuming after one starts from the identity
+def read_done(log_path):
+    if not os.path.exists(log_path):
+        return {}
+    done = {}
+    with open(log_path) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                if isinstance(entry, list):
+                    done[tuple(entry)] = None
+                else:
+                    done[tuple(entry['point'])] = [tuple(np.array(Q) for Q in Qs) for Qs in entry['Q']]
+    return done
+
+def record_done(log_path, point, Q_learned):
+    line = json.dumps({'point': list(point), 'Q': [[Q.tolist() for Q in Qs] for Qs in Q_learned]}) + '\n'
+    with open(log_path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+
+# Runs the tests of a chain of grid points in a worker, in order, starting the fits of Q of each from the Q learned
+# at the one before (Q_init for the first one; None starts from the identity); each grid point is logged as soon as
+# it finishes
+# The global numpy random state is reseeded, since forked workers would otherwise all start from the parent's state
+def run_chain(chain, Q_init=None):
+    np.random.seed()
+    for point in chain:
+        test, datasetname, K, reg, lmbd = point
+
+        geocache = worker_options['geocache']
+        configure_geodesics(datasetname, worker_options['geosolver'], worker_options['geoadaptive'])
+        if datasetname not in worker_caches:
+            worker_caches[datasetname] = GeodesicCache(path=os.path.join(geocache, datasetname) if geocache else None)
+        manifold_functions.geodesic_cache = worker_caches[datasetname]
+
+        _, Q_learned = run_test(test, datasetname, worker_datasets[datasetname], K, reg, lmbd, worker_options['optimizer'], worker_options['clustering'],
+                                Q_init=Q_init, seed=worker_options['seed'], store=worker_options['store'], knn_block_size=worker_options['knn_block_size'],
+                                max_dis_pairs=worker_options['max_dis_pairs'])
+        record_done(worker_options['log_path'], point, Q_learned)
+        if geocache:
+            worker_caches[datasetname].save()
+        if worker_options['warm_start']:
+            Q_init = Q_learned
+    return chain
+
+# Runs the tests of all grid points not yet recorded in log_path over n_jobs processes (all CPUs by default)
+# Each dataset is loaded once, before the workers start; chains of grid points (see grid_chains) are handed to the
+# workers one at a time as they become free, and each grid point is appended to log_path when it finishes, so that
+# an interrupted sweep started again with the same log_path skips them (a chain resumes from the last Q logged)
+# The train/test splits of round r are seeded with seed + r, and subsampled datasets with seed, so that all grid
+# points of a dataset share them
+# Output: grid points run, grid points not run because their chain failed
+# store, if given, is a ResultsStore to which all grid points append their results instead of writing .mat files
+# knn_block_size, if given, k-NN classifies in blocks of that many points (see knnclassify_mapped), and
+# max_dis_pairs fits the Q of clustering tests on a subsample of the dissimilar pairs (see fit_mmc)
+def sweep(test, datasetnames, K_vals, reg_vals, lmbd_vals, n_jobs=None, log_path='sweep_done.log', optimizer=None, clustering='kmeans', geosolver='sample', geoadaptive=False, geocache=None, seed=0, warm_start=True, store=None, knn_block_size=None, max_dis_pairs=None):
+    done = read_done(log_path)
+    chains = []
+    for chain in grid_chains(grid_points(test, datasetnames, K_vals, reg_vals, lmbd_vals), warm_start):
+        finished = [p for p in chain if p in done]
+        todo = [p for p in chain if p not in done]
+        if todo:
+            chains.append((todo, done[finished[-1]] if warm_start and finished else None))
+    if not chains:
+        return [], []
+    points = [p for todo, _ in chains for p in todo]
+
+    datasets = {}
+    for datasetname in sorted({p[1] for p in points}):
+        datasets[datasetname] = load_dataset(datasetname, seed)
+        if datasets[datasetname] is None:
+            raise ValueError('Undefined dataset: ' + datasetname)
+        if test == 'clus':
+            check_cluster_method(clustering, manifold_functions.euclid_mfd_dist, datasets[datasetname][5])
+
+    options = {'optimizer': optimizer, 'clustering': clustering, 'geosolver': geosolver, 'geoadaptive': geoadaptive, 'geocache': geocache,
+               'seed': seed, 'log_path': log_path, 'warm_start': warm_start, 'store': store, 'knn_block_size': knn_block_size,
+               'max_dis_pairs': max_dis_pairs}
+    n_jobs = os.cpu_count() if n_jobs is None else n_jobs
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+
+    with ProcessPoolExecutor(max_workers=min(n_jobs, len(chains)), mp_context=context, initializer=set_worker_state, initargs=(datasets, options)) as pool:
+        futures = {pool.submit(run_chain, todo, Q_init): todo for todo, Q_init in chains}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print('FAILED ' + str(futures[future][0][:4]) + ': ' + repr(e))
+
+    done_now = read_done(log_path)
+    finished = [p for p in points if p in done_now]
+    failed = [p for p in points if p not in done_now]
+    print('DONE ' + str(len(finished)) + ' of ' + str(len(points)) + ' grid points')
+    return finished, failed
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datasets', nargs='+', required=True)
+    parser.add_argument('--K', nargs='+', type=int, default=[1, 3, 5, 7, 11])
+    parser.add_argument('--reg', nargs='+', type=float, default=[0.2, 0.3, 0.5, 0.8])
+    parser.add_argument('--lmbd', nargs='+', type=float, default=[0, 0.1, 0.2, 0.5, 0.7, 1, 2, 4, 10])
+    parser.add_argument('--clf', action='store_true')
+    parser.add_argument('--clus', action='store_true')
+    parser.add_argument('--jobs', type=int, help='number of worker processes (all CPUs by default)')
+    parser.add_argument('--log', default='sweep_done.log', help='file recording the finished grid points, for resuming the sweep')
+    parser.add_argument('--geocache', help='directory in which to store approximate geodesic distances across runs')
+    parser.add_argument('--geosolver', default='sample', choices=['sample', 'lbfgs'], help='path refinement used for approximate geodesic distances')
+    parser.add_argument('--optimizer', default='default', choices=['default', 'adam', 'sgd'], help='fit Q on minibatches with Adam or SGD instead of on the full loss')
+    parser.add_argument('--clustering', default='kmeans', choices=['kmeans', 'kmedoids', 'riemannian'], help='clustering method of the --clus tests')
+    parser.add_argument('--geoadaptive', action='store_true', help='adaptively subdivide the paths of approximate geodesic distances')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the train/test splits and dataset subsamples, shared by all grid points')
+    parser.add_argument('--no-warm-start', action='store_true', help='start every fit of Q from the identity instead of the Q learned at the previous lmbd')
+    parser.add_argument('--store', help='append the results to this database (see results_store.py) instead of writing .mat files')
+    parser.add_argument('--knn-block-size', type=int, help='k-NN classify in blocks of this many test and training points instead of with a VPTree, bounding memory')
+    parser.add_argument('--max-dis-pairs', type=int, help='fit the Q of --clus tests on a class-balanced subsample of at most this many dissimilar pairs')
+    args = parser.parse_args()
+
+    if not (args.clf or args.clus):
+        print("No test type specified, exiting.")
+        exit()
+
+    optimizer = None if args.optimizer == 'default' else args.optimizer
+    _, failed = sweep('clf' if args.clf else 'clus', args.datasets, args.K, args.reg, args.lmbd, args.jobs, args.log, optimizer, args.clustering, args.geosolver, args.geoadaptive, args.geocache,
+                      args.seed, not args.no_warm_start, ResultsStore(args.store) if args.store else None, args.knn_block_size, args.max_dis_pairs)
+    if failed:
+        exit(1)
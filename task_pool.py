@@ -0,0 +1,67 @@
+import os
+import random
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import manifold_functions
+
+# ----------------------------------------------------------------------------------------------------
+#
+# CONCURRENT TASKS
+#
+# ----------------------------------------------------------------------------------------------------
+
+# True in worker processes (of run_tasks or of a sweep), which already share the CPUs with the other workers
+in_worker = False
+
+# Number of processes for n_jobs None: all CPUs, or 1 in a worker process, so that pools started from within workers
+# do not multiply the processes
+def default_jobs(n_jobs):
+    if n_jobs is not None:
+        return n_jobs
+    return 1 if in_worker else os.cpu_count()
+
+# Runs fun(*args) in a worker process, with np.random and random seeded with seed
+# The geodesic distances the task computes only reach the worker's copy of manifold_functions.geodesic_cache, so
+# they are saved to its directory (if it has one) before returning, where the parent and other workers find them
+# Output: result of the task, and the counts it added to manifold_functions.dist_method_counts (to be added to the
+#         parent's)
+def run_seeded(seed, fun, args):
+    global in_worker
+    in_worker = True
+    np.random.seed(seed)
+    random.seed(seed)
+    counts = manifold_functions.dist_method_counts.copy()
+    result = fun(*args)
+    if manifold_functions.geodesic_cache is not None:
+        manifold_functions.geodesic_cache.save()
+    return result, manifold_functions.dist_method_counts - counts
+
+# Runs tasks (a list of (function, args)) and returns their results in the order of the tasks
+# With n_jobs None or 1 they run one after another in this process; otherwise concurrently over n_jobs processes
+# (forked where the platform allows), each task with np.random and random seeded from a seed drawn from np.random
+# here, so that the results follow np.random.seed whichever worker runs a task and whenever it finishes
+def run_tasks(tasks, n_jobs=None):
+    if n_jobs is None or n_jobs <= 1 or len(tasks) <= 1:
+        return [fun(*args) for fun, args in tasks]
+
+    seeds = np.random.randint(2**31, size=len(tasks)).tolist()
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(max_workers=min(n_jobs, len(tasks)), mp_context=context) as pool:
+        futures = [pool.submit(run_seeded, seed, fun, args) for seed, (fun, args) in zip(seeds, tasks)]
+        results = []
+        for future in futures:
+            result, counts = future.result()
+            manifold_functions.dist_method_counts.update(counts)
+            results.append(result)
+    if manifold_functions.geodesic_cache is not None:
+        manifold_functions.geodesic_cache.stored.clear()   # re-read the on-disk store, now holding the tasks' distances
+    return results
+
+# Splits n_jobs processes between n concurrent tasks that each run tasks of their own
+# Output: number of processes for the outer tasks, number of processes for the tasks of each of them
+def split_jobs(n_jobs, n):
+    if n_jobs is None or n_jobs <= 1:
+        return n_jobs, n_jobs
+    outer = min(n_jobs, n)
+    return outer, max(1, n_jobs // outer)
@@ -0,0 +1,51 @@
+import multiprocessing
+import numpy as np
+from geodesic_cache import GeodesicCache
+from manifold_functions import integrand_swiss
+
+settings = {'solver': 'sample', 'n': 10}
+
+def pairs(seed, n=20):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(1, 3, size=(n, 2)), rng.uniform(1, 3, size=(n, 2))
+
+def test_lookup_is_symmetric_and_keyed_on_settings():
+    cache = GeodesicCache()
+    BX, BY = pairs(0)
+    _, found, keys = cache.lookup(BX, BY, integrand_swiss, settings)
+    assert not found.any()
+    cache.store(keys, np.arange(len(keys), dtype=float), integrand_swiss, settings)
+
+    dist, found, _ = cache.lookup(BY, BX, integrand_swiss, settings)
+    assert found.all() and np.array_equal(dist, np.arange(len(keys)))
+    _, found, _ = cache.lookup(BX, BY, integrand_swiss, dict(settings, n=20))
+    assert not found.any()
+
+def test_save_and_load_round_trip(tmp_path):
+    cache = GeodesicCache(path=str(tmp_path))
+    BX, BY = pairs(0)
+    _, _, keys = cache.lookup(BX, BY, integrand_swiss, settings)
+    cache.store(keys, np.arange(len(keys), dtype=float), integrand_swiss, settings)
+    cache.save()
+
+    dist, found, _ = GeodesicCache(path=str(tmp_path)).lookup(BX, BY, integrand_swiss, settings)
+    assert found.all() and np.array_equal(dist, np.arange(len(keys)))
+
+def save_from_job(args):
+    path, seed = args
+    cache = GeodesicCache(path=path)
+    BX, BY = pairs(seed)
+    _, _, keys = cache.lookup(BX, BY, integrand_swiss, settings)
+    cache.store(keys, np.full(len(keys), float(seed)), integrand_swiss, settings)
+    cache.save()
+
+# Saves from concurrent jobs are merged under the file lock, so none of their entries are lost
+def test_concurrent_saves_merge(tmp_path):
+    seeds = list(range(1, 9))
+    with multiprocessing.Pool(4) as pool:
+        pool.map(save_from_job, [(str(tmp_path), seed) for seed in seeds])
+
+    cache = GeodesicCache(path=str(tmp_path))
+    for seed in seeds:
+        dist, found, _ = cache.lookup(*pairs(seed), integrand_swiss, settings)
+        assert found.all() and np.all(dist == seed)
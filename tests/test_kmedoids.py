@@ -0,0 +1,27 @@
+import itertools
+import numpy as np
+from kmedoids import kmedoids, fasterpam
+
+def tiny_problem():
+    rng = np.random.default_rng(0)
+    X = np.concatenate([rng.normal(size=(4, 2)) + c for c in ([0, 0], [5, 0], [0, 5])])
+    return np.linalg.norm(X[:, None, :] - X[None, :, :], axis=-1)
+
+# Lowest total deviation over every set of k medoids
+def brute_force_deviation(dist, k):
+    return min(dist[:, list(medoids)].min(axis=1).sum() for medoids in itertools.combinations(range(len(dist)), k))
+
+def test_kmedoids_matches_exhaustive_search():
+    dist = tiny_problem()
+    nearest, medoids, deviation = kmedoids(dist, 3, n_jobs=1)
+    assert np.isclose(deviation, brute_force_deviation(dist, 3))
+    assert np.isclose(deviation, dist[np.arange(len(dist)), medoids[nearest]].sum())
+    assert np.array_equal(nearest, dist[:, medoids].argmin(axis=1))
+
+# A single FasterPAM run from a poor start still reaches a local optimum no worse than its start
+def test_fasterpam_improves_start():
+    dist = tiny_problem()
+    start = np.array([0, 1, 2])
+    medoids, nearest, deviation = fasterpam(dist, start.copy())
+    assert deviation <= dist[:, start].min(axis=1).sum()
+    assert np.isclose(deviation, dist[np.arange(len(dist)), medoids[nearest]].sum())
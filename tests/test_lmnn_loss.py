@@ -0,0 +1,49 @@
+import numpy as np
+import manifold_functions as mf
+from loss_functions import lmnn_loss_generic, new_lmnn_state
+
+# Central finite differences of f at Q (flattened)
+def finite_diff_grad(f, Q, eps=1e-6):
+    grad = np.zeros(Q.size)
+    for i in range(Q.size):
+        step = np.zeros(Q.size)
+        step[i] = eps
+        grad[i] = (f(Q.ravel() + step) - f(Q.ravel() - step)) / (2 * eps)
+    return grad
+
+def lmnn_problem():
+    rng = np.random.default_rng(0)
+    labels = np.repeat([0, 1, 2], 6)
+    B = rng.normal(size=(18, 3)) + labels[:, None]
+    Q = np.eye(3) + 0.1 * rng.normal(size=(3, 3))
+    return B, labels, Q
+
+def check_lmnn_grad(fxn, fxn_dist):
+    B, labels, Q = lmnn_problem()
+    state = new_lmnn_state()
+    lmnn_loss_generic(Q, None, 3, 0.5, 0.1, fxn, fxn_dist, None, B, labels, update=True, state=state)
+
+    loss, grad = lmnn_loss_generic(Q, None, 3, 0.5, 0.1, fxn, fxn_dist, None, B, labels, return_grad=True, active_refresh=0, state=state)
+    f = lambda q: lmnn_loss_generic(q, None, 3, 0.5, 0.1, fxn, fxn_dist, None, B, labels, active_refresh=0, state=state)
+    assert np.isclose(loss, f(Q))
+    assert np.allclose(grad, finite_diff_grad(f, Q), atol=1e-5)
+
+def test_hyp_lmnn_grad():
+    check_lmnn_grad(mf.hyp_mfd, mf.hyp_mfd_dist)
+
+def test_euclid_lmnn_grad():
+    check_lmnn_grad(mf.euclid_mfd, mf.euclid_mfd_dist)
+
+# Small steps stay within the active set, so it gives the same loss as evaluating every triplet
+def test_lmnn_active_set_matches_full_loss():
+    B, labels, Q = lmnn_problem()
+    state = new_lmnn_state()
+    lmnn_loss_generic(Q, None, 3, 0.5, 0.1, mf.hyp_mfd, mf.hyp_mfd_dist, None, B, labels, update=True, state=state)
+
+    rng = np.random.default_rng(1)
+    for _ in range(5):
+        Q = Q + 0.01 * rng.normal(size=Q.shape)
+        active = lmnn_loss_generic(Q, None, 3, 0.5, 0.1, mf.hyp_mfd, mf.hyp_mfd_dist, None, B, labels, state=state)
+        full = lmnn_loss_generic(Q, None, 3, 0.5, 0.1, mf.hyp_mfd, mf.hyp_mfd_dist, None, B, labels, active_refresh=0, state=dict(state))
+        assert np.isclose(active, full)
+    assert state['evals'] > 1
@@ -0,0 +1,33 @@
+import numpy as np
+import manifold_functions as mf
+from loss_functions import mmc_loss_generic, new_mmc_state
+
+# Central finite differences of f at Q (flattened)
+def finite_diff_grad(f, Q, eps=1e-6):
+    grad = np.zeros(Q.size)
+    for i in range(Q.size):
+        step = np.zeros(Q.size)
+        step[i] = eps
+        grad[i] = (f(Q.ravel() + step) - f(Q.ravel() - step)) / (2 * eps)
+    return grad
+
+def check_mmc_grad(fxn, fxn_dist, max_dis_pairs=None):
+    rng = np.random.default_rng(0)
+    B = rng.normal(size=(12, 3))
+    labels = np.repeat([0, 1, 2], 4)
+    Q = np.eye(3) + 0.1 * rng.normal(size=(3, 3))
+    state = new_mmc_state()
+
+    loss, grad = mmc_loss_generic(Q, 0.5, 0.1, fxn, fxn_dist, None, B, labels, return_grad=True, max_dis_pairs=max_dis_pairs, state=state)
+    f = lambda q: mmc_loss_generic(q, 0.5, 0.1, fxn, fxn_dist, None, B, labels, max_dis_pairs=max_dis_pairs, state=state)
+    assert np.isclose(loss, f(Q))
+    assert np.allclose(grad, finite_diff_grad(f, Q), atol=1e-6)
+
+def test_hyp_mmc_grad():
+    check_mmc_grad(mf.hyp_mfd, mf.hyp_mfd_dist)
+
+def test_euclid_mmc_grad():
+    check_mmc_grad(mf.euclid_mfd, mf.euclid_mfd_dist)
+
+def test_mmc_grad_subsampled_dis_pairs():
+    check_mmc_grad(mf.hyp_mfd, mf.hyp_mfd_dist, max_dis_pairs=10)
@@ -0,0 +1,40 @@
+import numpy as np
+import manifold_functions as mf
+from neighbor_index import VPTree
+from classification_tests import knnclassify_generic, knnclassify_stream, knn_vote
+
+def check_query(fxn, fxn_dist, k):
+    rng = np.random.default_rng(0)
+    data = mf.map_dataset_to_mfd(rng.normal(size=(200, 3)), np.eye(3), fxn)
+    queries = mf.map_dataset_to_mfd(rng.normal(size=(30, 3)), np.eye(3), fxn)
+
+    # small leaves, so that queries have to prune subtrees
+    dist, idx = VPTree(data, fxn_dist, None, leaf_size=4).query(queries, k)
+    brute = mf.pairwise_mfd_dist(queries, data, fxn_dist, None)
+    assert np.allclose(dist, np.sort(brute, axis=1)[:, :k])
+    assert np.allclose(np.take_along_axis(brute, idx, axis=1), dist)
+
+def test_hyp_vptree_matches_brute_force():
+    check_query(mf.hyp_mfd, mf.hyp_mfd_dist, 5)
+
+def test_euclid_vptree_matches_brute_force():
+    check_query(mf.euclid_mfd, mf.euclid_mfd_dist, 5)
+
+# Asking for more neighbors than there are points pads with inf distances and -1 indices
+def test_vptree_pads_missing_neighbors():
+    data = mf.map_dataset_to_mfd(np.random.default_rng(0).normal(size=(3, 2)), np.eye(2), mf.euclid_mfd)
+    dist, idx = VPTree(data, mf.euclid_mfd_dist, None).query(data, 5)
+    assert np.all(np.isinf(dist[:, 3:])) and np.all(idx[:, 3:] == -1)
+    assert np.array_equal(np.sort(idx[:, :3], axis=1), np.tile(np.arange(3), (3, 1)))
+
+def test_knn_vote_skips_padding():
+    assert knn_vote(np.array([[0, 1, 2, -1, -1, -1, -1]]), np.array([1, 1, 2])).tolist() == [1]
+
+# The VPTree path and the streaming path classify alike
+def test_knnclassify_index_matches_stream():
+    rng = np.random.default_rng(0)
+    labels = np.repeat([0, 1], 40)
+    data = mf.map_dataset_to_mfd(rng.normal(size=(80, 2)) + 2 * labels[:, None], np.eye(2), mf.hyp_mfd)
+    index = knnclassify_generic(data, 5, data, labels, mf.hyp_mfd_dist, None, skip_first_nbr=True)
+    stream = np.concatenate(list(knnclassify_stream(data, 5, data, labels, mf.hyp_mfd_dist, None, skip_first_nbr=True, block_size=16)))
+    assert index == stream.tolist()
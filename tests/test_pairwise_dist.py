@@ -0,0 +1,27 @@
+import numpy as np
+import manifold_functions as mf
+
+# Vectorized all-pairs distances against the pointwise distance functions
+def check_pairwise(fxn, fxn_dist, B, integrand=None):
+    X = mf.map_dataset_to_mfd(B[:8], np.eye(B.shape[1]), fxn)
+    Y = mf.map_dataset_to_mfd(B[8:], np.eye(B.shape[1]), fxn)
+    pointwise = np.array([[fxn_dist(x, y, integrand) for y in Y] for x in X])
+    assert np.allclose(mf.pairwise_mfd_dist(X, Y, fxn_dist, integrand), pointwise)
+
+    pointwise = np.array([[fxn_dist(x, y, integrand) if i != j else 0 for j, y in enumerate(X)] for i, x in enumerate(X)])
+    assert np.allclose(mf.pairwise_mfd_dist(X, None, fxn_dist, integrand), pointwise)
+
+def test_hyp_pairwise_dist():
+    check_pairwise(mf.hyp_mfd, mf.hyp_mfd_dist, np.random.default_rng(0).normal(size=(14, 3)))
+
+def test_euclid_pairwise_dist():
+    check_pairwise(mf.euclid_mfd, mf.euclid_mfd_dist, np.random.default_rng(1).normal(size=(14, 3)))
+
+def test_base_coords_pairwise_dist():
+    B = np.random.default_rng(2).uniform(0.2, 1.2, size=(14, 2))
+    check_pairwise(mf.torus_mfd, mf.torus_mfd_base_dist, B)
+    check_pairwise(mf.swiss_mfd, mf.swiss_mfd_base_dist, B)
+
+# The exact swiss roll distance (see exact_dist_of) through the pairwise and pointwise paths
+def test_swiss_geodesic_pairwise_dist():
+    check_pairwise(mf.swiss_mfd, mf.swiss_mfd_dist, np.random.default_rng(3).uniform(1, 3, size=(14, 2)), mf.integrand_swiss)
@@ -0,0 +1,58 @@
+import json
+import numpy as np
+import manifold_functions as mf
+import sweep
+from results_store import ResultsStore
+
+def test_read_done_reads_old_and_new_log_lines(tmp_path):
+    log_path = str(tmp_path / 'done.log')
+    with open(log_path, 'w') as f:
+        f.write(json.dumps(['clf', 'toy', 1, 0.5, 0.0]) + '\n')
+    Q = np.arange(4.0).reshape(2, 2)
+    sweep.record_done(log_path, ('clf', 'toy', 1, 0.5, 0.1), [(Q, 2 * Q)])
+
+    done = sweep.read_done(log_path)
+    assert done[('clf', 'toy', 1, 0.5, 0.0)] is None
+    (Q_euc, Q_mfd), = done[('clf', 'toy', 1, 0.5, 0.1)]
+    assert np.array_equal(Q_euc, Q) and np.array_equal(Q_mfd, 2 * Q)
+
+# Stands in for run_test: records the grid point and the Q it started from, and learns Q = lmbd * I
+def fake_run_test(calls_path):
+    def run_test(test, datasetname, dataset, K, reg, lmbd, *args, Q_init=None, **kwargs):
+        with open(calls_path, 'a') as f:
+            f.write(json.dumps([[test, datasetname, K, reg, lmbd], None if Q_init is None else float(Q_init[0][0][0, 0])]) + '\n')
+        Q = lmbd * np.eye(2)
+        return (), [(Q, Q)]
+    return run_test
+
+# A resumed sweep runs only the grid points not logged, continuing each chain from the last Q logged
+def test_resumed_sweep_skips_finished_points(tmp_path, monkeypatch):
+    calls_path = str(tmp_path / 'calls')
+    log_path = str(tmp_path / 'done.log')
+    monkeypatch.setattr(sweep, 'load_dataset', lambda datasetname, seed: (None,) * 7)
+    monkeypatch.setattr(sweep, 'run_test', fake_run_test(calls_path))
+    sweep.record_done(log_path, ('clf', 'toy', 1, 0.5, 0.1), [(0.1 * np.eye(2), 0.1 * np.eye(2))])
+
+    finished, failed = sweep.sweep('clf', ['toy'], [1], [0.5], [0.1, 0.2, 0.5], n_jobs=1, log_path=log_path)
+    assert finished == [('clf', 'toy', 1, 0.5, 0.2), ('clf', 'toy', 1, 0.5, 0.5)] and failed == []
+    with open(calls_path) as f:
+        calls = [json.loads(line) for line in f]
+    assert calls == [[['clf', 'toy', 1, 0.5, 0.2], 0.1], [['clf', 'toy', 1, 0.5, 0.5], 0.2]]
+
+    assert sweep.sweep('clf', ['toy'], [1], [0.5], [0.1, 0.2, 0.5], n_jobs=1, log_path=log_path) == ([], [])
+
+# End to end on a tiny Euclidean dataset, with the results in a store: a second sweep over a larger grid only runs
+# the new grid points
+def test_sweep_resumes_end_to_end(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    labels = np.repeat([1, 2], 15)[:, None]   # as loaded from .mat files
+    B = rng.normal(size=(30, 2)) + 3 * labels
+    dataset = (B, B, labels, 0.7, mf.euclid_mfd, mf.euclid_mfd_dist, None)
+    monkeypatch.setattr(sweep, 'load_dataset', lambda datasetname, seed: dataset)
+    store = ResultsStore(str(tmp_path / 'results.db'))
+    log_path = str(tmp_path / 'done.log')
+
+    sweep.sweep('clf', ['toy'], [3], [0.5], [0.1], n_jobs=1, log_path=log_path, store=store)
+    finished, failed = sweep.sweep('clf', ['toy'], [3], [0.5], [0.1, 0.2], n_jobs=1, log_path=log_path, store=store)
+    assert finished == [('clf', 'toy', 3, 0.5, 0.2)] and failed == []
+    assert [run['lmbd'] for run in store.runs(dataset='toy')] == [0.1, 0.2]